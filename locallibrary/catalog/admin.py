@@ -1,6 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import Author, Genre, Book, BookInstance, Language, User
+from django.forms.models import BaseInlineFormSet
+from django.utils.functional import cached_property
+from django.utils.http import urlencode
+from .models import Author, Genre, Book, BookInstance, Language, LoanEvent, OverdueNotice, User
+from .pagination import CachedCountPaginator
 
 
 """Minimal registration of Models.
@@ -11,38 +15,107 @@ admin.site.register(BookInstance)
 admin.site.register(Language)
 """
 
-admin.site.register(Genre)
-admin.site.register(Language)
 admin.site.register(User, UserAdmin)
 
-class BooksInline(admin.TabularInline):
+
+class ScalableAdmin(admin.ModelAdmin):
+    """Base for the catalog admins: the changelist count is cached and the unfiltered total is not counted."""
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Genre)
+class GenreAdmin(admin.ModelAdmin):
+    search_fields = ('name',)   # Needed for autocomplete_fields.
+
+
+@admin.register(Language)
+class LanguageAdmin(admin.ModelAdmin):
+    search_fields = ('name',)
+
+
+class CappedInlineFormSet(BaseInlineFormSet):
+    """Inline formset that shows only the first `cap` existing objects.
+
+    Every inline form costs a render (and its widgets' queries), so a book with thousands of
+    copies would otherwise produce a page nobody can load. The rest are edited from their own changelist:
+    the inline template (CappedInlineMixin) shows the total and links to the changelist filtered by the parent.
+    """
+    cap = 20
+
+    def get_queryset(self):
+        if not hasattr(self, '_capped_queryset'):
+            self._capped_queryset = super().get_queryset()[:self.cap]
+        return self._capped_queryset
+
+    @cached_property
+    def total_count(self):
+        """The number of related objects when there are more than the cap, otherwise None."""
+        if len(self.get_queryset()) < self.cap:
+            return None
+        total = super().get_queryset().count()
+        return total if total > self.cap else None
+
+    def changelist_query(self):
+        """Query string filtering the related objects' changelist to this formset's parent."""
+        return urlencode({f'{self.fk.name}__{self.fk.target_field.name}__exact': self.instance.pk})
+
+
+class CappedInlineMixin:
+    """Inline admin using CappedInlineFormSet, with a note and link when rows are left out."""
+    formset = CappedInlineFormSet
+    template = 'admin/edit_inline/capped_tabular.html'
+
+
+class BooksInline(CappedInlineMixin, admin.TabularInline):
     """Defines format of inline book insertion (used in AuthorAdmin)"""
     model = Book
     extra = 0
+    # Search widgets rather than a <select> of every row in each form.
+    autocomplete_fields = ('language', 'genre')
+
+    def get_queryset(self, request):
+        # The forms' initial genres come from the prefetch rather than a query per book.
+        return super().get_queryset(request).prefetch_related('genre')
 
 
-class BooksInstanceInline(admin.TabularInline):
+class BooksInstanceInline(CappedInlineMixin, admin.TabularInline):
     """Defines format of inline book instance insertion (used in BookAdmin)"""
     model = BookInstance
     extra = 0
+    autocomplete_fields = ('borrower',)
+
+    def get_queryset(self, request):
+        # BookInstance.__str__ (shown for each inline row) reads the book's title.
+        return super().get_queryset(request).select_related('book')
 
 
 # Register the Admin classes for Book using the decorator
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(ScalableAdmin):
     """Administration object for Book models.
         Defines:
          - fields to be displayed in list view (list_display)
+         - filters that will be displayed in sidebar (list_filter); language and genre are
+           small tables, a filter listing every title or author is not
          - adds inline addition of book instances in book view (inlines)
         """
     list_display = ('title', 'author', 'display_genre')
-    list_filter = ('title', 'author')
+    list_filter = ('language', 'genre')
+    list_select_related = ('author',)
+    # Prefix and exact matches: case-insensitive LIKEs, answered from the NOCASE title and isbn indexes.
+    search_fields = ('^title', '=isbn')
+    autocomplete_fields = ('author', 'language', 'genre')
     inlines = [BooksInstanceInline]
 
+    def get_queryset(self, request):
+        # display_genre reads the prefetched genres instead of running a query per row.
+        return super().get_queryset(request).prefetch_related('genre')
+
 
 # Register the Admin classes for BookInstance using the decorator
 @admin.register(BookInstance)
-class BookInstanceAdmin(admin.ModelAdmin):
+class BookInstanceAdmin(ScalableAdmin):
     """Administration object for BookInstance models.
        Defines:
         - fields to be displayed in list view (list_display)
@@ -51,6 +124,8 @@ class BookInstanceAdmin(admin.ModelAdmin):
        """
     list_display = ('book', 'status', 'borrower', 'due_back', 'id')
     list_filter = ('status', 'due_back')
+    list_select_related = ('book', 'borrower')
+    autocomplete_fields = ('book', 'borrower')
 
     fieldsets = (
         (None, {
@@ -63,7 +138,7 @@ class BookInstanceAdmin(admin.ModelAdmin):
 
 
 @admin.register(Author)
-class AuthorAdmin(admin.ModelAdmin):
+class AuthorAdmin(ScalableAdmin):
     """Administration object for Author models.
         Defines:
          - fields to be displayed in list view (list_display)
@@ -72,7 +147,36 @@ class AuthorAdmin(admin.ModelAdmin):
          - adds inline addition of books in author view (inlines)
         """
     list_display = ('last_name', 'first_name', 'date_of_birth', 'date_of_death')
+    search_fields = ('^last_name', '^first_name')
     inlines = [BooksInline]
 
     fields = ['first_name', 'last_name', ('date_of_birth', 'date_of_death')]
 
+
+
+@admin.register(OverdueNotice)
+class OverdueNoticeAdmin(ScalableAdmin):
+    """Administration object for the overdue digest written by the sweep_overdue command."""
+    list_display = ('swept_on', 'book_instance', 'borrower', 'due_back', 'days_overdue')
+    list_filter = ('swept_on',)
+    list_select_related = ('book_instance__book', 'borrower')
+    raw_id_fields = ('book_instance', 'borrower')
+
+
+@admin.register(LoanEvent)
+class LoanEventAdmin(ScalableAdmin):
+    """Read-only view of the append-only loan history."""
+    list_display = ('occurred_at', 'kind', 'book_instance_id', 'book', 'borrower', 'old_status', 'new_status',
+                    'due_back')
+    list_filter = ('kind', 'day')
+    list_select_related = ('book', 'borrower')
+    search_fields = ('=book_instance__id',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
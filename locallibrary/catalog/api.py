@@ -0,0 +1,180 @@
+"""Read-only JSON API for the catalog.
+
+    /catalog/api/<resource>/         one page of rows as JSON, with a cursor link to the next page
+    /catalog/api/<resource>/export/  every matching row as NDJSON (one JSON object per line), streamed
+    /catalog/api/availability/       copy counts of up to MAX_ISBNS books by ISBN, in one POST
+
+Both resource endpoints accept the resource's filter parameters (see RESOURCES). Rows are built
+with values() rather than model instances, and the export reads the table with
+QuerySet.iterator() so its memory use does not depend on the size of the catalog.
+"""
+
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Min, Q
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from catalog.models import Author, Book, BookInstance, Genre, Language
+from catalog.pagination import CursorPaginator, InvalidCursor
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+EXPORT_CHUNK_SIZE = 2000
+MAX_ISBNS = 5000
+# ISBNs per isbn__in query, well below SQLite's limit on query parameters.
+ISBN_CHUNK_SIZE = 500
+
+# For each resource: the queryset, the columns returned, and the GET parameters accepted as
+# filters (parameter name -> lookup).
+RESOURCES = {
+    'books': {
+        'queryset': Book.objects.all(),
+        'fields': ('id', 'title', 'author_id', 'summary', 'isbn', 'language_id'),
+        'filters': {'author': 'author_id', 'genre': 'genre', 'language': 'language_id',
+                    'isbn': 'isbn', 'title': 'title__istartswith'},
+    },
+    'book-genres': {
+        'queryset': Book.genre.through.objects.all(),
+        'fields': ('id', 'book_id', 'genre_id'),
+        'filters': {'book': 'book_id', 'genre': 'genre_id'},
+    },
+    'authors': {
+        'queryset': Author.objects.all(),
+        'fields': ('id', 'first_name', 'last_name', 'date_of_birth', 'date_of_death'),
+        'filters': {'last_name': 'last_name__istartswith'},
+    },
+    'copies': {
+        'queryset': BookInstance.objects.all(),
+        'fields': ('id', 'book_id', 'imprint', 'status', 'due_back'),
+        'filters': {'book': 'book_id', 'status': 'status', 'due_before': 'due_back__lt',
+                    'due_after': 'due_back__gt'},
+    },
+    'genres': {
+        'queryset': Genre.objects.all(),
+        'fields': ('id', 'name'),
+        'filters': {},
+    },
+    'languages': {
+        'queryset': Language.objects.all(),
+        'fields': ('id', 'name'),
+        'filters': {},
+    },
+}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def get_rows(resource, params):
+    """Return the values() queryset of a resource filtered by the request parameters, ordered by id."""
+    try:
+        config = RESOURCES[resource]
+    except KeyError:
+        raise Http404(f'Unknown resource {resource!r}.')
+    queryset = config['queryset']
+    for name, lookup in config['filters'].items():
+        if name in params:
+            try:
+                queryset = queryset.filter(**{lookup: params[name]})
+            except (ValueError, ValidationError):
+                raise BadRequest(f'Invalid value for {name}.')
+    return queryset.values(*config['fields']).order_by('id')
+
+
+def error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+@require_GET
+def resource_list(request, resource):
+    """One page of rows: {"results": [...], "next": "<url of the next page>" or null}."""
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return error(f'limit must be a number from 1 to {MAX_LIMIT}.')
+    try:
+        rows = get_rows(resource, request.GET)
+        paginator = CursorPaginator(rows, limit, ('id',))
+        page = paginator.page(request.GET.get('cursor', ''))
+    except (BadRequest, InvalidCursor) as e:
+        return error(str(e))
+
+    next_url = None
+    if page.has_next():
+        query = request.GET.copy()
+        query['cursor'] = page.next_cursor
+        next_url = f'{request.path}?{query.urlencode()}'
+    return JsonResponse({'results': page.object_list, 'next': next_url})
+
+
+@require_GET
+def resource_export(request, resource):
+    """Every matching row as NDJSON, streamed in chunks of EXPORT_CHUNK_SIZE rows."""
+    try:
+        rows = get_rows(resource, request.GET)
+    except BadRequest as e:
+        return error(str(e))
+    # The rows are read after the view returns, outside the request's routing (see catalog.database):
+    # choose the database now.
+    rows = rows.using(rows.db)
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    lines = (encoder.encode(row) + '\n' for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{resource}.ndjson"'
+    return response
+
+
+def get_availability(isbns):
+    """Map each of the ISBNs found to its copy counts and the earliest due date of its loans.
+
+    The counts are the counters maintained on Book, and the due date is a MIN() over the
+    book's loans in the same grouped query, so each chunk of ISBN_CHUNK_SIZE ISBNs is one
+    query through the unique ISBN index, however many books and copies it matches.
+    """
+    availability = {}
+    for start in range(0, len(isbns), ISBN_CHUNK_SIZE):
+        rows = (Book.objects.filter(isbn__in=isbns[start:start + ISBN_CHUNK_SIZE])
+                .values('isbn', 'copies_total', 'copies_available', 'copies_on_loan')
+                .annotate(next_due_back=Min('bookinstance__due_back', filter=Q(bookinstance__status__exact='o')))
+                .order_by())
+        for row in rows:
+            availability[row['isbn']] = {
+                'total': row['copies_total'],
+                'available': row['copies_available'],
+                'on_loan': row['copies_on_loan'],
+                'next_due_back': row['next_due_back'],
+            }
+    return availability
+
+
+@csrf_exempt
+@require_POST
+def availability(request):
+    """Copy counts for many books by ISBN: {"results": {isbn: {...}}, "not_found": [isbn, ...]}.
+
+    The ISBNs are posted as a JSON body, {"isbns": [...]}, or as repeated isbn form fields
+    (at most DATA_UPLOAD_MAX_NUMBER_FIELDS of them). It only reads, so it needs no CSRF token.
+    """
+    if request.content_type == 'application/json':
+        try:
+            isbns = json.loads(request.body).get('isbns')
+        except (ValueError, AttributeError):
+            return error('The body must be a JSON object with a list of "isbns".')
+    else:
+        isbns = request.POST.getlist('isbn')
+    if not isinstance(isbns, list) or not all(isinstance(isbn, str) for isbn in isbns):
+        return error('isbns must be a list of strings.')
+    # Accept ISBNs written with hyphens or spaces; they are stored as bare digits.
+    isbns = list(dict.fromkeys(isbn.replace('-', '').replace(' ', '') for isbn in isbns))
+    if len(isbns) > MAX_ISBNS:
+        return error(f'At most {MAX_ISBNS} ISBNs can be looked up at once.')
+
+    results = get_availability(isbns)
+    return JsonResponse({'results': results, 'not_found': [isbn for isbn in isbns if isbn not in results]})
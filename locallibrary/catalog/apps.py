@@ -1,6 +1,24 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+
+
+def create_search_index(sender, using, **kwargs):
+    from catalog import search
+    search.create_index(using)
 
 
 class CatalogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'catalog'
+
+    def ready(self):
+        # Connect the signal handlers that maintain derived data (counters etc.).
+        from catalog import signals  # noqa: F401
+
+        # The app has no migrations of its own, so the FTS5 search table is created after migrate.
+        post_migrate.connect(create_search_index, sender=self)
+
+        # WAL journal and the other SQLite settings of catalog.database, on every new connection.
+        from catalog import database
+        connection_created.connect(database.tune_sqlite)
@@ -0,0 +1,207 @@
+"""Async versions of the catalog's read views, served under /catalog/async/.
+
+They render the same templates as the views in catalog.views, but load their data with the
+async ORM (aget, acount, async for), so under ASGI a request waiting on the database does not
+hold a worker thread of its own. Independent loads are started together with asyncio.gather.
+Note that Django runs async ORM calls one at a time on a single thread, so gathered queries
+do not overlap each other; what the request saves is its place in the sync_to_async pool.
+
+Everything a template touches is loaded before rendering, since a query started while an
+async view renders would raise SynchronousOnlyOperation. The page around the content (with
+the user's name and permissions, which load lazily) is rendered through sync_to_async.
+
+Each view is configured by an instance of its sync counterpart (see setup_view), so both
+stacks paginate the same way (page numbers or ?cursor=), answer conditional GETs with the same
+ETags, and read and fill the same cached fragments.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import InvalidPage, Page, Paginator
+from django.http import Http404
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.safestring import mark_safe
+
+from catalog import caching, stats, views, visits
+from catalog.database import primary_reads
+from catalog.models import LibraryStats
+from catalog.pagination import CursorPaginator, InvalidCursor, acached_count
+
+
+async def get_user(request):
+    """Load the lazy request.user (which queries the session and user tables) off the event loop."""
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+
+async def require_permission(request, perm=None):
+    """Return a redirect to the login page for anonymous users, or raise PermissionDenied without perm."""
+    user = await get_user(request)
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), settings.LOGIN_URL)
+    if perm and not await sync_to_async(user.has_perm)(perm):
+        raise PermissionDenied
+    return None
+
+
+async def aget_object_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'No {queryset.model._meta.verbose_name} found matching the query')
+
+
+def setup_view(view_class, request, **kwargs):
+    """An instance of the sync view class, set up for request but not run.
+
+    The async views take their configuration from it (querysets, pagination, cache versions,
+    fragment keys and ETags), so both stacks serve the same pages and share cached fragments.
+    """
+    view = view_class()
+    view.setup(request, **kwargs)
+    return view
+
+
+async def paginate(view, queryset):
+    """CursorPaginationMixin.paginate_queryset() of view, with the counts and rows loaded asynchronously."""
+    request = view.request
+    if view.cursor_kwarg in request.GET:
+        paginator = CursorPaginator(queryset, view.paginate_by, view.cursor_ordering,
+                                    count_timeout=view.cursor_count_timeout)
+        try:
+            page = await paginator.apage(request.GET[view.cursor_kwarg])
+        except InvalidCursor as e:
+            raise Http404(str(e))
+        if view.cursor_show_count:
+            # Loaded now: the template would otherwise count while rendering.
+            paginator.count = await acached_count(queryset, view.cursor_count_timeout)
+        page.next_query = view.cursor_query(page.next_cursor)
+        page.previous_query = view.cursor_query(page.previous_cursor)
+    else:
+        paginator = Paginator(queryset, view.paginate_by)
+        paginator.count = await queryset.acount()
+        try:
+            number = paginator.validate_number(request.GET.get(view.page_kwarg) or 1)
+        except InvalidPage as e:
+            raise Http404(str(e))
+        bottom = (number - 1) * view.paginate_by
+        page = Page([obj async for obj in queryset[bottom:bottom + view.paginate_by]], number, paginator)
+        page.next_query = view.page_query(page.next_page_number()) if page.has_next() else None
+        page.previous_query = view.page_query(page.previous_page_number()) if page.has_previous() else None
+    return {'paginator': paginator, 'page_obj': page, 'is_paginated': page.has_other_pages(),
+            'object_list': page.object_list, 'view': view}
+
+
+async def render_page(request, template_name, context):
+    return await sync_to_async(render)(request, template_name, context)
+
+
+async def cached_fragment_page(view, get_context):
+    """CachedFragmentMixin.get() for async views: render view's fragment_template_name with the
+    context from get_context() (a coroutine function) inside its template_name, answering
+    conditional GETs and caching the fragment under the same key and ETag as the sync view.
+    """
+    request = view.request
+    versions = await caching.aget_versions(*view.get_version_names())
+    # In a thread: a view may query the database for its key (see views.BookListView).
+    fragment_key = await sync_to_async(view.get_fragment_key)(versions)
+    await get_user(request)
+    etag = await sync_to_async(view.get_etag)(fragment_key)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        fragment = await cache.aget(fragment_key)
+        if fragment is None:
+            # Loaded from the primary, as the fragment is cached for everyone (see catalog.database).
+            with primary_reads():
+                context = await get_context()
+            fragment = render_to_string(view.fragment_template_name, {**context, 'view': view}, request)
+            await cache.aset(fragment_key, fragment, getattr(settings, 'CATALOG_FRAGMENT_TIMEOUT', 3600))
+        response = await render_page(request, view.template_name, {'fragment': mark_safe(fragment), 'view': view})
+    return caching.patch_fragment_response(response, etag)
+
+
+async def get_stats():
+    """stats.get_stats() for async views: the cached counters, or the stats row."""
+    counts = await cache.aget(stats.CACHE_KEY)
+    if counts is None:
+        with primary_reads():
+            counts = await LibraryStats.objects.filter(pk=stats.STATS_PK).values(*stats.COUNTER_FIELDS).afirst()
+            if counts is None:
+                counts = (await sync_to_async(stats.rebuild)())[0]
+        await cache.aset(stats.CACHE_KEY, counts, stats.CACHE_TIMEOUT)
+    return counts
+
+
+async def index(request):
+    """Async home page: the counters and the visit count are loaded together."""
+    counts, num_visits = await asyncio.gather(get_stats(), sync_to_async(visits.count_visit)(request))
+    response = await render_page(request, 'index.html', {**counts, 'num_visits': num_visits})
+    return visits.set_visitor_cookie(request, response)
+
+
+async def book_list(request):
+    view = setup_view(views.BookListView, request)
+
+    async def get_context():
+        context = await paginate(view, view.get_queryset())
+        return {**context, 'book_list': context['object_list']}
+
+    return await cached_fragment_page(view, get_context)
+
+
+async def book_detail(request, pk):
+    view = setup_view(views.BookDetailView, request, pk=pk)
+
+    async def get_context():
+        book = await aget_object_or_404(view.get_queryset(), pk=pk)
+        return {'book': book, 'object': book}
+
+    return await cached_fragment_page(view, get_context)
+
+
+async def author_list(request):
+    view = setup_view(views.AuthorListView, request)
+
+    async def get_context():
+        context = await paginate(view, view.get_queryset())
+        return {**context, 'author_list': context['object_list']}
+
+    return await cached_fragment_page(view, get_context)
+
+
+async def author_detail(request, pk):
+    view = setup_view(views.AuthorDetailView, request, pk=pk)
+
+    async def get_context():
+        author = await aget_object_or_404(view.get_queryset(), pk=pk)
+        return {'author': author, 'object': author}
+
+    return await cached_fragment_page(view, get_context)
+
+
+async def loaned_books_by_user(request):
+    redirect = await require_permission(request)
+    if redirect:
+        return redirect
+    view = setup_view(views.LoanedBooksByUserListView, request)
+    context = await paginate(view, view.get_queryset())
+    context['bookinstance_list'] = context['object_list']
+    return await render_page(request, view.template_name, context)
+
+
+async def all_loaned_books(request):
+    redirect = await require_permission(request, 'catalog.can_mark_returned')
+    if redirect:
+        return redirect
+    view = setup_view(views.AllLoanedBooksListView, request)
+    context = await paginate(view, view.get_queryset())
+    context['bookinstance_list'] = context['object_list']
+    return await render_page(request, view.template_name, context)
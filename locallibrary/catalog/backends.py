@@ -0,0 +1,46 @@
+"""Authentication backend that keeps users' resolved permissions in the cache.
+
+ModelBackend resolves a user's permissions (their own and their groups') with joins over the
+user, group and permission tables, and keeps the result only on that user object, so every
+request pays for it again. CachedPermissionBackend keeps the resolved set in the shared cache
+under version keys (see catalog.caching): 'permissions:user:<pk>' is bumped by the signal
+handlers in catalog.signals when the user, their permissions or their groups change, and
+'permissions' when any group or permission changes. Warm permission checks run no queries.
+
+Enable it in place of ModelBackend:
+
+    AUTHENTICATION_BACKENDS = ['catalog.backends.CachedPermissionBackend']
+
+    CATALOG_PERMISSION_CACHE_TIMEOUT  -- seconds to keep a permission set (default 3600)
+"""
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+from catalog import caching
+
+PERMISSIONS_PREFIX = 'catalog:permissions:'
+PERMISSIONS_VERSION = 'permissions'
+
+
+def user_version(user_id):
+    """Name of the version of one user's permission set."""
+    return f'permissions:user:{user_id}'
+
+
+class CachedPermissionBackend(ModelBackend):
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            versions = caching.get_versions(PERMISSIONS_VERSION, user_version(user_obj.pk))
+            key = f'{PERMISSIONS_PREFIX}{user_obj.pk}:{versions[PERMISSIONS_VERSION]}:' \
+                  f'{versions[user_version(user_obj.pk)]}'
+            perms = cache.get(key)
+            if perms is None:
+                perms = super().get_all_permissions(user_obj)
+                cache.set(key, perms, getattr(settings, 'CATALOG_PERMISSION_CACHE_TIMEOUT', 3600))
+            user_obj._perm_cache = perms
+        return user_obj._perm_cache
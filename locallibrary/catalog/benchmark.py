@@ -0,0 +1,351 @@
+"""URL-level benchmarks of the catalog (see the benchmark_routes and benchmark_asgi commands).
+
+Every route in catalog.urls is requested through the Django test client, logged in as the
+generated librarian so that the staff pages render too. run_routes() records the latency
+percentiles, the number of SQL queries per request and the throughput of one client for each
+route. run_concurrent() sends many requests at once, from a pool of threads through the WSGI
+handler or from asyncio tasks through the ASGI handler, to compare the two under load.
+race_checkouts() has threads check out the same copies at once, to check that catalog.loans
+lends each copy once, and measures checkouts per second under contention.
+
+ROUTES says how to build each route's request from the sample objects of a generated catalog;
+uncovered_routes() lists routes added to catalog.urls but not to ROUTES.
+"""
+
+import asyncio
+import os
+import threading
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+from django.urls import reverse
+
+from catalog import loans, stats, urls, visits
+from catalog.generator import LIBRARIAN
+from catalog.models import Author, Book, BookInstance, LoanEvent, User
+
+# Route name -> (method, function of the sample returning (url args, GET or POST data)).
+# POST sends form data, JSON a POST with the data as its JSON body.
+ROUTES = {
+    'index': ('GET', lambda sample: ([], None)),
+    'books': ('GET', lambda sample: ([], None)),
+    'book-search': ('GET', lambda sample: ([], {'q': sample['word']})),
+    'book-browse': ('GET', lambda sample: ([], {'genre': sample['genre']})),
+    'book-detail': ('GET', lambda sample: ([sample['book']], None)),
+    'authors': ('GET', lambda sample: ([], None)),
+    'author-detail': ('GET', lambda sample: ([sample['author']], None)),
+    'my-borrowed': ('GET', lambda sample: ([], None)),
+    'all-borrowed': ('GET', lambda sample: ([], None)),
+    'renew-book-librarian': ('GET', lambda sample: ([sample['loan']], None)),
+    'bulk-update-loans': ('POST', lambda sample: ([], {'action': 'renew', 'renewal_date': sample['renewal_date'],
+                                                        'book_instances': sample['loans']})),
+    'circulation-report': ('GET', lambda sample: ([], {'by': 'genre', 'days': 30})),
+    'author-create': ('GET', lambda sample: ([], None)),
+    'author-update': ('GET', lambda sample: ([sample['author']], None)),
+    'author-delete': ('GET', lambda sample: ([sample['author']], None)),
+    'book-create': ('GET', lambda sample: ([], None)),
+    'book-update': ('GET', lambda sample: ([sample['book']], None)),
+    'book-delete': ('GET', lambda sample: ([sample['book']], None)),
+    'api-list': ('GET', lambda sample: (['copies'], None)),
+    'api-export': ('GET', lambda sample: (['books'], None)),
+    'api-availability': ('JSON', lambda sample: ([], {'isbns': sample['isbns']})),
+    'async-index': ('GET', lambda sample: ([], None)),
+    'async-books': ('GET', lambda sample: ([], None)),
+    'async-book-detail': ('GET', lambda sample: ([sample['book']], None)),
+    'async-authors': ('GET', lambda sample: ([], None)),
+    'async-author-detail': ('GET', lambda sample: ([sample['author']], None)),
+    'async-my-borrowed': ('GET', lambda sample: ([], None)),
+    'async-all-borrowed': ('GET', lambda sample: ([], None)),
+}
+
+# Sync route name -> its async version in catalog.async_views.
+ASYNC_ROUTES = {
+    'index': 'async-index',
+    'books': 'async-books',
+    'book-detail': 'async-book-detail',
+    'authors': 'async-authors',
+    'author-detail': 'async-author-detail',
+    'my-borrowed': 'async-my-borrowed',
+    'all-borrowed': 'async-all-borrowed',
+}
+
+
+def uncovered_routes():
+    """Names of the routes in catalog.urls that ROUTES does not cover."""
+    return [pattern.name for pattern in urls.urlpatterns if pattern.name not in ROUTES]
+
+
+@contextmanager
+def test_database(on_disk=False):
+    """Create an empty test database to generate a catalog into, and destroy it afterwards.
+
+    SQLite test databases are normally in memory, where connections from several threads
+    block each other instead of waiting; on_disk puts it in a temporary file instead.
+    """
+    test_settings = connection.settings_dict['TEST']
+    old_name = test_settings.get('NAME')
+    directory = None
+    if on_disk and connection.vendor == 'sqlite':
+        directory = tempfile.mkdtemp()
+        test_settings['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+    old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+    try:
+        cache.clear()
+        yield
+        # Write the buffered home page visits while the test database still exists.
+        visits.buffer.flush()
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        test_settings['NAME'] = old_name
+        if directory:
+            shutil.rmtree(directory)
+
+
+def get_sample(renewal_date):
+    """Objects from the middle of the catalog to request, so the benchmark does not only hit the first rows."""
+    book = Book.objects.order_by('pk')[Book.objects.count() // 2]
+    loans = list(BookInstance.objects.filter(status__exact='o').order_by('pk').values_list('pk', flat=True)[:10])
+    # A partner's availability batch: a thousand ISBNs spread over the catalog, and one unknown ISBN.
+    isbns = list(Book.objects.order_by('isbn').values_list('isbn', flat=True))
+    return {
+        'book': book.pk,
+        'author': book.author_id or Author.objects.values_list('pk', flat=True).first(),
+        'word': book.title.split()[0],
+        'genre': book.genre.values_list('pk', flat=True).first() or '',
+        'loan': loans[0],
+        'loans': [str(pk) for pk in loans],
+        'isbns': isbns[::max(1, len(isbns) // 1000)][:1000] + ['0000000000000'],
+        'renewal_date': renewal_date.isoformat(),
+    }
+
+
+def percentile(values, p):
+    """The p-th percentile of values (interpolating between the nearest ranks)."""
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+def summarise(durations):
+    return {
+        'p50_ms': round(percentile(durations, 50) * 1000, 2),
+        'p95_ms': round(percentile(durations, 95) * 1000, 2),
+        'p99_ms': round(percentile(durations, 99) * 1000, 2),
+        'mean_ms': round(statistics.mean(durations) * 1000, 2),
+    }
+
+
+def measure(client, method, url, data, requests, cold=False):
+    """Send the request requests times (after one untimed warm-up) and summarise the timings."""
+    durations = []
+    queries = []
+    status = None
+    for n in range(requests + 1):
+        if cold:
+            cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            if method == 'JSON':
+                response = client.post(url, data, content_type='application/json')
+            elif method == 'POST':
+                response = client.post(url, data)
+            else:
+                response = client.get(url, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            duration = time.perf_counter() - start
+        status = response.status_code
+        if n:
+            durations.append(duration)
+            queries.append(len(captured))
+    return {
+        'status': status,
+        'requests': requests,
+        **summarise(durations),
+        'queries': statistics.median_low(queries),
+        'throughput_rps': round(requests / sum(durations), 1),
+    }
+
+
+def run_routes(sample, requests=20, cold=False, routes=None):
+    """Benchmark each route (all of ROUTES by default). Returns a list of result dicts."""
+    client = librarian_client()
+    results = []
+    for name in routes or ROUTES:
+        method, build = ROUTES[name]
+        args, data = build(sample)
+        url = reverse(name, args=args)
+        results.append({'route': name, 'method': method, 'url': url,
+                        **measure(client, method, url, data, requests, cold)})
+    return results
+
+
+def librarian_client(client_class=Client):
+    client = client_class()
+    client.force_login(User.objects.get(username=LIBRARIAN))
+    return client
+
+
+def run_concurrent(url, handler='wsgi', concurrency=8, requests=200, cookies=None):
+    """Send requests GET requests for url, concurrency at a time, and summarise latency and throughput.
+
+    handler 'wsgi' sends them from a pool of concurrency threads, each with its own test client,
+    as a threaded WSGI server would; 'asgi' sends them from asyncio tasks through AsyncClient,
+    as an ASGI server would. Both use the session in cookies.
+    """
+    statuses = set()
+
+    if handler == 'wsgi':
+        def send(client):
+            start = time.perf_counter()
+            statuses.add(client.get(url).status_code)
+            return time.perf_counter() - start
+
+        def worker(count):
+            client = Client()
+            client.cookies.update(cookies or {})
+            try:
+                return [send(client) for _ in range(count)]
+            finally:
+                connection.close()
+
+        counts = [requests // concurrency + (n < requests % concurrency) for n in range(concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            durations = [duration for chunk in pool.map(worker, counts) for duration in chunk]
+        elapsed = time.perf_counter() - started
+    elif handler == 'asgi':
+        async def main():
+            client = AsyncClient()
+            client.cookies.update(cookies or {})
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def send():
+                async with semaphore:
+                    start = time.perf_counter()
+                    statuses.add((await client.get(url)).status_code)
+                    return time.perf_counter() - start
+
+            return await asyncio.gather(*[send() for _ in range(requests)])
+
+        started = time.perf_counter()
+        durations = asyncio.run(main())
+        elapsed = time.perf_counter() - started
+    else:
+        raise ValueError(f'Unknown handler {handler!r}.')
+    return {
+        'handler': handler,
+        'url': url,
+        'concurrency': concurrency,
+        'requests': requests,
+        'statuses': sorted(statuses),
+        **summarise(durations),
+        'throughput_rps': round(requests / elapsed, 1),
+    }
+
+
+def run_threads(count, target):
+    """Run target(n) for n in range(count), each in its own thread, released together.
+
+    Returns the exceptions raised (as strings) and the seconds taken.
+    """
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def run(n):
+        try:
+            barrier.wait()
+            target(n)
+        except Exception as e:
+            errors.append(f'{type(e).__name__}: {e}')
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors, time.perf_counter() - started
+
+
+def race_checkouts(threads=8, copies=5, rounds=10):
+    """Race threads against each other through catalog.loans and report what each race left behind.
+
+    The database must allow concurrent connections (an SQLite test database must be on disk).
+    1. Every thread checks out the same copy: one must win, the rest get a LoanConflict.
+    2. Every thread checks out any copy of a book with copies copies: each copy is lent once.
+    3. Every thread checks out and returns a copy of its own rounds times, for checkouts per second.
+    """
+    book = Book.objects.create(title='Race', summary='Concurrent checkouts.', isbn='0000000000001')
+    pks = [BookInstance.objects.create(book=book, imprint='Race', status='a').pk for n in range(copies)]
+    users = [User.objects.create(username=f'racer{n}') for n in range(threads)]
+    results = {'threads': threads, 'copies': copies, 'rounds': rounds}
+
+    winners = []
+
+    def same_copy(n):
+        try:
+            loans.checkout(pks[0], users[n])
+            winners.append(users[n].pk)
+        except loans.LoanConflict:
+            pass
+
+    errors, _ = run_threads(threads, same_copy)
+    results['same_copy'] = {
+        'errors': errors,
+        'winners': winners,
+        'borrower': BookInstance.objects.get(pk=pks[0]).borrower_id,
+    }
+    loans.return_copy(pks[0])
+
+    taken = []
+
+    def any_copy(n):
+        for attempt in range(5):
+            try:
+                taken.append(str(loans.checkout_book(book, users[n])))
+                return
+            except loans.LoanConflict:
+                pass
+            except BookInstance.DoesNotExist:
+                return
+
+    errors, _ = run_threads(threads, any_copy)
+    counted = Book.objects.get(pk=book.pk)
+    results['any_copy'] = {
+        'errors': errors,
+        'taken': taken,
+        'on_loan': BookInstance.objects.filter(book=book, status__exact='o').count(),
+        'counters': [counted.copies_total, counted.copies_available, counted.copies_on_loan],
+        'stats_drift': stats.rebuild()[1],
+    }
+    loans.return_loans(BookInstance.objects.filter(book=book).values_list('pk', flat=True))
+
+    # One copy per thread, so the threads only contend for the database.
+    pks += [BookInstance.objects.create(book=book, imprint='Race', status='a').pk
+            for n in range(threads - copies)]
+    loans_before = LoanEvent.objects.filter(kind=LoanEvent.LOAN).count()
+
+    def checkout_and_return(n):
+        for _ in range(rounds):
+            loans.checkout(pks[n], users[n])
+            loans.return_copy(pks[n], users[n])
+
+    errors, seconds = run_threads(threads, checkout_and_return)
+    results['throughput'] = {
+        'errors': errors,
+        'loan_events': LoanEvent.objects.filter(kind=LoanEvent.LOAN).count() - loans_before,
+        'seconds': round(seconds, 3),
+        'checkouts_per_second': round(threads * rounds / seconds, 1),
+    }
+    return results
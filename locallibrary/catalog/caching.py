@@ -0,0 +1,135 @@
+"""Rendered-fragment caching with version keys, and conditional GET for the catalog pages.
+
+Every cacheable piece of data has a version: a timestamp stored in the cache under
+'catalog:version:<name>', where <name> is for example 'book:12', 'author:3', 'books' (the
+book list), 'availability' (the copies of any book, bumped by circulation), 'authors' (the
+author list), 'taxonomy' (genre and language names), 'book-genres' (which books are in which
+genres) or 'catalog' (everything, bumped after bulk imports). The signal handlers in catalog.signals bump the versions that a change affects,
+once the transaction commits.
+
+CachedFragmentMixin renders a view's main content to a fragment and caches it under a key
+built from the versions it depends on, so changing the data simply makes the old fragment
+unreachable. The page around the fragment (the base template, with its per-user sidebar)
+is rendered for every request. The versions also give each page an ETag, so an unchanged
+page can be answered with 304 Not Modified without rendering at all. There is no
+Last-Modified date: it has one-second resolution, so a page changed twice in the same second
+would be wrongly answered with 304 to a client that only sent If-Modified-Since.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.safestring import mark_safe
+
+from catalog.database import primary_reads
+from catalog.models import Book
+
+VERSION_PREFIX = 'catalog:version:'
+FRAGMENT_PREFIX = 'catalog:fragment:'
+
+
+def get_versions(*names):
+    """Return the current version of each name, starting a version for names that have none."""
+    keys = {name: VERSION_PREFIX + name for name in names}
+    found = cache.get_many(keys.values())
+    now = time.time()
+    missing = {key: now for key in keys.values() if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+    return {name: found.get(key, now) for name, key in keys.items()}
+
+
+async def aget_versions(*names):
+    """get_versions() for async views."""
+    keys = {name: VERSION_PREFIX + name for name in names}
+    found = await cache.aget_many(keys.values())
+    now = time.time()
+    missing = {key: now for key in keys.values() if key not in found}
+    if missing:
+        await cache.aset_many(missing, timeout=None)
+    return {name: found.get(key, now) for name, key in keys.items()}
+
+
+def fragment_key(name, kwargs, query, versions):
+    """Cache key of a fragment rendered by the view name for the URL kwargs, GET query and versions."""
+    # The kwargs as strings, so the same page has the same key whether its route converts pk to an int or not.
+    kwargs = sorted((key, str(value)) for key, value in kwargs.items())
+    parts = [name, repr(kwargs), repr(sorted(query.lists())), repr(sorted(versions.items()))]
+    return FRAGMENT_PREFIX + hashlib.md5('|'.join(parts).encode(), usedforsecurity=False).hexdigest()
+
+
+def bump(*names):
+    """Give the names new versions once the current transaction commits (immediately outside one)."""
+    if not names:
+        return
+    keys = [VERSION_PREFIX + name for name in names]
+    transaction.on_commit(lambda: cache.set_many(dict.fromkeys(keys, time.time()), timeout=None))
+
+
+def bump_books(book_ids):
+    """Bump the pages showing the given books' copies: the book pages and their authors' pages."""
+    book_ids = {pk for pk in book_ids if pk is not None}
+    if not book_ids:
+        return
+    author_ids = set(Book.objects.filter(pk__in=book_ids, author__isnull=False)
+                     .values_list('author_id', flat=True).distinct())
+    bump(*[f'book:{pk}' for pk in book_ids], *[f'author:{pk}' for pk in author_ids])
+
+
+def patch_fragment_response(response, etag):
+    """Add the ETag, and the headers that make browsers revalidate a page that differs per user."""
+    response['ETag'] = etag
+    patch_vary_headers(response, ['Cookie'])
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+class CachedFragmentMixin:
+    """Cache the rendered main content of a generic view and answer conditional GETs.
+
+    The view's template_name (which must be set explicitly) receives the content as
+    ``fragment``; fragment_template_name is the template that renders it from the normal view
+    context. It must not contain anything specific to the user, which belongs in the page
+    template. Subclasses list the versions the content depends on in get_version_names().
+    The async views in catalog.async_views use the same keys and ETags.
+    """
+    fragment_template_name = None
+
+    def get_version_names(self):
+        return ['catalog']
+
+    def get_fragment_key(self, versions):
+        return fragment_key(type(self).__name__, self.kwargs, self.request.GET, versions)
+
+    def get_etag(self, fragment_key):
+        # The page also shows the user's name and staff links, so it differs per user.
+        user = self.request.user
+        user_part = f'{user.pk}:{user.has_perm("catalog.can_mark_returned")}' if user.is_authenticated else 'anonymous'
+        return '"%s"' % hashlib.md5(f'{fragment_key}|{user_part}'.encode(), usedforsecurity=False).hexdigest()
+
+    def get(self, request, *args, **kwargs):
+        versions = get_versions(*self.get_version_names())
+        fragment_key = self.get_fragment_key(versions)
+        etag = self.get_etag(fragment_key)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            fragment = cache.get(fragment_key)
+            if fragment is None:
+                # Run the normal view (object lookup, pagination ...) and render its content once, from the
+                # primary, as the fragment is cached for everyone under the current versions.
+                with primary_reads():
+                    response = super().get(request, *args, **kwargs)
+                    fragment = render_to_string(self.fragment_template_name, response.context_data, request)
+                cache.set(fragment_key, fragment, getattr(settings, 'CATALOG_FRAGMENT_TIMEOUT', 3600))
+                response.context_data['fragment'] = fragment
+            else:
+                response = TemplateResponse(request, self.template_name,
+                                            {'fragment': mark_safe(fragment), 'view': self})
+        return patch_fragment_response(response, etag)
@@ -0,0 +1,149 @@
+"""The loan event log, and the daily circulation rollups built from it.
+
+Every change of a copy's status is appended to LoanEvent, along with renewals and copies
+created on loan or reserved. Changes made with save() are logged by the BookInstance
+post_save handler in catalog.signals. catalog.loans, the importer and the generator log the
+changes they make with QuerySet.update() and bulk_create(), which send no signals; the copies
+the importer and generator create already on loan or reserved are logged as 'status' events,
+so they do not count as loans. sweep_overdue() logs an 'overdue' event the first time it finds
+a loan overdue on a given day.
+
+rollup() adds the events after its watermark to BookCirculation, GenreCirculation and
+LanguageCirculation: the number of loans, returns and overdue loans of each book, genre and
+language per day (see the rollup_circulation command). Each batch of events is added and the
+watermark moved past it in one transaction, so every event is counted exactly once however
+often the rollup runs. A book counts towards the genres and language it has when its events
+are rolled up. The watermark is an event id, which relies on events being committed in id
+order; SQLite commits one writer at a time, so they are.
+
+report() reads the rollups for the librarians' circulation page.
+"""
+
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Sum
+
+from catalog.models import (Book, BookCirculation, GenreCirculation, LanguageCirculation, LoanEvent,
+                            RollupWatermark)
+
+WATERMARK = 'circulation'
+# Event kind -> the rollup column it is counted in.
+COUNTED = {LoanEvent.LOAN: 'loans', LoanEvent.RETURN: 'returns', LoanEvent.OVERDUE: 'overdues'}
+COUNT_FIELDS = ('loans', 'returns', 'overdues')
+# Report dimension -> (rollup model, key field, field with the key's name).
+ROLLUPS = {
+    'genre': (GenreCirculation, 'genre', 'genre__name'),
+    'language': (LanguageCirculation, 'language', 'language__name'),
+    'book': (BookCirculation, 'book', 'book__title'),
+}
+
+
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+def event_kind(old_status, new_status):
+    """The kind of event of a copy going from old_status to new_status (a renewal if both are 'o')."""
+    if new_status == 'o':
+        return LoanEvent.RENEW if old_status == 'o' else LoanEvent.LOAN
+    if old_status == 'o':
+        return LoanEvent.RETURN
+    if new_status == 'r':
+        return LoanEvent.RESERVE
+    return LoanEvent.STATUS
+
+
+def make_event(book_instance_id, book_id, old_status, new_status, borrower=None, due_back=None, kind=None,
+               **kwargs):
+    """The LoanEvent of a copy going from old_status to new_status, of kind or the one event_kind() gives."""
+    kind = kind or event_kind(old_status, new_status)
+    return LoanEvent(kind=kind, book_instance_id=book_instance_id, book_id=book_id, borrower_id=_pk(borrower),
+                     old_status=old_status or '', new_status=new_status, due_back=due_back, **kwargs)
+
+
+def creation_events(copies):
+    """Events for the copies (BookInstances) bulk-created on loan or reserved by the importer and generator.
+
+    They are 'status' events, which are not counted: a copy imported or generated already on
+    loan was lent before it was recorded, and is not a loan made on the day it was created.
+    """
+    return [make_event(copy.pk, copy.book_id, '', copy.status, copy.borrower_id, copy.due_back,
+                       kind=LoanEvent.STATUS)
+            for copy in copies if copy.status in ('o', 'r')]
+
+
+def record(events):
+    LoanEvent.objects.bulk_create(events)
+
+
+def _add_counts(model, key_field, counts):
+    """Add counts ({(day, key): Counter of COUNT_FIELDS}) to the rows of model, creating the missing rows."""
+    if not counts:
+        return
+    rows = model.objects.filter(day__in={day for day, key in counts},
+                                **{f'{key_field}__in': {key for day, key in counts}})
+    existing = {(row.day, getattr(row, key_field)): row for row in rows}
+    changed, created = [], []
+    for (day, key), fields in counts.items():
+        row = existing.get((day, key))
+        if row is None:
+            created.append(model(day=day, **{key_field: key}, **fields))
+        else:
+            for field, count in fields.items():
+                setattr(row, field, getattr(row, field) + count)
+            changed.append(row)
+    model.objects.bulk_create(created)
+    model.objects.bulk_update(changed, COUNT_FIELDS)
+
+
+def rollup(batch_size=5000):
+    """Add the events after the watermark to the daily rollups. Returns the number of events processed."""
+    processed = 0
+    while True:
+        with transaction.atomic():
+            watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+            events = list(LoanEvent.objects.filter(pk__gt=watermark.last_event_id).order_by('pk')
+                          .values_list('pk', 'day', 'kind', 'book_id')[:batch_size])
+            if not events:
+                return processed
+
+            by_book = defaultdict(Counter)
+            for pk, day, kind, book_id in events:
+                if kind in COUNTED and book_id is not None:
+                    by_book[day, book_id][COUNTED[kind]] += 1
+            book_ids = {book_id for day, book_id in by_book}
+            languages = dict(Book.objects.filter(pk__in=book_ids, language__isnull=False)
+                             .values_list('pk', 'language_id'))
+            genres = defaultdict(list)
+            for book_id, genre_id in (Book.genre.through.objects.filter(book_id__in=book_ids)
+                                      .values_list('book_id', 'genre_id')):
+                genres[book_id].append(genre_id)
+
+            by_genre, by_language = defaultdict(Counter), defaultdict(Counter)
+            for (day, book_id), counts in by_book.items():
+                for genre_id in genres[book_id]:
+                    by_genre[day, genre_id].update(counts)
+                if book_id in languages:
+                    by_language[day, languages[book_id]].update(counts)
+            _add_counts(BookCirculation, 'book_id', by_book)
+            _add_counts(GenreCirculation, 'genre_id', by_genre)
+            _add_counts(LanguageCirculation, 'language_id', by_language)
+
+            watermark.last_event_id = events[-1][0]
+            watermark.save()
+            processed += len(events)
+        if len(events) < batch_size:
+            return processed
+
+
+def report(by, since, until, limit=50):
+    """Loans, returns and overdues per genre, language or book (by) between the days since and until.
+
+    Each row has the key's id and name and the sums total_loans, total_returns and total_overdues.
+    """
+    model, key, name = ROLLUPS[by]
+    rows = (model.objects.filter(day__range=(since, until)).values(f'{key}_id', name)
+            .annotate(**{f'total_{field}': Sum(field) for field in COUNT_FIELDS})
+            .order_by('-total_loans', name)[:limit])
+    return [{'id': row.pop(f'{key}_id'), 'name': row.pop(name), **row} for row in rows]
@@ -0,0 +1,125 @@
+"""Routing reads to a replica database, and tuning SQLite connections.
+
+ReadReplicaRouter sends the catalog's reads in GET and HEAD requests to the database alias
+named by CATALOG_READ_DATABASE, and everything else to the primary ('default'). That includes
+writes, reads of sessions, users and permissions (a user who has just logged in must not look
+anonymous), reads made outside a request (management commands ...), reads inside a
+transaction and reads of a request that has already written, so a request always reads back
+its own writes. ReplicaRoutingMiddleware (in catalog.middleware) opens the request scope.
+After a write it also keeps the user's next requests, such as the page a form redirects to,
+on the primary for CATALOG_PRIMARY_STICKY_SECONDS, so they do not miss the write while the
+replica catches up.
+
+    DATABASES['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'replica.sqlite3',
+                            'TEST': {'MIRROR': 'default'}}
+    DATABASE_ROUTERS = ['catalog.database.ReadReplicaRouter']
+    MIDDLEWARE = [..., 'catalog.middleware.ReplicaRoutingMiddleware', ...]
+    CATALOG_READ_DATABASE = 'replica'
+    CATALOG_PRIMARY_STICKY_SECONDS  -- read from the primary this long after a write (default 5)
+
+Locally the replica is a second SQLite file, copied from the primary by the sync_read_replica
+command. The shared caches (the fragments of catalog.caching, the home page counters and the
+facet counts) are keyed by data versions, not by database, so what fills them is read from the
+primary inside primary_reads(): a stale replica read cached under the current versions would
+be served to everyone, including the user who has just written, until the next change.
+
+tune_sqlite() is connected to connection_created in CatalogConfig.ready(). It runs the
+PRAGMAs in CATALOG_SQLITE_PRAGMAS on each new connection to an SQLite file. The defaults are:
+- the write-ahead log, so reads no longer wait for the writer's lock;
+- synchronous=NORMAL, which is safe with WAL and only syncs at checkpoints;
+- a 256 MB memory map.
+Set CONN_MAX_AGE (and CONN_HEALTH_CHECKS) on the database so that connections persist between
+requests, rather than being opened and set up again for each request.
+"""
+
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+_request_state = contextvars.ContextVar('catalog_database_request', default=None)
+
+
+class RequestState:
+    """Where the current request may read from; wrote is set once it writes."""
+
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+@contextmanager
+def request_scope(use_replica):
+    """Route the database access of one request (see ReplicaRoutingMiddleware)."""
+    state = RequestState(use_replica)
+    token = _request_state.set(state)
+    try:
+        yield state
+    finally:
+        _request_state.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Send the current request's reads to the primary inside the block, e.g. to fill a shared cache."""
+    state = _request_state.get()
+    use_replica = state is not None and state.use_replica
+    if use_replica:
+        state.use_replica = False
+    try:
+        yield
+    finally:
+        if use_replica:
+            state.use_replica = True
+
+
+def read_database():
+    return getattr(settings, 'CATALOG_READ_DATABASE', None)
+
+
+class ReadReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        alias = read_database()
+        if model._meta.app_label != 'catalog' or model._meta.label == settings.AUTH_USER_MODEL:
+            return DEFAULT_DB_ALIAS
+        if (alias and state is not None and state.use_replica and not state.wrote
+                and not connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Django asks just before writing, so from here on the request reads its own writes.
+        state = _request_state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, read_database()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica is a copy of the primary and is never migrated itself.
+        if db == read_database():
+            return False
+        return None
+
+
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+        return
+    pragmas = getattr(settings, 'CATALOG_SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS) or {}
+    # On the raw connection, so that the PRAGMAs are not counted as the request's queries.
+    for name, value in pragmas.items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
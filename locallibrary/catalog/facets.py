@@ -0,0 +1,104 @@
+"""Faceted browsing of the books by genre, language and author (see views.BookBrowseView).
+
+The filters come from the query string (?genre=1&genre=4&language=2&author=7&available=1).
+Values of one facet are alternatives (a book in any of the chosen genres), different facets
+must all match. The count shown next to each option is the number of books it would give
+combined with the filters of the other facets, so options of the same facet can be added
+without emptying the list.
+
+get_facets() computes the total and the counts of all three facets in four grouped queries,
+whatever the number of options. The result is cached under the versions of the data it
+depends on (see catalog.caching) for filter sets with at most CATALOG_FACET_CACHE_MAX_FILTERS
+values (default 2): the unfiltered page and the common one- and two-option combinations.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, IntegerField, Value, When
+
+from catalog import caching
+from catalog.database import primary_reads
+from catalog.models import Book
+
+FACETS_PREFIX = 'catalog:facets:'
+FACET_NAMES = ('genre', 'language', 'author')
+# Versions of the data the counts depend on. 'book-genres' is bumped when books' genres change,
+# 'availability' (only needed with ?available=1) when copies are lent or returned.
+VERSION_NAMES = ['catalog', 'books', 'authors', 'taxonomy', 'book-genres']
+# Authors shown in the author facet (the ones with most books, after any chosen ones).
+AUTHOR_LIMIT = 20
+
+
+def parse_filters(query):
+    """The filters in a GET query: {'genre': [ids], 'language': [ids], 'author': [ids], 'available': bool}.
+
+    Values that are not ids are ignored.
+    """
+    filters = {name: sorted({int(value) for value in query.getlist(name) if value.isdigit()})
+               for name in FACET_NAMES}
+    filters['available'] = bool(query.get('available'))
+    return filters
+
+
+def filter_books(filters, exclude=None):
+    """Books matching the filters, leaving out the facet exclude."""
+    books = Book.objects.all()
+    if filters['genre'] and exclude != 'genre':
+        # A subquery rather than a join, so a book in two chosen genres is not counted twice.
+        books = books.filter(pk__in=Book.genre.through.objects.filter(genre_id__in=filters['genre'])
+                             .values('book_id'))
+    if filters['language'] and exclude != 'language':
+        books = books.filter(language_id__in=filters['language'])
+    if filters['author'] and exclude != 'author':
+        books = books.filter(author_id__in=filters['author'])
+    if filters['available']:
+        books = books.filter(copies_available__gt=0)
+    return books
+
+
+def count_facets(filters):
+    """Compute the total and the facet counts of the filters (four queries)."""
+    genre_rows = (Book.genre.through.objects
+                  .filter(book_id__in=filter_books(filters, exclude='genre').values('pk'))
+                  .values('genre_id', 'genre__name').annotate(count=Count('book_id')).order_by('genre__name'))
+    language_rows = (filter_books(filters, exclude='language').filter(language__isnull=False)
+                     .values('language_id', 'language__name').annotate(count=Count('pk'))
+                     .order_by('language__name'))
+    # The chosen authors first, so they stay listed however few books they have.
+    chosen_first = Case(When(author_id__in=filters['author'], then=Value(0)), default=Value(1),
+                        output_field=IntegerField())
+    author_rows = (filter_books(filters, exclude='author').filter(author__isnull=False)
+                   .values('author_id', 'author__first_name', 'author__last_name').annotate(count=Count('pk'))
+                   .order_by(chosen_first, '-count', 'author__last_name', 'author_id')[:AUTHOR_LIMIT])
+    return {
+        'total': filter_books(filters).count(),
+        'genre': [{'id': row['genre_id'], 'name': row['genre__name'], 'count': row['count']}
+                  for row in genre_rows],
+        'language': [{'id': row['language_id'], 'name': row['language__name'], 'count': row['count']}
+                     for row in language_rows],
+        'author': sorted(({'id': row['author_id'], 'count': row['count'],
+                           'name': f'{row["author__last_name"]}, {row["author__first_name"]}'}
+                          for row in author_rows), key=lambda option: option['name']),
+    }
+
+
+def facets_key(filters, versions):
+    parts = [repr(sorted(filters.items())), repr(sorted(versions.items()))]
+    return FACETS_PREFIX + hashlib.md5('|'.join(parts).encode(), usedforsecurity=False).hexdigest()
+
+
+def get_facets(filters):
+    """count_facets(filters), from the cache when the filter set is small enough to be a common one."""
+    if sum(len(filters[name]) for name in FACET_NAMES) > getattr(settings, 'CATALOG_FACET_CACHE_MAX_FILTERS', 2):
+        return count_facets(filters)
+    names = VERSION_NAMES + ['availability'] if filters['available'] else VERSION_NAMES
+    key = facets_key(filters, caching.get_versions(*names))
+    facets = cache.get(key)
+    if facets is None:
+        # Counted on the primary: a replica's counts could be older than the versions in the key.
+        with primary_reads():
+            facets = count_facets(filters)
+        cache.set(key, facets, getattr(settings, 'CATALOG_FACET_TIMEOUT', 3600))
+    return facets
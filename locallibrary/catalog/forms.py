@@ -1,4 +1,5 @@
 import datetime
+import uuid
 
 from django import forms
 
@@ -20,4 +21,50 @@ class RenewBookForm(forms.Form):
             raise ValidationError(_('Invalid date - renewal more than 4 weeks ahead'))
 
         # Remember to always return the cleaned data.
-        return data
\ No newline at end of file
+        return data
+
+
+class RenewBookLibrarianForm(RenewBookForm):
+    """RenewBookForm with the loan the librarian was shown, so a loan changed since is not renewed."""
+    borrower = forms.IntegerField(widget=forms.HiddenInput, required=False)
+    due_back = forms.DateField(widget=forms.HiddenInput, required=False)
+
+
+class BookInstanceListField(forms.Field):
+    """Several BookInstance UUIDs, e.g. from a list of checkboxes with the same name."""
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        try:
+            return [uuid.UUID(str(item)) for item in value or []]
+        except ValueError:
+            raise ValidationError(_('Invalid book instance id'))
+
+    def validate(self, value):
+        if not value:
+            raise ValidationError(_('Select at least one book'))
+
+
+class BulkLoanForm(RenewBookForm):
+    """Renew or return several loans at once. A renewal date is checked with the RenewBookForm rules."""
+    RENEW = 'renew'
+    RETURN = 'return'
+
+    action = forms.ChoiceField(choices=((RENEW, 'Renew'), (RETURN, 'Mark returned')))
+    book_instances = BookInstanceListField()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['renewal_date'].required = False
+
+    def clean_renewal_date(self):
+        if self.cleaned_data['renewal_date'] is None:
+            return None
+        return super().clean_renewal_date()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('action') == self.RENEW and not cleaned_data.get('renewal_date') \
+                and 'renewal_date' not in self.errors:
+            self.add_error('renewal_date', _('Enter the renewal date'))
+        return cleaned_data
@@ -0,0 +1,150 @@
+"""Synthetic catalogs for benchmarking (see the generate_library and benchmark_routes commands).
+
+LibraryGenerator fills the catalog with a reproducible dataset: the same seed and sizes
+always give the same authors, books, genres, copies and loans. Rows are written with
+bulk_create() in batches, so each batch's book copy counters are recounted and its loans and
+reservations logged as status events (not counted as loans), and the home page counters and
+the search index are rebuilt once at the end (bulk_create() does not send the signals that
+normally maintain them).
+
+Copies get a status mix close to a lending library's: about 55% available, 30% on loan
+(a fifth of those overdue), 10% reserved and 5% in maintenance. Loans go to the generated
+users, whose usernames are reader0, reader1 ... and whose password is PASSWORD.
+"""
+
+import datetime
+import random
+import time
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Permission
+from django.db import transaction
+
+from catalog import caching, circulation, search, stats
+from catalog.models import Author, Book, BookInstance, Genre, Language, User
+
+PASSWORD = 'library'
+LIBRARIAN = 'librarian'
+USERNAME_PREFIX = 'reader'
+
+LANGUAGES = ['English', 'French', 'German', 'Spanish', 'Italian', 'Japanese', 'Portuguese', 'Dutch']
+# Weights: most of a library's books are in its main language.
+LANGUAGE_WEIGHTS = [60, 8, 8, 8, 5, 5, 3, 3]
+GENRES = ['Fantasy', 'Science Fiction', 'Mystery', 'Romance', 'Horror', 'History', 'Biography', 'Poetry',
+          'Thriller', 'Travel', 'Philosophy', 'Children', 'Cookery', 'Art', 'Science', 'Drama']
+STATUS_WEIGHTS = {'a': 55, 'o': 30, 'r': 10, 'm': 5}
+
+FIRST_NAMES = ['Mary', 'John', 'Ursula', 'Frank', 'Jane', 'Isaac', 'Octavia', 'Terry', 'Agatha', 'Arthur',
+               'Virginia', 'George', 'Doris', 'Italo', 'Toni', 'Jorge', 'Chinua', 'Haruki', 'Margaret', 'Kazuo']
+LAST_NAMES = ['Shelley', 'Austen', 'Le Guin', 'Herbert', 'Asimov', 'Butler', 'Pratchett', 'Christie', 'Clarke',
+              'Woolf', 'Eliot', 'Lessing', 'Calvino', 'Morrison', 'Borges', 'Achebe', 'Murakami', 'Atwood',
+              'Ishiguro', 'Orwell', 'Tolkien', 'Dickens', 'Bronte', 'Hardy', 'Wells']
+WORDS = ['shadow', 'river', 'empire', 'garden', 'winter', 'silence', 'machine', 'city', 'island', 'storm',
+         'memory', 'glass', 'forest', 'night', 'fire', 'star', 'house', 'road', 'sea', 'mountain', 'dream',
+         'letter', 'clock', 'crown', 'stone', 'bridge', 'harvest', 'lantern', 'mirror', 'orchard']
+
+
+class LibraryGenerator:
+    """Build a seeded catalog of the given size. Call run(); the counts written are left on the instance."""
+
+    def __init__(self, books=1000, authors=None, users=None, copies_per_book=3, seed=0, batch_size=2000,
+                 progress=None, today=None):
+        self.num_books = books
+        self.num_authors = authors if authors is not None else max(1, books // 5)
+        self.num_users = users if users is not None else max(1, books // 10)
+        self.copies_per_book = copies_per_book
+        self.batch_size = batch_size
+        self.progress = progress
+        self.today = today or datetime.date.today()
+        self.random = random.Random(seed)
+        self.books = 0
+        self.copies = 0
+        self.loans = 0
+        self.seconds = 0.0
+
+    def words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in range(count))
+
+    def run(self):
+        started = time.monotonic()
+        with transaction.atomic():
+            language_ids = self.get_ids(Language, LANGUAGES)
+            genre_ids = self.get_ids(Genre, GENRES)
+            author_ids = [author.pk for author in Author.objects.bulk_create([
+                Author(first_name=self.random.choice(FIRST_NAMES),
+                       last_name=f'{self.random.choice(LAST_NAMES)} {n}',
+                       date_of_birth=datetime.date(1800, 1, 1) + datetime.timedelta(days=self.random.randrange(70000)))
+                for n in range(self.num_authors)
+            ], batch_size=self.batch_size)]
+            user_ids = self.create_users()
+
+        for start in range(0, self.num_books, self.batch_size):
+            with transaction.atomic():
+                self.create_books(range(start, min(start + self.batch_size, self.num_books)),
+                                  language_ids, genre_ids, author_ids, user_ids)
+            if self.progress:
+                self.progress(self)
+
+        stats.rebuild()
+        search.rebuild_index()
+        caching.bump('catalog')
+        self.seconds = time.monotonic() - started
+        return self
+
+    def get_ids(self, model, names):
+        """Ids of the Languages or Genres with the names, in order, creating only the missing ones."""
+        ids = {name: pk for pk, name in model.objects.filter(name__in=names).values_list('pk', 'name')}
+        missing = [name for name in names if name not in ids]
+        for name, obj in zip(missing, model.objects.bulk_create([model(name=name) for name in missing])):
+            ids[name] = obj.pk
+        return [ids[name] for name in names]
+
+    def create_users(self):
+        # Hash the shared password once; hashing it for each user would dominate the run.
+        password = make_password(PASSWORD)
+        users = User.objects.bulk_create(
+            [User(username=f'{USERNAME_PREFIX}{n}', password=password) for n in range(self.num_users)]
+            + [User(username=LIBRARIAN, password=password, is_staff=True)],
+            batch_size=self.batch_size,
+        )
+        librarian = User.objects.get(username=LIBRARIAN)
+        librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        return [user.pk for user in users[:-1]]
+
+    def create_books(self, numbers, language_ids, genre_ids, author_ids, user_ids):
+        books = Book.objects.bulk_create([
+            Book(title=self.words(self.random.randint(1, 4)).title(),
+                 summary=self.words(self.random.randint(20, 60)).capitalize() + '.',
+                 isbn=f'{9790000000000 + n}',
+                 author_id=self.random.choice(author_ids),
+                 language_id=self.random.choices(language_ids, LANGUAGE_WEIGHTS)[0])
+            for n in numbers
+        ])
+        through = Book.genre.through
+        through.objects.bulk_create([
+            through(book_id=book.pk, genre_id=genre_id)
+            for book in books for genre_id in self.random.sample(genre_ids, self.random.randint(1, 3))
+        ])
+
+        statuses, weights = zip(*STATUS_WEIGHTS.items())
+        copies = []
+        for book in books:
+            for _ in range(self.random.randint(0, 2 * self.copies_per_book)):
+                status = self.random.choices(statuses, weights)[0]
+                copy = BookInstance(id=uuid.UUID(int=self.random.getrandbits(128), version=4), book_id=book.pk,
+                                    imprint=f'{self.random.choice(LAST_NAMES)} Press, {self.random.randint(1950, 2024)}',
+                                    status=status)
+                if status == 'o':
+                    # A fifth of the loans are overdue, the rest due within three weeks.
+                    days = -self.random.randint(1, 60) if self.random.random() < 0.2 else self.random.randint(0, 21)
+                    copy.due_back = self.today + datetime.timedelta(days=days)
+                    copy.borrower_id = self.random.choice(user_ids)
+                    self.loans += 1
+                copies.append(copy)
+        BookInstance.objects.bulk_create(copies, batch_size=self.batch_size)
+        stats.recount_books(book.pk for book in books)
+        circulation.record(circulation.creation_events(copies))
+        self.books += len(books)
+        self.copies += len(copies)
+
@@ -0,0 +1,218 @@
+"""Operations on loans (BookInstance rows with status 'o') and reservations (status 'r').
+
+The single-copy operations (checkout, reserve, return_copy, renew) change a copy with one
+conditional UPDATE whose WHERE clause checks the status (and borrower) the change expects.
+If another request changed the copy first, no row matches and LoanConflict is raised, so two
+librarians acting on the same copy cannot overwrite each other, and no lock is held while a
+form is being filled in. checkout_book() retries on conflicts with other available copies.
+"""
+
+import datetime
+
+from django.db import transaction
+
+from catalog import caching, circulation, stats
+from catalog.models import BookInstance, LoanEvent, OverdueNotice
+from catalog.pagination import CursorPaginator
+
+RENEWED = 'renewed'
+RETURNED = 'returned'
+NOT_ON_LOAN = 'not on loan'
+NOT_FOUND = 'not found'
+
+LOAN_PERIOD = datetime.timedelta(weeks=3)
+
+
+class LoanConflict(Exception):
+    """A copy was not in the state an operation expected, because another request changed it first."""
+
+    def __init__(self, book_instance_id, status, borrower_id):
+        self.book_instance_id = book_instance_id
+        self.status = status
+        self.borrower_id = borrower_id
+        super().__init__(f'Copy {book_instance_id} is {dict(BookInstance.LOAN_STATUS).get(status, status).lower()}.')
+
+
+def sweep_overdue(today=None, chunk_size=5000, on_chunk=None):
+    """Record every loan overdue on today as an OverdueNotice, reading the loans in keyset chunks.
+
+    The loans are walked in (due_back, id) order through the status index, chunk_size rows at a
+    time, so memory use stays flat however many loans are active. Sweeping the same day twice
+    does not duplicate notices. on_chunk, if given, is called with each chunk's list of notices.
+    Returns the number of overdue loans found.
+    """
+    today = today or datetime.date.today()
+    loans = (BookInstance.objects.overdue(today).with_overdue(today)
+             .values('id', 'book_id', 'borrower_id', 'due_back', 'overdue_by'))
+    paginator = CursorPaginator(loans, chunk_size, ('due_back', 'id'))
+    found = 0
+    cursor = ''
+    while True:
+        page = paginator.page(cursor)
+        notices = [
+            OverdueNotice(swept_on=today, book_instance_id=loan['id'], borrower_id=loan['borrower_id'],
+                          due_back=loan['due_back'], days_overdue=loan['overdue_by'].days)
+            for loan in page.object_list
+        ]
+        ids = [loan['id'] for loan in page.object_list]
+        with transaction.atomic():
+            # Lock the copies (where the database supports it; SQLite lets one writer in at a time) and
+            # only then look for today's notices, so that an overlapping sweep waits for this one and
+            # sees its notices. Only the loans without a notice get one, and an 'overdue' event.
+            list(BookInstance.objects.select_for_update().filter(pk__in=ids).values_list('pk'))
+            swept = set(OverdueNotice.objects.filter(swept_on=today, book_instance_id__in=ids)
+                        .values_list('book_instance_id', flat=True))
+            new = [notice for notice in notices if notice.book_instance_id not in swept]
+            OverdueNotice.objects.bulk_create(new, ignore_conflicts=True)
+            circulation.record([
+                LoanEvent(kind=LoanEvent.OVERDUE, day=today, book_instance_id=loan['id'], book_id=loan['book_id'],
+                          borrower_id=loan['borrower_id'], old_status='o', new_status='o', due_back=loan['due_back'])
+                for loan in page.object_list if loan['id'] not in swept
+            ])
+        found += len(notices)
+        if on_chunk:
+            on_chunk(notices)
+        if not page.has_next():
+            return found
+        cursor = page.next_cursor
+
+
+def _update_loans(ids, outcome, **changes):
+    """Apply changes to those of the copies (given as UUIDs) that are on loan, with one UPDATE in one transaction.
+
+    Returns a dict mapping each id to outcome, NOT_ON_LOAN or NOT_FOUND.
+    """
+    ids = list(dict.fromkeys(ids))
+    with transaction.atomic():
+        # Lock the rows (where the database supports it) so the statuses cannot change before the UPDATE.
+        copies = {pk: (status, borrower_id, book_id) for pk, status, borrower_id, book_id in
+                  BookInstance.objects.select_for_update().filter(pk__in=ids)
+                  .values_list('pk', 'status', 'borrower_id', 'book_id')}
+        statuses = {pk: copy[0] for pk, copy in copies.items()}
+        on_loan = [pk for pk, status in statuses.items() if status == 'o']
+        updated = BookInstance.objects.filter(pk__in=on_loan, status__exact='o').update(**changes)
+        book_ids = {copies[pk][2] for pk in on_loan}
+        circulation.record([
+            circulation.make_event(pk, copies[pk][2], 'o', changes.get('status', 'o'), copies[pk][1],
+                                   changes.get('due_back'))
+            for pk in on_loan
+        ])
+        caching.bump_books(book_ids)
+        if changes.get('status') == 'a':
+            # QuerySet.update() sends no signals, so adjust the home page and book counters here.
+            stats.adjust(num_instances_available=updated)
+            stats.recount_books(book_ids)
+            caching.bump('availability')
+    results = {}
+    for pk in ids:
+        if pk not in statuses:
+            results[pk] = NOT_FOUND
+        else:
+            results[pk] = outcome if statuses[pk] == 'o' else NOT_ON_LOAN
+    return results
+
+
+def renew_loans(ids, renewal_date):
+    """Set the due date of the given copies that are on loan to renewal_date."""
+    return _update_loans(ids, RENEWED, due_back=renewal_date)
+
+
+def return_loans(ids):
+    """Mark the given copies that are on loan as returned (available, no borrower or due date)."""
+    return _update_loans(ids, RETURNED, status='a', borrower=None, due_back=None)
+
+
+def _transition(pk, old_status, new_status=None, expected_borrower=None, expected_due_back=None, **changes):
+    """Change the copy pk with one UPDATE, provided it still has old_status (and expected_borrower and
+    expected_due_back, if given).
+
+    Returns the copy's book id. Raises LoanConflict if the copy has changed, and
+    BookInstance.DoesNotExist if it is gone.
+    """
+    expected = {'status__exact': old_status}
+    if expected_borrower is not None:
+        expected['borrower'] = expected_borrower
+    if expected_due_back is not None:
+        expected['due_back'] = expected_due_back
+    if new_status is not None:
+        changes['status'] = new_status
+    # A return clears the borrower only after the row has been read back, so that its event keeps
+    # who had the copy. (Reading before the UPDATE would start an SQLite read snapshot that cannot
+    # then take the write lock if another request writes first.)
+    clear_borrower = 'borrower' in changes and changes['borrower'] is None
+    if clear_borrower:
+        del changes['borrower']
+    with transaction.atomic():
+        updated = BookInstance.objects.filter(pk=pk, **expected).update(**changes)
+        current = BookInstance.objects.filter(pk=pk).order_by().values_list('status', 'borrower_id', 'book_id').first()
+        if current is None:
+            raise BookInstance.DoesNotExist(f'Copy {pk} does not exist.')
+        if not updated:
+            raise LoanConflict(pk, current[0], current[1])
+        book_id = current[2]
+        if clear_borrower:
+            BookInstance.objects.filter(pk=pk).update(borrower=None)
+        # The borrower after a checkout or renewal, or the one who had the copy before a return.
+        circulation.record([circulation.make_event(pk, book_id, old_status, new_status or old_status,
+                                                   current[1], changes.get('due_back'))])
+        if new_status is not None and new_status != old_status:
+            # QuerySet.update() sends no signals, so move the copy between the counters here.
+            stats.adjust(num_instances_available=(new_status == 'a') - (old_status == 'a'))
+            old, new = stats.copy_deltas(old_status, -1), stats.copy_deltas(new_status)
+            stats.adjust_book(book_id, **{name: old[name] + new[name] for name in old})
+            caching.bump('availability')
+        caching.bump_books([book_id])
+    return book_id
+
+
+def checkout(pk, borrower, due_back=None):
+    """Lend the copy pk to borrower: an available copy, or one reserved for borrower. Returns its book id."""
+    due_back = due_back or datetime.date.today() + LOAN_PERIOD
+    try:
+        return _transition(pk, 'a', 'o', borrower=borrower, due_back=due_back)
+    except LoanConflict as e:
+        if e.status != 'r' or e.borrower_id != getattr(borrower, 'pk', borrower):
+            raise
+        return _transition(pk, 'r', 'o', expected_borrower=borrower, due_back=due_back)
+
+
+def checkout_book(book, borrower, due_back=None, attempts=5):
+    """Lend any available copy of book to borrower and return the copy's id.
+
+    Another request may take the chosen copy between reading and updating it, so on a conflict
+    another available copy is tried, up to attempts times. Copies are picked at random so that
+    concurrent checkouts of the same book rarely pick the same one. Raises LoanConflict if every
+    attempt lost its race, or BookInstance.DoesNotExist if no copy is available.
+    """
+    conflict = None
+    for attempt in range(attempts):
+        pk = (BookInstance.objects.filter(book=book, status__exact='a').order_by('?')
+              .values_list('pk', flat=True).first())
+        if pk is None:
+            break
+        try:
+            checkout(pk, borrower, due_back)
+            return pk
+        except LoanConflict as e:
+            conflict = e
+    if conflict is not None:
+        raise conflict
+    raise BookInstance.DoesNotExist(f'No copy of book {getattr(book, "pk", book)} is available.')
+
+
+def reserve(pk, borrower):
+    """Reserve the available copy pk for borrower. Returns its book id."""
+    return _transition(pk, 'a', 'r', borrower=borrower, due_back=None)
+
+
+def return_copy(pk, borrower=None):
+    """Mark the copy pk, which must be on loan (to borrower, if given), as returned. Returns its book id."""
+    return _transition(pk, 'o', 'a', expected_borrower=borrower, borrower=None, due_back=None)
+
+
+def renew(pk, renewal_date, borrower=None, due_back=None):
+    """Set the due date of the copy pk, which must still be on loan (to borrower and due on due_back, if given).
+
+    Returns its book id.
+    """
+    return _transition(pk, 'o', expected_borrower=borrower, expected_due_back=due_back, due_back=renewal_date)
@@ -0,0 +1,74 @@
+import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from catalog import benchmark
+from catalog.generator import LibraryGenerator
+
+# (label, handler, use the async view)
+MODES = (
+    ('wsgi', 'wsgi', False),
+    ('asgi sync view', 'asgi', False),
+    ('asgi async view', 'asgi', True),
+)
+
+
+class Command(BaseCommand):
+    help = ('Compare the WSGI and ASGI request paths under concurrent load: each read view through threaded '
+            'WSGI, and through ASGI both as the sync view and as its async version in catalog.async_views.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=2000, help='Number of books to generate.')
+        parser.add_argument('--concurrency', default='1,8,32',
+                            help='Comma-separated numbers of requests in flight (default 1,8,32).')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per route, mode and concurrency.')
+        parser.add_argument('--routes', default=','.join(benchmark.ASYNC_ROUTES),
+                            help='Comma-separated sync route names to compare (default: all with an async version).')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated catalog.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency must be a comma-separated list of numbers.')
+        routes = options['routes'].split(',')
+        unknown = set(routes) - set(benchmark.ASYNC_ROUTES)
+        if unknown:
+            raise CommandError(f'No async version of: {", ".join(sorted(unknown))}.')
+
+        results = []
+        setup_test_environment()
+        try:
+            # On disk, so that the WSGI threads' connections can share the database.
+            with benchmark.test_database(on_disk=True):
+                generator = LibraryGenerator(books=options['books'], seed=options['seed']).run()
+                self.stdout.write(f'{generator.books} books, {generator.copies} copies, {generator.loans} loans')
+                sample = benchmark.get_sample(datetime.date.today() + datetime.timedelta(weeks=2))
+                cookies = benchmark.librarian_client().cookies
+
+                self.stdout.write(f'{"route":<16} {"mode":<16} {"conc":>4} {"req/s":>8} {"p50 ms":>8} '
+                                  f'{"p95 ms":>8} {"p99 ms":>8}')
+                for name in routes:
+                    for label, handler, use_async in MODES:
+                        route = benchmark.ASYNC_ROUTES[name] if use_async else name
+                        url = reverse(route, args=benchmark.ROUTES[route][1](sample)[0])
+                        for level in levels:
+                            result = benchmark.run_concurrent(url, handler, level, options['requests'], cookies)
+                            results.append({'route': name, 'mode': label, **result})
+                            self.stdout.write(
+                                f'{name:<16} {label:<16} {level:>4} {result["throughput_rps"]:>8.1f} '
+                                f'{result["p50_ms"]:>8.1f} {result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f}'
+                                + ('' if result['statuses'] == [200] else f'  statuses {result["statuses"]}')
+                            )
+        finally:
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'books': options['books'], 'requests': options['requests'], 'results': results},
+                          output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}.'))
@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from catalog import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Race threads checking out the same copies in a fresh on-disk test database, checking that each copy '
+            'is lent once, and report checkouts per second under contention.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Number of threads racing.')
+        parser.add_argument('--copies', type=int, default=5, help='Copies of the book raced for.')
+        parser.add_argument('--rounds', type=int, default=10, help='Checkouts per thread in the throughput run.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        try:
+            # On disk, so that the threads' connections wait for each other's locks.
+            with benchmark.test_database(on_disk=True):
+                results = benchmark.race_checkouts(options['threads'], options['copies'], options['rounds'])
+        finally:
+            teardown_test_environment()
+
+        same_copy, any_copy, throughput = results['same_copy'], results['any_copy'], results['throughput']
+        self.stdout.write(f'Same copy: {len(same_copy["winners"])} of {results["threads"]} threads won.')
+        self.stdout.write(f'Any copy: {len(set(any_copy["taken"]))} of {results["copies"]} copies lent.')
+        self.stdout.write(f'{results["threads"]} threads: {throughput["checkouts_per_second"]} checkouts/s.')
+        for name in ('same_copy', 'any_copy', 'throughput'):
+            for error in results[name]['errors']:
+                self.stderr.write(f'{name}: {error}')
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}.'))
@@ -0,0 +1,82 @@
+import datetime
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from catalog import benchmark
+from catalog.generator import LibraryGenerator
+
+
+class Command(BaseCommand):
+    help = ('Benchmark every catalog URL at one or more dataset sizes, each generated into a fresh test database, '
+            'reporting latency percentiles, queries per request and throughput.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000',
+                            help='Comma-separated numbers of books to generate (default 1000,10000).')
+        parser.add_argument('--requests', type=int, default=20, help='Timed requests per route.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated catalogs.')
+        parser.add_argument('--cold', action='store_true', help='Clear the cache before every request.')
+        parser.add_argument('--routes', help='Comma-separated route names to benchmark (default: all).')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of numbers.')
+        routes = options['routes'].split(',') if options['routes'] else None
+        unknown = set(routes or []) - set(benchmark.ROUTES)
+        if unknown:
+            raise CommandError(f'Unknown routes: {", ".join(sorted(unknown))}.')
+        for name in benchmark.uncovered_routes():
+            self.stderr.write(f'Route {name!r} is not covered by catalog.benchmark.ROUTES.')
+
+        report = {
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'requests': options['requests'],
+            'cold': options['cold'],
+            'seed': options['seed'],
+            'sizes': [],
+        }
+        setup_test_environment()
+        try:
+            for size in sizes:
+                report['sizes'].append(self.run_size(size, routes, options))
+        finally:
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}.'))
+
+    def run_size(self, size, routes, options):
+        """Generate a catalog of size books into a new test database and benchmark it."""
+        with benchmark.test_database():
+            generator = LibraryGenerator(books=size, seed=options['seed']).run()
+            self.stdout.write(f'\n{generator.books} books, {generator.copies} copies, {generator.loans} loans '
+                              f'(generated in {generator.seconds:.1f}s)')
+            sample = benchmark.get_sample(datetime.date.today() + datetime.timedelta(weeks=2))
+            results = benchmark.run_routes(sample, options['requests'], options['cold'], routes)
+
+        self.stdout.write(f'{"route":<22} {"status":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+                          f'{"queries":>7} {"req/s":>8}')
+        for result in results:
+            self.stdout.write(f'{result["route"]:<22} {result["status"]:>6} {result["p50_ms"]:>8.1f} '
+                              f'{result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f} {result["queries"]:>7} '
+                              f'{result["throughput_rps"]:>8.1f}')
+        return {
+            'books': generator.books,
+            'copies': generator.copies,
+            'loans': generator.loans,
+            'generate_seconds': round(generator.seconds, 2),
+            'routes': results,
+        }
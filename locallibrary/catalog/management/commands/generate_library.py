@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from catalog.generator import LIBRARIAN, PASSWORD, LibraryGenerator
+from catalog.models import Book, User
+
+
+class Command(BaseCommand):
+    help = ('Fill an empty catalog with a reproducible synthetic dataset: authors, books with genres and '
+            'languages, copies with a mix of loan statuses, and users borrowing them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000, help='Number of books.')
+        parser.add_argument('--authors', type=int, help='Number of authors (default: books / 5).')
+        parser.add_argument('--users', type=int, help='Number of borrowers (default: books / 10).')
+        parser.add_argument('--copies-per-book', type=int, default=3, help='Average number of copies of each book.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed; the same seed gives the same data.')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of books written per batch.')
+
+    def handle(self, *args, **options):
+        if Book.objects.exists() or User.objects.filter(username=LIBRARIAN).exists():
+            raise CommandError('The catalog is not empty. Generate into a new database.')
+        generator = LibraryGenerator(
+            books=options['books'], authors=options['authors'], users=options['users'],
+            copies_per_book=options['copies_per_book'], seed=options['seed'], batch_size=options['batch_size'],
+            progress=self.report,
+        )
+        generator.run()
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {generator.books} books, {generator.copies} copies and {generator.loans} loans '
+            f'in {generator.seconds:.1f}s. Log in as {LIBRARIAN!r} with password {PASSWORD!r}.'
+        ))
+
+    def report(self, generator):
+        self.stdout.write(f'{generator.books} books, {generator.copies} copies')
@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catalog.importer import CatalogImporter, CatalogImportError, read_records
+
+
+class Command(BaseCommand):
+    help = ('Import books, authors, genres, languages and copies from a CSV or JSON Lines file, '
+            'updating books that already exist (matched on ISBN).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for standard input.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Input format (default: guessed from the file extension).')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of records written per batch.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        importer = CatalogImporter(batch_size=options['batch_size'], progress=self.report)
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            importer.run(read_records(stream, format))
+        except CatalogImportError as e:
+            raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {importer.books} books and {importer.copies} copies from {importer.rows} rows '
+            f'({importer.skipped} skipped) at {importer.rate:.0f} rows/s.'
+        ))
+
+    def report(self, importer):
+        self.stdout.write(f'{importer.rows} rows, {importer.copies} copies ({importer.rate:.0f} rows/s)')
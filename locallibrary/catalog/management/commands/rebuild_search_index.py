@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catalog import search
+
+
+class Command(BaseCommand):
+    help = 'Recreate the full-text search index and index every book in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=search.CHUNK_SIZE,
+                            help='Number of books indexed per batch.')
+        parser.add_argument('--database', default='default', help='Database alias to rebuild the index in.')
+
+    def handle(self, *args, **options):
+        if not search.is_supported(options['database']):
+            raise CommandError('Full-text search needs an SQLite database with FTS5.')
+        started = time.monotonic()
+        indexed = search.rebuild_index(batch_size=options['batch_size'], using=options['database'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {indexed} books in {time.monotonic() - started:.1f}s.'
+        ))
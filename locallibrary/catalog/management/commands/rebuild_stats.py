@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from catalog import stats
+
+
+class Command(BaseCommand):
+    help = 'Recount the home page counters from the catalog tables and report any drift.'
+
+    def handle(self, *args, **options):
+        counts, drift = stats.rebuild()
+        for name, (stored, actual) in drift.items():
+            self.stdout.write(self.style.WARNING(f'{name}: stored {stored}, actual {actual}'))
+        if not drift:
+            self.stdout.write('No drift found.')
+        self.stdout.write(self.style.SUCCESS(
+            ', '.join(f'{name}={counts[name]}' for name in stats.COUNTER_FIELDS)
+        ))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from catalog import caching, stats
+
+
+class Command(BaseCommand):
+    help = "Recount each book's copy counters (total, available, on loan) from the copies table and repair any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Number of books checked per query.')
+
+    def handle(self, *args, **options):
+        drift = stats.reconcile_books(batch_size=options['batch_size'])
+        for book_id, stored, actual in drift:
+            self.stdout.write(self.style.WARNING(
+                f'Book {book_id}: stored {"/".join(map(str, stored))}, actual {"/".join(map(str, actual))} '
+                f'(total/available/on loan)'
+            ))
+        if drift:
+            caching.bump(*[f'book:{book_id}' for book_id, stored, actual in drift], 'availability')
+        self.stdout.write(self.style.SUCCESS(f'Repaired {len(drift)} books.' if drift else 'No drift found.'))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog import circulation
+from catalog.models import RollupWatermark
+
+
+class Command(BaseCommand):
+    help = ('Add the loan events logged since the last run to the daily circulation rollups '
+            '(loans, returns and overdues per book, genre and language).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of events added per transaction.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        processed = circulation.rollup(batch_size=options['batch_size'])
+        watermark = RollupWatermark.objects.filter(name=circulation.WATERMARK).first()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rolled up {processed} loan events in {time.monotonic() - started:.1f}s '
+            f'(up to event {watermark.last_event_id if watermark else 0}).'
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from catalog import database
+
+
+class Command(BaseCommand):
+    help = ('Copy the primary SQLite database into the read replica (CATALOG_READ_DATABASE), '
+            'the local stand-in for replication. Run it again to bring the replica up to date.')
+
+    def handle(self, *args, **options):
+        alias = database.read_database()
+        if not alias:
+            raise CommandError('CATALOG_READ_DATABASE is not set.')
+        primary, replica = connections[DEFAULT_DB_ALIAS], connections[alias]
+        if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+            raise CommandError('Only SQLite databases can be copied; use the database\'s own replication.')
+        primary.ensure_connection()
+        replica.ensure_connection()
+        # The online backup API copies a consistent snapshot while the primary stays in use.
+        primary.connection.backup(replica.connection)
+        self.stdout.write(self.style.SUCCESS(f'Copied {primary.settings_dict["NAME"]} to '
+                                             f'{replica.settings_dict["NAME"]}.'))
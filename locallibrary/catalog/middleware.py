@@ -0,0 +1,128 @@
+"""Middleware for the catalog app.
+
+QueryTimingMiddleware measures each request: the number of SQL queries and the time spent
+in them (through connection.execute_wrapper), the time spent in the view and the time spent
+rendering the template. It reports them in a Server-Timing header, which browser developer
+tools display, and logs requests slower than CATALOG_SLOW_REQUEST_MS to the
+'catalog.performance' logger with their slowest and most repeated statements.
+
+Enable it by adding 'catalog.middleware.QueryTimingMiddleware' near the top of MIDDLEWARE,
+so that the time it measures includes the other middleware. Settings:
+
+    CATALOG_SLOW_REQUEST_MS  -- log requests taking at least this long (default 500, None to disable)
+    CATALOG_SERVER_TIMING    -- add the Server-Timing header (default True)
+
+Render time can only be separated from view time for views that return a TemplateResponse
+(the generic class-based views); for views calling render() it is counted as view time.
+
+ReplicaRoutingMiddleware lets catalog.database.ReadReplicaRouter send the reads of GET and
+HEAD requests to the read replica, and keeps a user on the primary for a few seconds after
+a request that wrote.
+"""
+
+import logging
+from collections import Counter
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+
+from catalog import database
+
+logger = logging.getLogger('catalog.performance')
+
+
+class RequestTiming:
+    """Statement log for one request, used as a database execute wrapper."""
+
+    def __init__(self):
+        self.queries = []   # (sql, seconds) for each statement executed.
+        self.render = 0.0
+        self.render_sql = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, perf_counter() - start))
+
+    @property
+    def sql(self):
+        return sum(duration for sql, duration in self.queries)
+
+    def slowest(self, n=3):
+        return sorted(self.queries, key=lambda query: query[1], reverse=True)[:n]
+
+    def most_repeated(self, n=3):
+        return [(sql, count) for sql, count in Counter(sql for sql, duration in self.queries).most_common(n)
+                if count > 1]
+
+
+class QueryTimingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_request_ms = getattr(settings, 'CATALOG_SLOW_REQUEST_MS', 500)
+        self.server_timing = getattr(settings, 'CATALOG_SERVER_TIMING', True)
+
+    def __call__(self, request):
+        timing = request.catalog_timing = RequestTiming()
+        start = perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timing))
+            response = self.get_response(request)
+        total = perf_counter() - start
+
+        sql = timing.sql
+        view = total - timing.render
+        if self.server_timing:
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={sql * 1000:.1f};desc="{len(timing.queries)} queries"',
+                f'view;dur={view * 1000:.1f}',
+                f'render;dur={timing.render * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ])
+        if self.slow_request_ms is not None and total * 1000 >= self.slow_request_ms:
+            self.log_slow_request(request, timing, total)
+        return response
+
+    def process_template_response(self, request, response):
+        # Render now rather than after the middleware returns, so the time can be measured apart from the view.
+        timing = getattr(request, 'catalog_timing', None)
+        if timing is not None:
+            start = perf_counter()
+            sql_before = timing.sql
+            response.render()
+            timing.render += perf_counter() - start
+            timing.render_sql += timing.sql - sql_before
+        return response
+
+    def log_slow_request(self, request, timing, total):
+        lines = [
+            f'Slow request: {request.method} {request.get_full_path()} took {total * 1000:.0f}ms '
+            f'({len(timing.queries)} queries, {timing.sql * 1000:.0f}ms SQL of which '
+            f'{timing.render_sql * 1000:.0f}ms while rendering, {timing.render * 1000:.0f}ms rendering)'
+        ]
+        for sql, duration in timing.slowest():
+            lines.append(f'  slowest {duration * 1000:.1f}ms: {sql}')
+        for sql, count in timing.most_repeated():
+            lines.append(f'  repeated {count}x: {sql}')
+        logger.warning('\n'.join(lines))
+
+
+class ReplicaRoutingMiddleware:
+    cookie_name = 'catalog_primary'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sticky_seconds = getattr(settings, 'CATALOG_PRIMARY_STICKY_SECONDS', 5)
+
+    def __call__(self, request):
+        use_replica = request.method in ('GET', 'HEAD') and self.cookie_name not in request.COOKIES
+        with database.request_scope(use_replica) as state:
+            response = self.get_response(request)
+        if state.wrote and self.sticky_seconds:
+            response.set_cookie(self.cookie_name, '1', max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+        return response
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.functions import Collate
+from django.utils import timezone
 from django.urls import reverse # Used to generate URLs by reversing the URL patterns
 import uuid  # Required for unique book instances
 
@@ -12,6 +14,25 @@ class User(AbstractUser):
     #     db_table = 'auth_user'
 
 
+class BookInstanceQuerySet(models.QuerySet):
+    """Loan queries computed in the database rather than per row in Python."""
+
+    def overdue(self, today=None):
+        """Copies on loan whose due date has passed."""
+        return self.filter(status__exact='o', due_back__lt=today or date.today())
+
+    def with_overdue(self, today=None):
+        """Annotate each copy with overdue (bool) and overdue_by (timedelta past due_back, or None)."""
+        today = today or date.today()
+        is_overdue = models.Q(status__exact='o', due_back__lt=today)
+        return self.annotate(
+            overdue=models.Case(models.When(is_overdue, then=models.Value(True)),
+                                default=models.Value(False), output_field=models.BooleanField()),
+            overdue_by=models.Case(models.When(is_overdue, then=models.Value(today) - models.F('due_back')),
+                                   default=None, output_field=models.DurationField()),
+        )
+
+
 class BookInstance(models.Model):
     """Model representing a specific copy of a book (i.e. that can be borrowed from the library)."""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4,
@@ -37,9 +58,29 @@ class BookInstance(models.Model):
         help_text='Book availability',
     )
 
+    objects = BookInstanceQuerySet.as_manager()
+
     class Meta:
-        ordering = ['due_back']
+        ordering = ['due_back', 'id']
         permissions = (("can_mark_returned", "Set book as returned"),)
+        # Serve the loan lists (status='o', optionally by borrower, ordered by due_back) and the default
+        # ordering from indexes rather than a table scan and sort. See LoanIndexPlanTests.
+        indexes = [
+            models.Index(fields=['status', 'due_back', 'id'], name='bookinstance_status_due_idx'),
+            models.Index(fields=['borrower', 'due_back', 'id'], condition=models.Q(status='o'),
+                         name='bookinstance_loans_idx'),
+            models.Index(fields=['due_back', 'id'], name='bookinstance_due_back_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored loan fields so the signals can tell when they change on save().
+        instance._loaded_status = instance.__dict__.get('status')
+        instance._loaded_book_id = instance.__dict__.get('book_id')
+        instance._loaded_due_back = instance.__dict__.get('due_back')
+        instance._loaded_borrower_id = instance.__dict__.get('borrower_id')
+        return instance
 
     def __str__(self):
         """String for representing the Model object."""
@@ -51,6 +92,11 @@ class BookInstance(models.Model):
             return True
         return False
 
+    @property
+    def days_overdue(self):
+        """Whole days overdue, for copies fetched with BookInstance.objects.with_overdue()."""
+        return self.overdue_by.days if self.overdue_by else 0
+
 
 class Genre(models.Model):
     """Model representing a book genre."""
@@ -70,6 +116,7 @@ class Author(models.Model):
 
     class Meta:
         ordering = ['last_name', 'first_name']
+        indexes = [models.Index(fields=['last_name', 'first_name', 'id'], name='author_name_idx')]
 
     def get_absolute_url(self):
         """Returns the URL to access a particular author instance."""
@@ -98,6 +145,41 @@ class Book(models.Model):
     genre = models.ManyToManyField(Genre, help_text='Select a genre for this book')
     language = models.ForeignKey('Language', on_delete=models.SET_NULL, null=True)
 
+    # Counts of this book's copies, maintained by catalog.signals and the bulk loan and import code
+    # (see catalog.stats), so lists can show and filter on availability without reading the copies.
+    copies_total = models.IntegerField(default=0, editable=False)
+    copies_available = models.IntegerField(default=0, editable=False)
+    copies_on_loan = models.IntegerField(default=0, editable=False)
+
+    COPY_COUNTER_FIELDS = ('copies_total', 'copies_available', 'copies_on_loan')
+
+    class Meta:
+        # Sort key of BookListView, and the same for its ?available=1 filter.
+        indexes = [
+            models.Index(fields=['title', 'id'], name='book_title_idx'),
+            models.Index(fields=['title', 'id'], condition=models.Q(copies_available__gt=0),
+                         name='book_available_title_idx'),
+            # The admin search ('^title', '=isbn') is a case-insensitive LIKE, which SQLite can only
+            # answer from an index with the NOCASE collation.
+            models.Index(Collate('title', 'NOCASE'), name='book_title_nocase_idx'),
+            models.Index(Collate('isbn', 'NOCASE'), name='book_isbn_nocase_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored author so the signals can also refresh the previous author's page.
+        instance._loaded_author_id = instance.__dict__.get('author_id')
+        return instance
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # The copy counters change with UPDATE ... F() while the book is loaded (e.g. in an edit
+        # form), so saving an existing book must not write back the values it was loaded with.
+        if update_fields is None and not self._state.adding and not force_insert:
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.name not in self.COPY_COUNTER_FIELDS]
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+
     def __str__(self):
         """String for representing the Book object"""
         return self.title
@@ -108,7 +190,8 @@ class Book(models.Model):
 
     def display_genre(self):
         """Create a string for the Genre. This is required to display genre in Admin."""
-        return ', '.join(genre.name for genre in self.genre.all()[:3])
+        # Slice in Python rather than the query, so genres fetched with prefetch_related('genre') are used.
+        return ', '.join(genre.name for genre in list(self.genre.all())[:3])
 
     display_genre.short_description = 'Genre'
 
@@ -121,3 +204,143 @@ class Language(models.Model):
     def __str__(self):
         """String for representing the Model object (in Admin site etc.)"""
         return self.name
+
+
+class LibraryStats(models.Model):
+    """Single-row table of counters shown on the home page, maintained by the signals in catalog.signals."""
+    num_books = models.IntegerField(default=0)
+    num_instances = models.IntegerField(default=0)
+    num_instances_available = models.IntegerField(default=0)
+    num_authors = models.IntegerField(default=0)
+    num_genres = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'library stats'
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.num_books} books, {self.num_instances} copies'
+
+
+class OverdueNotice(models.Model):
+    """Digest row for librarians: one loan found overdue by the sweep_overdue command on a given day."""
+    swept_on = models.DateField()
+    book_instance = models.ForeignKey(BookInstance, on_delete=models.CASCADE)
+    borrower = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    due_back = models.DateField()
+    days_overdue = models.IntegerField()
+
+    class Meta:
+        ordering = ['-swept_on', '-days_overdue']
+        constraints = [
+            models.UniqueConstraint(fields=['swept_on', 'book_instance'], name='overduenotice_unique_per_day'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.book_instance_id} overdue by {self.days_overdue} days on {self.swept_on}'
+
+
+class VisitCount(models.Model):
+    """Home page visits by one visitor (identified by a cookie), written in batches by catalog.visits."""
+    visitor = models.CharField(max_length=36, primary_key=True)
+    count = models.PositiveIntegerField(default=0)
+    last_flushed = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.visitor}: {self.count} visits'
+
+
+class LoanEvent(models.Model):
+    """Append-only history of the copies' loans, written by catalog.circulation on every status change.
+
+    Events are never changed or deleted. The copy, book and borrower are kept as plain ids
+    (no database constraint), so the history outlives them.
+    """
+    LOAN = 'loan'
+    RETURN = 'return'
+    RENEW = 'renew'
+    RESERVE = 'reserve'
+    OVERDUE = 'overdue'
+    STATUS = 'status'
+    KINDS = (
+        (LOAN, 'Loaned'),
+        (RETURN, 'Returned'),
+        (RENEW, 'Renewed'),
+        (RESERVE, 'Reserved'),
+        (OVERDUE, 'Found overdue'),
+        (STATUS, 'Other status change'),
+    )
+
+    occurred_at = models.DateTimeField(default=timezone.now)
+    # The day the event counts towards in the circulation rollups.
+    day = models.DateField(default=date.today)
+    kind = models.CharField(max_length=10, choices=KINDS)
+    book_instance = models.ForeignKey(BookInstance, on_delete=models.DO_NOTHING, db_constraint=False,
+                                      related_name='+')
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+    borrower = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True,
+                                 related_name='+')
+    old_status = models.CharField(max_length=1, blank=True)
+    new_status = models.CharField(max_length=1, blank=True)
+    due_back = models.DateField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [models.Index(fields=['book_instance', 'id'], name='loanevent_copy_idx')]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Loan events cannot be changed.')
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError('Loan events cannot be deleted.')
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.get_kind_display()}: {self.book_instance_id} at {self.occurred_at:%Y-%m-%d %H:%M}'
+
+
+class DailyCirculation(models.Model):
+    """Loans, returns and overdue loans found on one day, summed from the LoanEvents by catalog.circulation."""
+    day = models.DateField()
+    loans = models.IntegerField(default=0)
+    returns = models.IntegerField(default=0)
+    overdues = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class BookCirculation(DailyCirculation):
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['day', 'book'], name='bookcirculation_unique_day')]
+
+
+class GenreCirculation(DailyCirculation):
+    genre = models.ForeignKey(Genre, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['day', 'genre'], name='genrecirculation_unique_day')]
+
+
+class LanguageCirculation(DailyCirculation):
+    language = models.ForeignKey(Language, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['day', 'language'], name='languagecirculation_unique_day')]
+
+
+class RollupWatermark(models.Model):
+    """The last LoanEvent a rollup has processed (see the rollup_circulation command)."""
+    name = models.CharField(max_length=50, primary_key=True)
+    last_event_id = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.name}: up to event {self.last_event_id}'
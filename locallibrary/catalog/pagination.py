@@ -0,0 +1,255 @@
+"""Keyset (cursor) pagination.
+
+Instead of LIMIT/OFFSET plus a COUNT(*), each page is fetched with a WHERE clause that
+continues from the sort key of the last row shown, so any page costs about the same as the
+first one. The position is passed between requests as an opaque cursor token.
+
+List views opt in with CursorPaginationMixin: a request carrying a ``cursor`` parameter
+(an empty one means the first page) is served by CursorPaginator, other requests keep using
+Django's page-number Paginator.
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import F, Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def count_key(queryset):
+    sql, params = queryset.query.sql_with_params()
+    digest = hashlib.md5(f'{queryset.db}:{sql}:{params!r}'.encode(), usedforsecurity=False).hexdigest()
+    return f'catalog:count:{digest}'
+
+
+def cached_count(queryset, timeout=300):
+    """Return queryset.count(), reusing the result for the same SQL for up to timeout seconds."""
+    key = count_key(queryset)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+async def acached_count(queryset, timeout=300):
+    """cached_count() for async views."""
+    key = count_key(queryset)
+    count = await cache.aget(key)
+    if count is None:
+        count = await queryset.acount()
+        await cache.aset(key, count, timeout)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator whose count comes from cached_count(), so paging a large table does not run COUNT(*) for every page.
+
+    The count may be up to count_timeout seconds old. Used by the admin changelists.
+    """
+    count_timeout = 300
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, 'query'):
+            return super().count
+        return cached_count(self.object_list, self.count_timeout)
+
+
+class CursorPage:
+    """One page of a CursorPaginator, with the tokens that lead to its neighbours."""
+    uses_cursor = True
+
+    def __init__(self, object_list, paginator, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f'<CursorPage of {len(self.object_list)} objects>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """Paginate a queryset by a unique sort key.
+
+    ordering is a sequence of local field names (prefix '-' for descending) whose last entry
+    must make the order total, e.g. ('last_name', 'first_name', 'id'). NULLs sort before
+    every value in ascending order and after every value in descending order.
+
+    count is only computed if asked for, and cached for count_timeout seconds.
+    """
+
+    def __init__(self, queryset, per_page, ordering, count_timeout=300):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.count_timeout = count_timeout
+        opts = queryset.model._meta
+        self.ordering = []
+        for name in ordering:
+            descending = name.startswith('-')
+            self.ordering.append((opts.get_field(name.lstrip('-')), descending))
+
+    @cached_property
+    def count(self):
+        return cached_count(self.queryset, self.count_timeout)
+
+    def encode_cursor(self, obj, backwards=False):
+        """Encode the sort key of obj, a model instance or a values() dict, as a cursor token."""
+        if isinstance(obj, dict):
+            values = [obj[field.attname] for field, descending in self.ordering]
+        else:
+            values = [getattr(obj, field.attname) for field, descending in self.ordering]
+        token = json.dumps({'v': values, 'b': backwards}, separators=(',', ':'), cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            token = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            values = token['v']
+            if len(values) != len(self.ordering):
+                raise ValueError
+            values = [None if value is None else field.to_python(value)
+                      for value, (field, descending) in zip(values, self.ordering)]
+            return values, bool(token.get('b'))
+        except (binascii.Error, ValueError, TypeError, KeyError, ValidationError):
+            raise InvalidCursor('Invalid cursor.')
+
+    def _order_by(self, backwards):
+        order_by = []
+        for field, descending in self.ordering:
+            if descending != backwards:
+                order_by.append(F(field.name).desc(nulls_last=True) if field.null else F(field.name).desc())
+            else:
+                order_by.append(F(field.name).asc(nulls_first=True) if field.null else F(field.name).asc())
+        return order_by
+
+    def _after(self, values, backwards):
+        """Build the filter for rows that sort strictly after values (before them if backwards)."""
+        condition = Q(pk__in=[])
+        equal = Q()
+        for (field, descending), value in zip(self.ordering, values):
+            name = field.name
+            if descending != backwards:
+                # NULLs come last: after a value are smaller values and NULLs, after NULL only equal rows.
+                greater = None if value is None else Q(**{f'{name}__lt': value}) | Q(**{f'{name}__isnull': True})
+            else:
+                # NULLs come first: after NULL is every non-NULL value.
+                greater = Q(**{f'{name}__isnull': False}) if value is None else Q(**{f'{name}__gt': value})
+            if greater is not None:
+                condition |= equal & greater
+            equal &= Q(**{f'{name}__isnull': True}) if value is None else Q(**{name: value})
+        # Repeat the bound on the leading column on its own so the database can seek an index to it.
+        (field, descending), value = self.ordering[0], values[0]
+        if value is not None:
+            if descending == backwards:
+                condition &= Q(**{f'{field.name}__gte': value})
+            else:
+                condition &= Q(**{f'{field.name}__lte': value}) | Q(**{f'{field.name}__isnull': True})
+        return condition
+
+    def page(self, cursor=''):
+        """Return the page following (or, for a backwards cursor, preceding) the position in cursor."""
+        queryset, backwards = self._page_queryset(cursor)
+        return self._make_page(list(queryset), cursor, backwards)
+
+    async def apage(self, cursor=''):
+        """page() for async views."""
+        queryset, backwards = self._page_queryset(cursor)
+        return self._make_page([obj async for obj in queryset], cursor, backwards)
+
+    def _page_queryset(self, cursor):
+        """The rows of the page at cursor, plus one to tell whether there are more, and the direction."""
+        backwards = False
+        queryset = self.queryset
+        if cursor:
+            values, backwards = self.decode_cursor(cursor)
+            queryset = queryset.filter(self._after(values, backwards))
+        return queryset.order_by(*self._order_by(backwards))[:self.per_page + 1], backwards
+
+    def _make_page(self, rows, cursor, backwards):
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            has_next, has_previous = bool(rows), has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor) and bool(rows)
+        next_cursor = self.encode_cursor(rows[-1]) if has_next and rows else None
+        previous_cursor = self.encode_cursor(rows[0], backwards=True) if has_previous and rows else None
+        return CursorPage(rows, self, next_cursor, previous_cursor)
+
+
+class CursorPaginationMixin:
+    """Opt-in cursor pagination for ListView subclasses.
+
+    Set cursor_ordering to the view's unique sort key. The queryset is always ordered by it,
+    and requests with a ``cursor`` GET parameter are paginated by CursorPaginator. Set
+    cursor_show_count to show the (cached) total number of rows on those pages.
+    """
+    cursor_ordering = None
+    cursor_kwarg = 'cursor'
+    cursor_count_timeout = 300
+    cursor_show_count = False
+
+    def get_queryset(self):
+        return super().get_queryset().order_by(*self.cursor_ordering)
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.cursor_kwarg not in self.request.GET:
+            paginator, page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+            if page is not None:
+                # Page-number links keep the request's filters too.
+                page.next_query = self.page_query(page.next_page_number()) if page.has_next() else None
+                page.previous_query = self.page_query(page.previous_page_number()) if page.has_previous() else None
+            return paginator, page, object_list, is_paginated
+        paginator = CursorPaginator(queryset, page_size, self.cursor_ordering,
+                                    count_timeout=self.cursor_count_timeout)
+        try:
+            page = paginator.page(self.request.GET[self.cursor_kwarg])
+        except InvalidCursor as e:
+            raise Http404(str(e))
+        page.next_query = self.cursor_query(page.next_cursor)
+        page.previous_query = self.cursor_query(page.previous_cursor)
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def page_query(self, number):
+        """Return the query string for page number, keeping the request's other parameters."""
+        query = self.request.GET.copy()
+        query[self.page_kwarg] = number
+        return f'?{query.urlencode()}'
+
+    def cursor_query(self, cursor):
+        """Return the query string for the page at cursor, keeping the request's other parameters."""
+        if cursor is None:
+            return None
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        query[self.cursor_kwarg] = cursor
+        return f'?{query.urlencode()}'
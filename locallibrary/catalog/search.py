@@ -0,0 +1,173 @@
+"""Full-text search over books, using an SQLite FTS5 index.
+
+The index is the virtual table catalog_book_fts, with one row per book (rowid = Book.id)
+holding the title, summary, author name and genre names. It is created after migrate
+(see CatalogConfig.ready()), kept in sync by the handlers in catalog.signals, and can be
+rebuilt from scratch with the rebuild_search_index management command.
+
+On databases other than SQLite the index is not maintained and search() falls back to
+plain icontains filters.
+"""
+
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+
+from catalog.models import Book
+
+FTS_TABLE = 'catalog_book_fts'
+
+# bm25() weights for the indexed columns: title, summary, author, genres.
+COLUMN_WEIGHTS = (10.0, 1.0, 5.0, 2.0)
+
+# Number of books (re)indexed per statement, kept well below SQLite's bound-parameter limit.
+CHUNK_SIZE = 500
+
+
+def is_supported(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'sqlite'
+
+
+def create_index(using=DEFAULT_DB_ALIAS):
+    """Create the FTS5 table if it does not exist yet."""
+    if not is_supported(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} '
+            "USING fts5(title, summary, author, genres, tokenize='unicode61 remove_diacritics 2')"
+        )
+
+
+def drop_index(using=DEFAULT_DB_ALIAS):
+    if not is_supported(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def remove_books(book_ids, using=DEFAULT_DB_ALIAS):
+    """Delete the index rows of the given books."""
+    if not is_supported(using):
+        return
+    with connections[using].cursor() as cursor:
+        for chunk in _chunks(book_ids):
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', chunk)
+
+
+def index_books(book_ids, using=DEFAULT_DB_ALIAS):
+    """(Re)index the given books. Ids of books that no longer exist are just removed from the index."""
+    if not is_supported(using):
+        return
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        for chunk in _chunks(book_ids):
+            remove_books(chunk, using=using)
+            books = Book.objects.using(using).filter(pk__in=chunk).select_related('author').prefetch_related('genre')
+            rows = [
+                (book.pk, book.title, book.summary,
+                 f'{book.author.first_name} {book.author.last_name}' if book.author else '',
+                 ' '.join(genre.name for genre in book.genre.all()))
+                for book in books
+            ]
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, summary, author, genres) VALUES (%s, %s, %s, %s, %s)',
+                rows,
+            )
+
+
+def rebuild_index(batch_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS):
+    """Recreate the index and fill it in batches of books. Returns the number of books indexed.
+
+    All in one transaction: searches keep using the old index until the new one is complete,
+    and a failed rebuild leaves the old index in place.
+    """
+    indexed = 0
+    last_pk = 0
+    with transaction.atomic(using=using):
+        drop_index(using)
+        create_index(using)
+        while True:
+            batch = list(Book.objects.using(using).filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                break
+            index_books(batch, using=using)
+            indexed += len(batch)
+            last_pk = batch[-1]
+        with connections[using].cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+def build_match_expression(text):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix.
+
+    Words are quoted so that FTS5 operators and punctuation in the input are taken literally.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return ''
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+class SearchResults:
+    """Lazily evaluated, ranked search results that can be passed to a Paginator.
+
+    Slicing fetches just that page of book ids from the index (best match first) and then
+    loads those books, with their authors, in one query.
+    """
+
+    def __init__(self, match, using=DEFAULT_DB_ALIAS):
+        self.match = match
+        self.using = using
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            with connections[self.using].cursor() as cursor:
+                cursor.execute(f'SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [self.match])
+                self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice) or k.step is not None:
+            raise TypeError('SearchResults only supports slicing without a step.')
+        offset = k.start or 0
+        limit = -1 if k.stop is None else max(k.stop - offset, 0)
+        weights = ', '.join(str(weight) for weight in COLUMN_WEIGHTS)
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                f'ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s OFFSET %s',
+                [self.match, limit, offset],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        books = Book.objects.using(self.using).select_related('author').in_bulk(ids)
+        return [books[pk] for pk in ids if pk in books]
+
+
+def search(text, using=DEFAULT_DB_ALIAS):
+    """Return the books matching text, best match first, as a sliceable sequence."""
+    match = build_match_expression(text)
+    if not match:
+        return Book.objects.none()
+    if is_supported(using):
+        return SearchResults(match, using=using)
+    query = Q()
+    for word in re.findall(r'\w+', text):
+        query &= (Q(title__icontains=word) | Q(summary__icontains=word) | Q(author__first_name__icontains=word)
+                  | Q(author__last_name__icontains=word) | Q(genre__name__icontains=word))
+    return Book.objects.using(using).filter(query).select_related('author').distinct().order_by('title')
@@ -0,0 +1,185 @@
+"""Signal handlers that keep derived data in step with the catalog models.
+
+Connected in CatalogConfig.ready(). Note that QuerySet.update() and bulk_create() do not
+send these signals, so code using them must adjust the derived data itself.
+"""
+
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from catalog import backends, caching, circulation, search, stats
+from catalog.models import Author, Book, BookInstance, Genre, Language, User
+
+
+def _author_versions(*author_ids):
+    return [f'author:{pk}' for pk in set(author_ids) if pk is not None]
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, created, using, **kwargs):
+    if created:
+        stats.adjust(num_books=1)
+    search.index_books([instance.pk], using=using)
+    caching.bump(f'book:{instance.pk}', 'books',
+                 *_author_versions(instance.author_id, getattr(instance, '_loaded_author_id', None)))
+    instance._loaded_author_id = instance.author_id
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, using, **kwargs):
+    stats.adjust(num_books=-1)
+    search.remove_books([instance.pk], using=using)
+    caching.bump(f'book:{instance.pk}', 'books',
+                 *_author_versions(instance.author_id, getattr(instance, '_loaded_author_id', None)))
+
+
+@receiver(m2m_changed, sender=Book.genre.through)
+def book_genres_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # genre.book_set.clear(): remember the books, pk_set is not given for clears.
+        instance._book_ids = list(instance.book_set.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            book_ids = [instance.pk]
+        elif action == 'post_clear':
+            book_ids = getattr(instance, '_book_ids', [])
+        else:
+            book_ids = pk_set
+        search.index_books(book_ids, using=using)
+        caching.bump('book-genres', *[f'book:{pk}' for pk in book_ids])
+
+
+@receiver(post_save, sender=Author)
+def author_saved(sender, instance, created, using, **kwargs):
+    if created:
+        stats.adjust(num_authors=1)
+        caching.bump('authors')
+    else:
+        # The author's name appears on their books' pages and in the book list.
+        book_ids = list(instance.book_set.values_list('pk', flat=True))
+        search.index_books(book_ids, using=using)
+        caching.bump(f'author:{instance.pk}', 'authors', 'books', *[f'book:{pk}' for pk in book_ids])
+
+
+@receiver(pre_delete, sender=Author)
+def author_deleting(sender, instance, **kwargs):
+    # The books' author is set to NULL without signals, so remember which books are affected.
+    instance._book_ids = list(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+def author_deleted(sender, instance, using, **kwargs):
+    stats.adjust(num_authors=-1)
+    book_ids = getattr(instance, '_book_ids', [])
+    search.index_books(book_ids, using=using)
+    caching.bump(f'author:{instance.pk}', 'authors', 'books', *[f'book:{pk}' for pk in book_ids])
+
+
+@receiver(post_save, sender=Genre)
+def genre_saved(sender, instance, created, using, **kwargs):
+    if created:
+        stats.adjust(num_genres=1)
+    else:
+        search.index_books(instance.book_set.values_list('pk', flat=True), using=using)
+        caching.bump('taxonomy')
+
+
+@receiver(pre_delete, sender=Genre)
+def genre_deleting(sender, instance, **kwargs):
+    # The book/genre links are deleted without m2m_changed, so remember which books to reindex.
+    instance._book_ids = list(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Genre)
+def genre_deleted(sender, instance, using, **kwargs):
+    stats.adjust(num_genres=-1)
+    search.index_books(getattr(instance, '_book_ids', []), using=using)
+    caching.bump('taxonomy')
+
+
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+def language_changed(sender, instance, **kwargs):
+    caching.bump('taxonomy')
+
+
+@receiver(post_save, sender=BookInstance)
+def bookinstance_saved(sender, instance, created, **kwargs):
+    old_status = None if created else getattr(instance, '_loaded_status', instance.status)
+    old_book_id = None if created else getattr(instance, '_loaded_book_id', instance.book_id)
+    was_available = old_status == 'a'
+    is_available = instance.status == 'a'
+    stats.adjust(
+        num_instances=1 if created else 0,
+        num_instances_available=int(is_available) - int(was_available),
+    )
+    if created or old_status != instance.status or old_book_id != instance.book_id:
+        # Move the copy from the counters of its old status (and book) to the new ones.
+        if not created:
+            stats.adjust_book(old_book_id, **stats.copy_deltas(old_status, -1))
+        stats.adjust_book(instance.book_id, **stats.copy_deltas(instance.status))
+        caching.bump('availability')
+    caching.bump_books([instance.book_id, old_book_id])
+
+    # Append the change to the loan history (a renewal if the copy stays on loan with a new due date).
+    if created:
+        # A copy saved already on loan (e.g. from the admin) is a real loan, unlike bulk imports.
+        if instance.status in ('o', 'r'):
+            circulation.record([circulation.make_event(instance.pk, instance.book_id, '', instance.status,
+                                                       instance.borrower_id, instance.due_back)])
+    elif old_status != instance.status or (
+            instance.status == 'o' and getattr(instance, '_loaded_due_back', instance.due_back) != instance.due_back):
+        borrower_id = instance.borrower_id or getattr(instance, '_loaded_borrower_id', None)
+        circulation.record([circulation.make_event(instance.pk, instance.book_id, old_status, instance.status,
+                                                   borrower_id, instance.due_back)])
+    instance._loaded_status = instance.status
+    instance._loaded_book_id = instance.book_id
+    instance._loaded_due_back = instance.due_back
+    instance._loaded_borrower_id = instance.borrower_id
+
+
+@receiver(post_delete, sender=BookInstance)
+def bookinstance_deleted(sender, instance, **kwargs):
+    status = getattr(instance, '_loaded_status', instance.status)
+    book_id = getattr(instance, '_loaded_book_id', instance.book_id)
+    stats.adjust(
+        num_instances=-1,
+        num_instances_available=-1 if status == 'a' else 0,
+    )
+    stats.adjust_book(book_id, **stats.copy_deltas(status, -1))
+    caching.bump('availability')
+    caching.bump_books([book_id])
+
+
+# Permission sets cached by catalog.backends.CachedPermissionBackend.
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # is_active and is_superuser change what the user may do.
+    caching.bump(backends.user_version(instance.pk))
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def user_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        caching.bump(backends.user_version(instance.pk))
+    elif action == 'post_clear':
+        # permission.user_set.clear() or group.user_set.clear(): the users are not given.
+        caching.bump(backends.PERMISSIONS_VERSION)
+    else:
+        caching.bump(*[backends.user_version(pk) for pk in pk_set])
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def permissions_changed(sender, action=None, **kwargs):
+    if action is None or action.startswith('post_'):
+        caching.bump(backends.PERMISSIONS_VERSION)
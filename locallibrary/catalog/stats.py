@@ -0,0 +1,157 @@
+"""Maintained record counts.
+
+The home page counters live in the single LibraryStats row, and the copy counters of each
+book (Book.copies_total, copies_available, copies_on_loan) on the book. Both are kept up to
+date by the signal handlers in catalog.signals. rebuild() recomputes the home page counters
+from the real tables (see the rebuild_stats command), and recount_books() and
+reconcile_books() do the same for the book counters (see the reconcile_copy_counts command).
+"""
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from catalog.database import primary_reads
+from catalog.models import Author, Book, BookInstance, Genre, LibraryStats
+
+STATS_PK = 1
+CACHE_KEY = 'catalog:library-stats'
+CACHE_TIMEOUT = 60
+
+COUNTER_FIELDS = (
+    'num_books',
+    'num_instances',
+    'num_instances_available',
+    'num_authors',
+    'num_genres',
+)
+
+
+def count_from_tables():
+    """Count the records directly (the five COUNT(*) queries the stats row replaces)."""
+    return {
+        'num_books': Book.objects.count(),
+        'num_instances': BookInstance.objects.count(),
+        'num_instances_available': BookInstance.objects.filter(status__exact='a').count(),
+        'num_authors': Author.objects.count(),
+        'num_genres': Genre.objects.count(),
+    }
+
+
+def get_stats():
+    """Return the counters as a dict, from the cache if possible, otherwise from the stats row."""
+    stats = cache.get(CACHE_KEY)
+    if stats is None:
+        # Read from the primary, as the counters are cached for everyone (see catalog.database).
+        with primary_reads():
+            row = LibraryStats.objects.filter(pk=STATS_PK).values(*COUNTER_FIELDS).first()
+            stats = row if row is not None else rebuild()[0]
+        cache.set(CACHE_KEY, stats, CACHE_TIMEOUT)
+    return stats
+
+
+def adjust(**deltas):
+    """Apply relative changes to the counters, e.g. adjust(num_books=1), in a single UPDATE."""
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    updated = LibraryStats.objects.filter(pk=STATS_PK).update(
+        **{name: F(name) + delta for name, delta in deltas.items()}
+    )
+    if not updated:
+        # No stats row yet: build it from the tables, which already include this change.
+        rebuild()
+        return
+    transaction.on_commit(invalidate)
+
+
+def invalidate():
+    cache.delete(CACHE_KEY)
+
+
+def rebuild():
+    """Recount everything and overwrite the stats row.
+
+    Returns a (counts, drift) tuple, where drift maps each counter that was wrong
+    to its (stored, actual) values.
+    """
+    counts = count_from_tables()
+    with transaction.atomic():
+        row, created = LibraryStats.objects.select_for_update().get_or_create(pk=STATS_PK, defaults=counts)
+        drift = {}
+        if not created:
+            for name in COUNTER_FIELDS:
+                if getattr(row, name) != counts[name]:
+                    drift[name] = (getattr(row, name), counts[name])
+                    setattr(row, name, counts[name])
+            if drift:
+                row.save(update_fields=list(drift))
+    transaction.on_commit(invalidate)
+    return counts, drift
+
+
+def copy_deltas(status, sign=1):
+    """The changes to a book's copy counters for adding (sign=1) or removing (sign=-1) a copy with status."""
+    return {
+        'copies_total': sign,
+        'copies_available': sign if status == 'a' else 0,
+        'copies_on_loan': sign if status == 'o' else 0,
+    }
+
+
+def adjust_book(book_id, **deltas):
+    """Apply relative changes to a book's copy counters, e.g. adjust_book(1, copies_total=1), in a single UPDATE."""
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if book_id is None or not deltas:
+        return
+    Book.objects.filter(pk=book_id).update(**{name: F(name) + delta for name, delta in deltas.items()})
+
+
+def _copy_count(**filters):
+    copies = (BookInstance.objects.filter(book=OuterRef('pk'), **filters).order_by()
+              .values('book').annotate(count=Count('pk')).values('count'))
+    return Coalesce(Subquery(copies, output_field=IntegerField()), Value(0))
+
+
+def counted_copies():
+    """The copy counters of each book as computed from the copies table, for annotate() or update()."""
+    return {
+        'copies_total': _copy_count(),
+        'copies_available': _copy_count(status__exact='a'),
+        'copies_on_loan': _copy_count(status__exact='o'),
+    }
+
+
+def recount_books(book_ids):
+    """Recompute the copy counters of the given books from the copies table, in a single UPDATE.
+
+    Used after bulk operations that bypass the signals (QuerySet.update(), bulk_create()).
+    """
+    book_ids = {pk for pk in book_ids if pk is not None}
+    if book_ids:
+        Book.objects.filter(pk__in=book_ids).update(**counted_copies())
+
+
+def reconcile_books(batch_size=2000):
+    """Compare every book's copy counters with the copies table and repair the ones that have drifted.
+
+    Books are checked in batches of batch_size. Returns a list of (book_id, stored, actual)
+    tuples, where stored and actual are (total, available, on_loan).
+    """
+    fields = Book.COPY_COUNTER_FIELDS
+    actual = {f'actual_{name}': expression for name, expression in counted_copies().items()}
+    drift = []
+    last_pk = 0
+    while True:
+        batch = list(Book.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return drift
+        last_pk = batch[-1]
+        rows = (Book.objects.filter(pk__in=batch).annotate(**actual)
+                .filter(~Q(**{name: F(f'actual_{name}') for name in fields}))
+                .values_list('pk', *fields, *actual))
+        drifted = [(row[0], row[1:4], row[4:7]) for row in rows]
+        if drifted:
+            recount_books(pk for pk, stored, counted in drifted)
+            drift.extend(drifted)
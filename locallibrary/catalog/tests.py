@@ -1,3 +1,1644 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import uuid
+import time
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import F, QuerySet
+from django.http import HttpResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.http import http_date
+from django.views import generic
+
+from catalog import api, benchmark, caching, circulation, database, facets, loans, search, stats, views, visits
+from catalog.generator import GENRES, LANGUAGES, LibraryGenerator
+from catalog.admin import BookAdmin, CappedInlineFormSet
+from catalog.middleware import ReplicaRoutingMiddleware
+from catalog.pagination import CursorPaginator
+from catalog.models import (Author, Book, BookCirculation, BookInstance, Genre, Language, LibraryStats, LoanEvent,
+                            OverdueNotice, User, VisitCount)
+
+
+class LibraryStatsTests(TestCase):
+    """The home page counters follow inserts, deletes and status changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.author = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+        self.book = Book.objects.create(title='The Dispossessed', author=self.author,
+                                        summary='Anarres and Urras.', isbn='9780060512750')
+        Genre.objects.create(name='Science Fiction')
+
+    def assertStatsMatchTables(self):
+        row = LibraryStats.objects.values(*stats.COUNTER_FIELDS).get()
+        self.assertEqual(row, stats.count_from_tables())
+
+    def test_counters_follow_creates_and_deletes(self):
+        copy = BookInstance.objects.create(book=self.book, imprint='Harper', status='a')
+        BookInstance.objects.create(book=self.book, imprint='Harper', status='o')
+        self.assertStatsMatchTables()
+        copy.delete()
+        self.assertStatsMatchTables()
+
+    def test_counters_follow_status_changes(self):
+        copy = BookInstance.objects.create(book=self.book, imprint='Harper', status='m')
+        copy = BookInstance.objects.get(pk=copy.pk)
+        copy.status = 'a'
+        copy.save()
+        self.assertEqual(LibraryStats.objects.get().num_instances_available, 1)
+        copy.imprint = 'Gollancz'
+        copy.save()
+        self.assertEqual(LibraryStats.objects.get().num_instances_available, 1)
+        copy.status = 'o'
+        copy.save()
+        self.assertStatsMatchTables()
+
+    def test_rebuild_reports_drift(self):
+        LibraryStats.objects.update(num_books=42)
+        out = StringIO()
+        call_command('rebuild_stats', stdout=out)
+        self.assertIn('num_books: stored 42, actual 1', out.getvalue())
+        self.assertStatsMatchTables()
+
+    def test_index_reads_stats_row(self):
+        stats.get_stats()
+        with self.assertNumQueries(0):
+            stats.get_stats()
+        with mock.patch.object(visits, 'buffer', visits.VisitBuffer()):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['num_books'], 1)
+        self.assertEqual(response.context['num_authors'], 1)
+        self.assertEqual(response.context['num_genres'], 1)
+
+
+class QueryBudgetTests(TestCase):
+    """List and detail views run a fixed number of queries however many rows they show."""
+
+    def setUp(self):
+        self.language = Language.objects.create(name='English')
+        self.genres = [Genre.objects.create(name=name) for name in ('Fantasy', 'Horror')]
+        self.author = Author.objects.create(first_name='Mary', last_name='Shelley')
+        self.librarian = User.objects.create(username='librarian')
+        self.librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        self.client.force_login(self.librarian)
+        self.book = self.add_books(1)[0]
+
+    def add_books(self, count):
+        """Add books by the author, each with genres and copies on loan to the librarian and another borrower."""
+        books = []
+        for i in range(count):
+            n = Book.objects.count()
+            book = Book.objects.create(title=f'Book {n}', author=self.author, summary='Summary',
+                                       isbn=f'{n:013d}', language=self.language)
+            book.genre.set(self.genres)
+            self.add_copies(book, User.objects.create(username=f'borrower{n}'))
+            books.append(book)
+        return books
+
+    def add_copies(self, book, borrower):
+        due_back = datetime.date.today()
+        BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.librarian, due_back=due_back)
+        BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=borrower, due_back=due_back)
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url):
+        before = self.count_queries(url)
+        self.add_books(4)
+        self.add_copies(self.book, User.objects.create(username='another'))
+        self.assertEqual(self.count_queries(url), before)
+
+    def test_book_list(self):
+        self.assertConstantQueries(reverse('books'))
+
+    def test_book_detail(self):
+        self.assertConstantQueries(self.book.get_absolute_url())
+
+    def test_author_detail(self):
+        self.assertConstantQueries(self.author.get_absolute_url())
+
+    def test_my_borrowed(self):
+        self.assertConstantQueries(reverse('my-borrowed'))
+
+    def test_all_borrowed(self):
+        self.assertConstantQueries(reverse('all-borrowed'))
+
+
+class SearchTests(TestCase):
+    """The FTS5 index follows book, author and genre changes and ranks title matches first."""
+
+    def setUp(self):
+        self.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        self.dune = Book.objects.create(title='Dune', author=self.author, isbn='9780441013593',
+                                        summary='A desert planet and its spice.')
+        self.other = Book.objects.create(title='Arrakis Tales', author=None, isbn='9780000000001',
+                                         summary='Stories set near the dune seas.')
+        self.genre = Genre.objects.create(name='Science Fiction')
+
+    def titles(self, text):
+        return [book.title for book in search.search(text)[:10]]
+
+    def test_ranks_title_matches_first(self):
+        self.assertEqual(self.titles('dune'), ['Dune', 'Arrakis Tales'])
+
+    def test_prefix_and_all_words(self):
+        self.assertEqual(self.titles('desert pla'), ['Dune'])
+        self.assertEqual(self.titles('desert tales'), [])
+
+    def test_operators_are_literal(self):
+        self.assertEqual(self.titles('NEAR(dune'), ['Arrakis Tales'])
+        self.assertEqual(self.titles('*'), [])
+
+    def test_index_follows_related_changes(self):
+        self.dune.genre.add(self.genre)
+        self.assertEqual(self.titles('science fiction'), ['Dune'])
+        self.genre.name = 'Space Opera'
+        self.genre.save()
+        self.assertEqual(self.titles('science'), [])
+        self.assertEqual(self.titles('opera'), ['Dune'])
+        self.genre.delete()
+        self.assertEqual(self.titles('opera'), [])
+
+        self.author.last_name = 'Herbertson'
+        self.author.save()
+        self.assertEqual(self.titles('herbertson'), ['Dune'])
+        self.author.delete()
+        self.assertEqual(self.titles('herbertson'), [])
+
+        self.other.delete()
+        self.assertEqual(self.titles('dune'), ['Dune'])
+
+    def test_rebuild_command(self):
+        search.drop_index()
+        search.create_index()
+        self.assertEqual(self.titles('dune'), [])
+        call_command('rebuild_search_index', batch_size=1, stdout=StringIO())
+        self.assertEqual(self.titles('dune'), ['Dune', 'Arrakis Tales'])
+
+    def test_failed_rebuild_keeps_old_index(self):
+        with mock.patch.object(search, 'index_books', side_effect=OperationalError('disk I/O error')):
+            with self.assertRaises(OperationalError):
+                search.rebuild_index()
+        self.assertEqual(self.titles('dune'), ['Dune', 'Arrakis Tales'])
+
+    def test_search_view_paginates(self):
+        for n in range(12):
+            Book.objects.create(title=f'Dune sequel {n}', author=self.author, isbn=f'{n:013d}', summary='More spice.')
+        response = self.client.get(reverse('book-search'), {'q': 'spice'})
+        self.assertEqual(response.context['page_obj'].paginator.count, 13)
+        self.assertEqual(len(response.context['book_list']), 10)
+        response = self.client.get(reverse('book-search'), {'q': 'spice', 'page': 2})
+        self.assertEqual(len(response.context['book_list']), 3)
+
+
+class CursorPaginationTests(TestCase):
+    """Walking the cursor pages forwards and backwards visits every row once, in order."""
+
+    def setUp(self):
+        for i in range(23):
+            # Repeated names and dates exercise the tie-breaking columns, missing dates the NULL handling.
+            Author.objects.create(first_name=f'First {i % 3}', last_name=f'Last {i % 5}')
+        book = Book.objects.create(title='Book', summary='Summary', isbn='9780000000000')
+        for i in range(17):
+            due_back = None if i % 6 == 0 else datetime.date.today() + datetime.timedelta(days=i % 4)
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', due_back=due_back)
+
+    def walk(self, queryset, ordering, per_page=4):
+        paginator = CursorPaginator(queryset, per_page, ordering)
+        pages = [paginator.page('')]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor))
+        forwards = [obj.pk for page in pages for obj in page]
+        backwards = []
+        page = pages[-1]
+        while page.has_previous():
+            page = paginator.page(page.previous_cursor)
+            backwards[:0] = [obj.pk for obj in page]
+        self.assertEqual(backwards, forwards[:len(backwards)])
+        self.assertEqual(len(backwards) + len(pages[-1]), len(forwards))
+        return forwards
+
+    def test_authors(self):
+        ordering = ('last_name', 'first_name', 'id')
+        expected = list(Author.objects.order_by(*ordering).values_list('pk', flat=True))
+        self.assertEqual(self.walk(Author.objects.all(), ordering), expected)
+        descending = ('-last_name', 'first_name', '-id')
+        expected = list(Author.objects.order_by(*descending).values_list('pk', flat=True))
+        self.assertEqual(self.walk(Author.objects.all(), descending), expected)
+
+    def test_loans_with_null_dates(self):
+        ordering = ('due_back', 'id')
+        expected = list(BookInstance.objects.order_by(F('due_back').asc(nulls_first=True), 'id')
+                        .values_list('pk', flat=True))
+        self.assertEqual(self.walk(BookInstance.objects.all(), ordering, per_page=5), expected)
+        expected = list(BookInstance.objects.order_by(F('due_back').desc(nulls_last=True), 'id')
+                        .values_list('pk', flat=True))
+        self.assertEqual(self.walk(BookInstance.objects.all(), ('-due_back', 'id'), per_page=5), expected)
+
+    def test_view_cursor_mode(self):
+        response = self.client.get(reverse('authors'), {'cursor': ''})
+        page = response.context['page_obj']
+        self.assertEqual(len(page), 10)
+        self.assertContains(response, '23 in total.')
+        response = self.client.get(reverse('authors') + page.next_query)
+        self.assertEqual(len(response.context['page_obj']), 10)
+        self.assertTrue(response.context['page_obj'].has_previous())
+        self.assertEqual(self.client.get(reverse('authors'), {'cursor': 'not-a-cursor'}).status_code, 404)
+        # Without a cursor parameter the numbered pages still work.
+        response = self.client.get(reverse('authors'), {'page': 3})
+        self.assertEqual(response.context['page_obj'].number, 3)
+
+    def test_deep_pages_cost_the_same(self):
+        cache.clear()
+        paginator = CursorPaginator(Author.objects.all(), 2, ('last_name', 'first_name', 'id'))
+        with self.assertNumQueries(1):
+            page = paginator.page('')
+        while page.has_next():
+            with self.assertNumQueries(1):
+                page = paginator.page(page.next_cursor)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific.')
+class LoanIndexPlanTests(TestCase):
+    """The list views' queries are answered from indexes, without table scans or temporary sorts."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='borrower')
+        self.factory = RequestFactory()
+
+    def setup_view(self, view_class, params=None):
+        request = self.factory.get('/', params)
+        request.user = self.user
+        view = view_class()
+        view.setup(request)
+        return view
+
+    def view_queryset(self, view_class, cursor_after=None, params=None):
+        view = self.setup_view(view_class, params)
+        queryset = view.get_queryset()
+        paginator = CursorPaginator(queryset, view.paginate_by, view.cursor_ordering)
+        if cursor_after is not None:
+            queryset = queryset.filter(paginator._after(cursor_after, False))
+        return queryset.order_by(*paginator._order_by(False))[:view.paginate_by + 1]
+
+    def assertIndexedPages(self, view_class, params=None):
+        """Check the queries of page-number pagination: the count, and a page reached by OFFSET."""
+        view = self.setup_view(view_class, params)
+        queryset = view.get_queryset()
+        self.assertIndexedPlan(queryset[view.paginate_by * 4:view.paginate_by * 5])
+        if queryset.query.where:
+            # Counting a whole table reads every row whichever way it goes; a filtered count must not.
+            with CaptureQueriesContext(connection) as queries:
+                queryset.count()
+            self.assertIndexedPlan(queries[0]['sql'])
+
+    def assertIndexedPlan(self, queryset):
+        # A queryset, or the SQL of a query that already ran (with its parameters inlined).
+        sql, params = (queryset, ()) if isinstance(queryset, str) else queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        for step in plan:
+            self.assertNotIn('TEMP B-TREE', step, plan)
+            # "SCAN table" walks the whole table; "SCAN table USING INDEX" is an ordered index walk under LIMIT.
+            self.assertIsNone(re.match(r'SCAN \w+$', step), plan)
+
+    def test_all_borrowed(self):
+        self.assertIndexedPlan(self.view_queryset(views.AllLoanedBooksListView))
+        self.assertIndexedPlan(self.view_queryset(views.AllLoanedBooksListView,
+                                                  [datetime.date.today(), BookInstance().id]))
+        self.assertIndexedPlan(self.view_queryset(views.AllLoanedBooksListView, params={'overdue': '1'}))
+
+    def test_my_borrowed(self):
+        self.assertIndexedPlan(self.view_queryset(views.LoanedBooksByUserListView))
+        self.assertIndexedPlan(self.view_queryset(views.LoanedBooksByUserListView,
+                                                  [datetime.date.today(), BookInstance().id]))
+
+    def test_book_and_author_lists(self):
+        self.assertIndexedPlan(self.view_queryset(views.BookListView))
+        self.assertIndexedPlan(self.view_queryset(views.BookListView, ['Dune', 1]))
+        self.assertIndexedPlan(self.view_queryset(views.AuthorListView))
+        self.assertIndexedPlan(self.view_queryset(views.AuthorListView, ['Herbert', 'Frank', 1]))
+
+    def test_page_numbers(self):
+        self.assertIndexedPages(views.AllLoanedBooksListView)
+        self.assertIndexedPages(views.AllLoanedBooksListView, {'overdue': '1'})
+        self.assertIndexedPages(views.LoanedBooksByUserListView)
+        self.assertIndexedPages(views.BookListView)
+        self.assertIndexedPages(views.BookListView, {'available': '1'})
+        self.assertIndexedPages(views.AuthorListView)
+
+    def test_default_bookinstance_ordering(self):
+        self.assertIndexedPlan(BookInstance.objects.all()[:100])
+
+    def test_admin_book_search(self):
+        model_admin = BookAdmin(Book, admin.site)
+        queryset, may_have_duplicates = model_admin.get_search_results(self.factory.get('/'), Book.objects.all(),
+                                                                       'dune')
+        self.assertIndexedPlan(queryset)
+
+
+class ImportCatalogTests(TestCase):
+    """import_catalog creates and updates books in batches and keeps derived data current."""
+
+    def import_file(self, suffix, content, *args):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('import_catalog', f.name, *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv(self):
+        out = self.import_file('.csv', (
+            'title,isbn,summary,author_first_name,author_last_name,language,genre,copies,imprint,status\n'
+            'Dune,9780441013593,Spice.,Frank,Herbert,English,Science Fiction;Adventure,3,Ace,a\n'
+            'Children of Dune,9780441104024,More spice.,Frank,Herbert,English,Science Fiction,1,Ace,o\n'
+            ',,No title or ISBN,,,,,,,\n'
+        ), '--batch-size', '1')
+        self.assertIn('Imported 2 books and 4 copies from 3 rows (1 skipped)', out)
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(Genre.objects.count(), 2)
+        dune = Book.objects.get(isbn='9780441013593')
+        self.assertEqual(dune.author.last_name, 'Herbert')
+        self.assertEqual(dune.language.name, 'English')
+        self.assertEqual(sorted(genre.name for genre in dune.genre.all()), ['Adventure', 'Science Fiction'])
+        self.assertEqual(dune.bookinstance_set.filter(status='a').count(), 3)
+        self.assertEqual((dune.copies_total, dune.copies_available, dune.copies_on_loan), (3, 3, 0))
+        self.assertEqual(Book.objects.get(isbn='9780441104024').copies_on_loan, 1)
+        self.assertEqual(stats.get_stats()['num_instances_available'], 3)
+        self.assertEqual([book.title for book in search.search('herbert')[:10]], ['Dune', 'Children of Dune'])
+
+    def test_jsonl_upserts_on_isbn(self):
+        Book.objects.create(title='Old title', isbn='9780441013593', summary='Old.')
+        self.import_file('.jsonl', '\n'.join(json.dumps(record) for record in [
+            {'title': 'Dune', 'isbn': '9780441013593', 'summary': 'Spice.', 'genre': ['Science Fiction']},
+            {'title': 'Dune', 'isbn': '9780441013593', 'summary': 'Spice!', 'copies': 2},
+        ]))
+        dune = Book.objects.get()
+        self.assertEqual((dune.title, dune.summary), ('Dune', 'Spice!'))
+        self.assertEqual(dune.bookinstance_set.count(), 2)
+
+    def test_bad_status(self):
+        with self.assertRaisesMessage(CommandError, "unknown status 'x'"):
+            self.import_file('.jsonl', json.dumps({'title': 'Dune', 'isbn': '1', 'copies': 1, 'status': 'x'}))
+        self.assertFalse(Book.objects.exists())
+
+
+class ApiTests(TestCase):
+    """The JSON list endpoints filter and page with cursors; the export streams NDJSON."""
+
+    def setUp(self):
+        self.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        self.genre = Genre.objects.create(name='Science Fiction')
+        for n in range(5):
+            book = Book.objects.create(title=f'Dune {n}', author=self.author if n % 2 else None,
+                                       summary='Spice.', isbn=f'{n:013d}')
+            book.genre.add(self.genre)
+            BookInstance.objects.create(book=book, imprint='Ace', status='o', due_back=datetime.date(2030, 1, n + 1))
+
+    def test_list_pages_and_filters(self):
+        url = reverse('api-list', args=['books'])
+        response = self.client.get(url, {'limit': 2})
+        data = response.json()
+        self.assertEqual([row['title'] for row in data['results']], ['Dune 0', 'Dune 1'])
+        data = self.client.get(data['next']).json()
+        self.assertEqual([row['title'] for row in data['results']], ['Dune 2', 'Dune 3'])
+        data = self.client.get(data['next']).json()
+        self.assertEqual(([row['title'] for row in data['results']], data['next']), (['Dune 4'], None))
+
+        data = self.client.get(url, {'author': self.author.pk, 'genre': self.genre.pk}).json()
+        self.assertEqual([row['title'] for row in data['results']], ['Dune 1', 'Dune 3'])
+        self.assertEqual(self.client.get(url, {'author': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'limit': 0}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api-list', args=['users'])).status_code, 404)
+
+    def test_copies_filter_on_dates(self):
+        data = self.client.get(reverse('api-list', args=['copies']), {'due_before': '2030-01-03'}).json()
+        self.assertEqual(sorted(row['due_back'] for row in data['results']), ['2030-01-01', '2030-01-02'])
+        self.assertNotIn('borrower_id', data['results'][0])
+        self.assertEqual(self.client.get(reverse('api-list', args=['copies']), {'due_before': 'soon'}).status_code, 400)
+
+    def test_export_streams_every_row(self):
+        response = self.client.get(reverse('api-export', args=['copies']))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['imprint'], 'Ace')
+        response = self.client.get(reverse('api-export', args=['book-genres']), {'genre': self.genre.pk})
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 5)
+
+    def test_availability(self):
+        book = Book.objects.get(isbn=f'{1:013d}')
+        BookInstance.objects.create(book=book, imprint='Ace', status='a')
+        BookInstance.objects.create(book=book, imprint='Ace', status='o', due_back=datetime.date(2029, 12, 1))
+        url = reverse('api-availability')
+        response = self.client.post(url, {'isbns': ['000-0000000-00-1', f'{2:013d}', 'unknown', f'{2:013d}']},
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {
+            'results': {
+                f'{1:013d}': {'total': 3, 'available': 1, 'on_loan': 2, 'next_due_back': '2029-12-01'},
+                f'{2:013d}': {'total': 1, 'available': 0, 'on_loan': 1, 'next_due_back': '2030-01-03'},
+            },
+            'not_found': ['unknown'],
+        })
+        data = self.client.post(url, {'isbn': [f'{3:013d}']}).json()
+        self.assertEqual(data['results'][f'{3:013d}']['on_loan'], 1)
+
+    def test_availability_queries_in_chunks(self):
+        isbns = [f'{n:013d}' for n in range(api.ISBN_CHUNK_SIZE * 2 + 1)]
+        with self.assertNumQueries(3):
+            response = self.client.post(reverse('api-availability'), {'isbns': isbns}, content_type='application/json')
+        data = response.json()
+        self.assertEqual(len(data['results']), 5)
+        self.assertEqual(len(data['not_found']), len(isbns) - 5)
+
+    def test_availability_rejects_bad_requests(self):
+        url = reverse('api-availability')
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.client.post(url, 'nope', content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post(url, {'isbns': [1]}, content_type='application/json').status_code, 400)
+        too_many = {'isbns': [str(n) for n in range(api.MAX_ISBNS + 1)]}
+        self.assertEqual(self.client.post(url, too_many, content_type='application/json').status_code, 400)
+
+
+class OverdueTests(TestCase):
+    """Overdue loans are found and measured in SQL, and swept into the digest table in chunks."""
+
+    def setUp(self):
+        self.today = datetime.date(2030, 6, 15)
+        self.borrower = User.objects.create(username='borrower')
+        book = Book.objects.create(title='Dune', summary='Spice.', isbn='9780441013593')
+        for days in (-10, -3, -1, 0, 5):
+            BookInstance.objects.create(book=book, imprint='Ace', status='o', borrower=self.borrower,
+                                        due_back=self.today + datetime.timedelta(days=days))
+        # Past due but not on loan, so never overdue.
+        BookInstance.objects.create(book=book, imprint='Ace', status='a', due_back=datetime.date(2020, 1, 1))
+
+    def test_annotations(self):
+        copies = BookInstance.objects.with_overdue(self.today).order_by('due_back')
+        self.assertEqual([(copy.overdue, copy.days_overdue) for copy in copies],
+                         [(False, 0), (True, 10), (True, 3), (True, 1), (False, 0), (False, 0)])
+        self.assertEqual(BookInstance.objects.overdue(self.today).count(), 3)
+        self.assertEqual(BookInstance.objects.with_overdue(self.today)
+                         .filter(overdue_by__gte=datetime.timedelta(days=3)).count(), 2)
+
+    def test_sweep_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'digest.csv')
+        self.addCleanup(os.remove, path)
+        out = StringIO()
+        call_command('sweep_overdue', '--date', '2030-06-15', '--chunk-size', '2', '--output', path, stdout=out)
+        self.assertIn('Found 3 overdue loans', out.getvalue())
+        self.assertEqual(list(OverdueNotice.objects.values_list('days_overdue', flat=True)), [10, 3, 1])
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+        # Sweeping the same day again adds nothing.
+        call_command('sweep_overdue', '--date', '2030-06-15', stdout=StringIO())
+        self.assertEqual(OverdueNotice.objects.count(), 3)
+
+    def test_all_borrowed_overdue_filter(self):
+        librarian = User.objects.create(username='librarian')
+        librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        self.client.force_login(librarian)
+        # Make the loans due before self.today two days overdue now, and the others due today.
+        today = datetime.date.today()
+        BookInstance.objects.filter(status='o', due_back__gte=self.today).update(due_back=today)
+        BookInstance.objects.filter(status='o').exclude(due_back=today).update(due_back=today - datetime.timedelta(days=2))
+        response = self.client.get(reverse('all-borrowed'), {'overdue': '1'})
+        self.assertEqual(len(response.context['bookinstance_list']), 3)
+        self.assertContains(response, '2 days overdue', count=3)
+
+
+class BulkLoanTests(TestCase):
+    """Librarians renew or return many loans with a single UPDATE and get a result per copy."""
+
+    def setUp(self):
+        book = Book.objects.create(title='Dune', summary='Spice.', isbn='9780441013593')
+        self.borrower = User.objects.create(username='borrower')
+        self.loans = [BookInstance.objects.create(book=book, imprint='Ace', status='o', borrower=self.borrower,
+                                                  due_back=datetime.date.today()) for _ in range(3)]
+        self.available = BookInstance.objects.create(book=book, imprint='Ace', status='a')
+        self.librarian = User.objects.create(username='librarian')
+        self.librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        self.client.force_login(self.librarian)
+
+    def post(self, **data):
+        data.setdefault('book_instances', [copy.pk for copy in self.loans] + [self.available.pk])
+        return self.client.post(reverse('bulk-update-loans'), data)
+
+    def test_renew(self):
+        renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(action='renew', renewal_date=renewal_date)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "catalog_bookinstance"')]
+        self.assertEqual(len(updates), 1)
+        results = dict(response.context['results'])
+        self.assertEqual([results[copy.pk] for copy in self.loans], [loans.RENEWED] * 3)
+        self.assertEqual(results[self.available.pk], loans.NOT_ON_LOAN)
+        self.assertEqual(set(BookInstance.objects.filter(status='o').values_list('due_back', flat=True)),
+                         {renewal_date})
+
+    def test_renewal_date_rules(self):
+        for renewal_date in (None, datetime.date.today() - datetime.timedelta(days=1),
+                             datetime.date.today() + datetime.timedelta(weeks=5)):
+            response = self.post(action='renew', renewal_date=renewal_date or '')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post(action='renew', renewal_date='2030-01-01', book_instances=[]).status_code, 400)
+        self.assertFalse(BookInstance.objects.exclude(due_back=datetime.date.today()).filter(status='o').exists())
+
+    def test_return(self):
+        stats.rebuild()
+        response = self.post(action='return')
+        results = dict(response.context['results'])
+        self.assertEqual(results[self.loans[0].pk], loans.RETURNED)
+        self.assertFalse(BookInstance.objects.filter(status='o').exists())
+        self.assertFalse(BookInstance.objects.filter(borrower__isnull=False).exists())
+        self.assertEqual(LibraryStats.objects.get().num_instances_available, 4)
+        results = loans.return_loans([self.loans[0].pk, BookInstance().id])
+        self.assertEqual(sorted(results.values()), [loans.NOT_FOUND, loans.NOT_ON_LOAN])
+
+
+@override_settings(MIDDLEWARE=['catalog.middleware.QueryTimingMiddleware'] + settings.MIDDLEWARE)
+class QueryTimingMiddlewareTests(TestCase):
+    """Each response reports its SQL, view and render time; slow requests are logged."""
+
+    def setUp(self):
+        cache.clear()
+        author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        for n in range(3):
+            Book.objects.create(title=f'Dune {n}', author=author, summary='Spice.', isbn=f'{n:013d}')
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('books'))
+        timing = response['Server-Timing']
+        self.assertIn(f'desc="{len(queries)} queries"', timing)
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", view;dur=[\d.]+, render;dur=[\d.]+, total;dur=[\d.]+$')
+
+    @override_settings(CATALOG_SLOW_REQUEST_MS=0)
+    def test_slow_request_log(self):
+        with self.assertLogs('catalog.performance', 'WARNING') as logs:
+            self.client.get(reverse('books'))
+        self.assertIn('Slow request: GET /catalog/books/', logs.output[0])
+        self.assertIn('slowest', logs.output[0])
+
+    @override_settings(CATALOG_SLOW_REQUEST_MS=None, CATALOG_SERVER_TIMING=False)
+    def test_disabled(self):
+        with self.assertNoLogs('catalog.performance'):
+            response = self.client.get(reverse('books'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class PageCacheTests(TestCase):
+    """Rendered catalog pages are reused until the data they show changes, and support conditional GET."""
+
+    def setUp(self):
+        cache.clear()
+        self.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        self.book = Book.objects.create(title='Dune', author=self.author, summary='Spice.', isbn='9780441013593')
+        self.user = User.objects.create(username='reader')
+
+    def get(self, url, **headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.get(url, **headers)
+
+    def change(self, func, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            func(*args, **kwargs)
+
+    def test_fragment_reused_until_change(self):
+        url = self.book.get_absolute_url()
+        self.assertContains(self.get(url), 'Spice.')
+        with self.assertNumQueries(0):
+            self.assertContains(self.get(url), 'Spice.')
+
+        self.book.summary = 'Sand.'
+        self.change(self.book.save)
+        self.assertContains(self.get(url), 'Sand.')
+
+        self.change(BookInstance.objects.create, book=self.book, imprint='Ace Books', status='a')
+        self.assertContains(self.get(url), 'Ace Books')
+        self.assertContains(self.get(self.author.get_absolute_url()), '1 copy')
+
+        self.author.last_name = 'Herbertson'
+        self.change(self.author.save)
+        self.assertContains(self.get(url), 'Herbertson')
+        self.assertContains(self.get(reverse('books')), 'Herbertson')
+        self.assertContains(self.get(reverse('authors')), 'Herbertson')
+
+        genre = Genre.objects.create(name='Science Fiction')
+        self.change(self.book.genre.add, genre)
+        self.assertContains(self.get(url), 'Science Fiction')
+        genre.name = 'Space Opera'
+        self.change(genre.save)
+        self.assertContains(self.get(url), 'Space Opera')
+
+    def test_loan_only_invalidates_book_list_pages_showing_the_book(self):
+        for n in range(10):
+            Book.objects.create(title=f'Children of Dune {n}', author=self.author, summary='.', isbn=f'{n:013d}')
+        copy = BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        first, second = reverse('books'), reverse('books') + '?page=2'
+        self.assertNotContains(self.get(first), 'Dune</a>')
+        self.assertContains(self.get(second), '1 of 1 copy available')
+        self.change(loans.checkout, copy.pk, self.user)
+        with self.assertNumQueries(0):
+            self.get(first)
+        self.assertContains(self.get(second), '0 of 1 copy available')
+
+    def test_sidebar_is_per_user(self):
+        url = self.book.get_absolute_url()
+        self.assertNotContains(self.get(url), 'reader')
+        self.client.force_login(self.user)
+        self.assertContains(self.get(url), 'User: reader')
+        self.client.logout()
+        self.assertNotContains(self.get(url), 'reader')
+
+    def test_conditional_get(self):
+        url = self.book.get_absolute_url()
+        response = self.get(url)
+        etag = response['ETag']
+        self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # No Last-Modified: its one-second resolution cannot tell apart two changes in the same second.
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self.get(url, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60)).status_code, 200)
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.client.logout()
+
+        self.change(BookInstance.objects.create, book=self.book, imprint='Ace', status='a')
+        self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_missing_book(self):
+        self.assertEqual(self.get(reverse('book-detail', args=[self.book.pk + 1])).status_code, 404)
+        url = self.book.get_absolute_url()
+        self.get(url)
+        self.change(self.book.delete)
+        self.assertEqual(self.get(url).status_code, 404)
+
+
+class VisitCountTests(TestCase):
+    """Home page visits are buffered in memory and written in batches, without touching the session."""
+
+    def setUp(self):
+        self.buffer = visits.VisitBuffer(flush_interval=3600, max_pending=5)
+        patcher = mock.patch.object(visits, 'buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def visit(self):
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        return response.context['num_visits']
+
+    def test_counts_per_visitor_without_session(self):
+        self.assertEqual([self.visit() for n in range(3)], [0, 1, 2])
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertEqual(VisitCount.objects.count(), 0)
+
+        other = self.client_class()
+        self.assertEqual(other.get(reverse('index')).context['num_visits'], 0)
+        self.assertEqual(self.visit(), 3)
+
+    def test_flushes_in_batches(self):
+        for n in range(4):
+            self.visit()
+        self.assertEqual(VisitCount.objects.count(), 0)
+        # The fifth pending visit fills the buffer and writes the batch.
+        self.client_class().get(reverse('index'))
+        self.assertEqual(self.buffer.num_pending, 0)
+        self.assertEqual(sorted(VisitCount.objects.values_list('count', flat=True)), [1, 4])
+        self.assertEqual(self.visit(), 4)
+
+    def test_flush_adds_to_stored_counts(self):
+        VisitCount.objects.create(visitor='a', count=10)
+        self.buffer.pending.update({'a': 2, 'b': 2, 'c': 1})
+        with self.assertNumQueries(5):
+            # One INSERT for the missing rows and one UPDATE for each distinct increment, in a transaction.
+            self.assertEqual(self.buffer.flush(), 5)
+        self.assertEqual(dict(VisitCount.objects.values_list('visitor', 'count')), {'a': 12, 'b': 2, 'c': 1})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.buffer.flush(), 0)
+
+    def test_tampered_cookie_gets_new_visitor(self):
+        self.visit()
+        self.visit()
+        self.client.cookies[visits.COOKIE_NAME] = 'not-signed'
+        self.assertEqual(self.visit(), 0)
+
+    def test_failed_flush_does_not_fail_the_page(self):
+        error = OperationalError('database is locked')
+        with mock.patch.object(visits, 'write_visits', side_effect=error), self.assertLogs('catalog.visits'):
+            # The fifth visit's flush fails: the buffer keeps its five visits and drops the next ones
+            # until the retry, one flush interval later.
+            self.assertEqual([self.visit() for n in range(8)], [0, 1, 2, 3, 4, 4, 4, 4])
+            self.assertEqual(self.buffer.num_pending, 5)
+        self.assertEqual(VisitCount.objects.count(), 0)
+        self.buffer.retry_after = 0
+        self.visit()
+        self.assertEqual(VisitCount.objects.get().count, 6)
+
+    def test_failed_flush_requeues_at_most_max_pending(self):
+        self.buffer.pending.update({'a': 4, 'b': 4})
+        with mock.patch.object(visits, 'write_visits', side_effect=OperationalError), self.assertLogs('catalog.visits'):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        self.assertEqual((self.buffer.num_pending, sum(self.buffer.pending.values())), (5, 5))
+
+    def test_flush_during_read_is_not_double_counted(self):
+        self.visit()
+        self.visit()
+        filter = VisitCount.objects.filter
+
+        def flush_then_filter(*args, **kwargs):
+            # Another thread writes the waiting visits while this one reads the stored count.
+            self.buffer.flush()
+            return filter(*args, **kwargs)
+
+        with mock.patch.object(VisitCount.objects, 'filter', side_effect=flush_then_filter):
+            self.assertEqual(self.visit(), 2)
+
+    def test_visits_being_written_are_still_waiting(self):
+        self.buffer.pending.update({'a': 2})
+        write_visits = visits.write_visits
+
+        def check_then_write(pending):
+            # Until the write commits, a reader finds the visits in the buffer, not in the table.
+            self.assertEqual(self.buffer.snapshot('a'), (0, 2))
+            write_visits(pending)
+
+        with mock.patch.object(visits, 'write_visits', side_effect=check_then_write):
+            self.buffer.flush()
+        self.assertEqual(self.buffer.snapshot('a'), (1, 0))
+
+
+class AdminQueryBudgetTests(TestCase):
+    """Admin changelists and change pages run a fixed number of queries however large the catalog."""
+
+    def setUp(self):
+        self.language = Language.objects.create(name='English')
+        self.genres = [Genre.objects.create(name=name) for name in ('Fantasy', 'Horror')]
+        self.author = Author.objects.create(first_name='Mary', last_name='Shelley')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.admin)
+        self.book = self.add_books(1)[0]
+
+    def add_books(self, count, copies=2):
+        books = []
+        for i in range(count):
+            n = Book.objects.count()
+            book = Book.objects.create(title=f'Book {n}', author=self.author, summary='Summary',
+                                       isbn=f'{n:013d}', language=self.language)
+            book.genre.set(self.genres)
+            for c in range(copies):
+                BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.admin,
+                                            due_back=datetime.date.today())
+            books.append(book)
+        return books
+
+    def get(self, url):
+        cache.clear()
+        ContentType.objects.clear_cache()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def assertConstantQueries(self, url):
+        response, before = self.get(url)
+        self.add_books(5)
+        self.add_books(1, copies=30)
+        response, after = self.get(url)
+        self.assertEqual(after, before)
+        return response
+
+    def test_changelists(self):
+        for model in ('book', 'bookinstance', 'author'):
+            with self.subTest(model=model):
+                self.assertConstantQueries(reverse(f'admin:catalog_{model}_changelist'))
+
+    def test_changelist_count_is_cached(self):
+        url = reverse('admin:catalog_book_changelist')
+        self.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+    def test_book_filters(self):
+        response, queries = self.get(reverse('admin:catalog_book_changelist'))
+        filters = [spec.title for spec in response.context['cl'].filter_specs]
+        self.assertEqual(filters, ['language', 'genre'])
+
+    def test_change_pages_cap_inlines(self):
+        book = self.add_books(1, copies=CappedInlineFormSet.cap + 5)[0]
+        response = self.assertConstantQueries(reverse('admin:catalog_book_change', args=[book.pk]))
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertEqual(len(formset.initial_forms), CappedInlineFormSet.cap)
+        # The page says how many copies there are and links to all of them.
+        self.assertContains(response, f'Showing the first {CappedInlineFormSet.cap} of {CappedInlineFormSet.cap + 5}')
+        changelist = reverse('admin:catalog_bookinstance_changelist') + f'?book__id__exact={book.pk}'
+        self.assertContains(response, f'href="{changelist}"')
+        response = self.client.get(changelist)
+        self.assertEqual(response.context['cl'].result_count, CappedInlineFormSet.cap + 5)
+
+        self.add_books(CappedInlineFormSet.cap)
+        response = self.assertConstantQueries(reverse('admin:catalog_author_change', args=[self.author.pk]))
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertEqual(len(formset.initial_forms), CappedInlineFormSet.cap)
+        self.assertContains(response, f'?author__id__exact={self.author.pk}')
+
+    def test_uncapped_inline_has_no_note(self):
+        book = self.add_books(1, copies=3)[0]
+        response = self.client.get(reverse('admin:catalog_book_change', args=[book.pk]))
+        self.assertNotContains(response, 'Showing the first')
+
+
+class GenerateLibraryTests(TestCase):
+
+    def test_generates_seeded_catalog(self):
+        out = StringIO()
+        call_command('generate_library', books=50, seed=3, stdout=out)
+        self.assertIn('Generated 50 books', out.getvalue())
+        self.assertEqual(Author.objects.count(), 10)
+        self.assertEqual(User.objects.filter(username__startswith='reader').count(), 5)
+        self.assertFalse(Book.objects.filter(genre=None).exists())
+        statuses = set(BookInstance.objects.values_list('status', flat=True))
+        self.assertEqual(statuses, {'a', 'o', 'r', 'm'})
+        self.assertFalse(BookInstance.objects.filter(status__exact='o', borrower=None).exists())
+        self.assertTrue(BookInstance.objects.overdue().exists())
+        self.assertEqual(LibraryStats.objects.get().num_books, 50)
+        self.assertTrue(search.search(Book.objects.first().title.split()[0]))
+
+        with self.assertRaises(CommandError):
+            call_command('generate_library', books=10, stdout=StringIO())
+
+    def test_reuses_existing_languages_and_genres(self):
+        english = Language.objects.create(name='English')
+        fantasy = Genre.objects.create(name='Fantasy')
+        LibraryGenerator(books=20, seed=0).run()
+        self.assertEqual(Language.objects.count(), len(LANGUAGES))
+        self.assertEqual(Genre.objects.count(), len(GENRES))
+        self.assertEqual(Language.objects.get(name='English'), english)
+        self.assertEqual(Genre.objects.get(name='Fantasy'), fantasy)
+
+    def test_same_seed_same_data(self):
+        def generate(seed):
+            LibraryGenerator(books=20, seed=seed, today=datetime.date(2024, 1, 1)).run()
+            data = (list(Book.objects.order_by('isbn').values_list('isbn', 'title', 'author__last_name')),
+                    sorted(BookInstance.objects.values_list('id', 'status', 'due_back')))
+            for model in (BookInstance, Book, Author, Genre, Language, User):
+                model.objects.all().delete()
+            return data
+
+        self.assertEqual(generate(1), generate(1))
+        self.assertNotEqual(generate(1), generate(2))
+
+
+class BenchmarkTests(TestCase):
+
+    def test_every_route_is_covered(self):
+        self.assertEqual(benchmark.uncovered_routes(), [])
+
+    def test_run_routes(self):
+        LibraryGenerator(books=30, seed=0).run()
+        sample = benchmark.get_sample(datetime.date.today() + datetime.timedelta(weeks=2))
+        with mock.patch.object(visits, 'buffer', visits.VisitBuffer()):
+            results = benchmark.run_routes(sample, requests=2)
+        self.assertEqual([result['route'] for result in results], list(benchmark.ROUTES))
+        for result in results:
+            self.assertEqual(result['status'], 200, result['route'])
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['throughput_rps'], 0)
+
+
+class BookCopyCounterTests(TestCase):
+    """Book.copies_total/copies_available/copies_on_loan follow every change to the copies."""
+
+    def setUp(self):
+        self.book = Book.objects.create(title='Dune', summary='Spice.', isbn='9780441013593')
+        self.other = Book.objects.create(title='Emma', summary='Match-making.', isbn='9780141439587')
+        self.borrower = User.objects.create(username='reader')
+
+    def assertCounts(self, book, total, available, on_loan):
+        book = Book.objects.get(pk=book.pk)
+        self.assertEqual((book.copies_total, book.copies_available, book.copies_on_loan), (total, available, on_loan))
+
+    def test_signals(self):
+        copy = BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        BookInstance.objects.create(book=self.book, imprint='Ace', status='m')
+        self.assertCounts(self.book, 2, 1, 0)
+
+        copy = BookInstance.objects.get(pk=copy.pk)
+        copy.status, copy.borrower, copy.due_back = 'o', self.borrower, datetime.date.today()
+        copy.save()
+        self.assertCounts(self.book, 2, 0, 1)
+
+        copy.book = self.other
+        copy.save()
+        self.assertCounts(self.book, 1, 0, 0)
+        self.assertCounts(self.other, 1, 0, 1)
+
+        copy.delete()
+        self.assertCounts(self.other, 0, 0, 0)
+
+    def test_saving_book_keeps_counters(self):
+        stale = Book.objects.get(pk=self.book.pk)
+        BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        stale.title = 'Dune Messiah'
+        stale.save()
+        self.assertCounts(self.book, 1, 1, 0)
+
+    def test_bulk_return(self):
+        copies = [BookInstance.objects.create(book=book, imprint='Ace', status='o', borrower=self.borrower,
+                                              due_back=datetime.date.today()) for book in (self.book, self.other)]
+        loans.return_loans([copy.pk for copy in copies])
+        self.assertCounts(self.book, 1, 1, 0)
+        self.assertCounts(self.other, 1, 1, 0)
+
+    def test_reconcile_command(self):
+        BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        BookInstance.objects.create(book=self.other, imprint='Ace', status='o')
+        Book.objects.filter(pk=self.book.pk).update(copies_total=7, copies_available=0)
+        out = StringIO()
+        call_command('reconcile_copy_counts', '--batch-size', '1', stdout=out)
+        self.assertIn(f'Book {self.book.pk}: stored 7/0/0, actual 1/1/0', out.getvalue())
+        self.assertIn('Repaired 1 books.', out.getvalue())
+        self.assertCounts(self.book, 1, 1, 0)
+        self.assertCounts(self.other, 1, 0, 1)
+
+        out = StringIO()
+        call_command('reconcile_copy_counts', stdout=out)
+        self.assertIn('No drift found.', out.getvalue())
+
+    def test_book_list_availability(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+            BookInstance.objects.create(book=self.book, imprint='Ace', status='o')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('books'))
+        self.assertContains(response, '1 of 2 copies available')
+        self.assertContains(response, '0 of 0 copies available')
+        self.assertFalse([query for query in queries if 'catalog_bookinstance' in query['sql']])
+
+        response = self.client.get(reverse('books'), {'available': 1})
+        self.assertEqual(list(response.context['book_list']), [self.book])
+
+        # Removing the last available copy takes the book off the available list.
+        with self.captureOnCommitCallbacks(execute=True):
+            BookInstance.objects.filter(book=self.book, status='a').get().delete()
+        response = self.client.get(reverse('books'), {'available': 1})
+        self.assertEqual(list(response.context['book_list']), [])
+
+
+class LoanServiceTests(TestCase):
+    """checkout/reserve/return_copy/renew change a copy only from the state they expect."""
+
+    def setUp(self):
+        self.book = Book.objects.create(title='Dune', summary='Spice.', isbn='9780441013593')
+        self.copy = BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def assertCopy(self, status, borrower):
+        copy = BookInstance.objects.get(pk=self.copy.pk)
+        self.assertEqual((copy.status, copy.borrower), (status, borrower))
+        self.assertEqual(LibraryStats.objects.get().num_instances_available, int(status == 'a'))
+        book = Book.objects.get(pk=self.book.pk)
+        self.assertEqual((book.copies_available, book.copies_on_loan), (int(status == 'a'), int(status == 'o')))
+
+    def test_checkout_and_return(self):
+        # The conditional UPDATE, reading the copy back, the loan event, two counters and the author pages.
+        with self.assertNumQueries(8):
+            loans.checkout(self.copy.pk, self.alice)
+        self.assertCopy('o', self.alice)
+        self.assertEqual(BookInstance.objects.get(pk=self.copy.pk).due_back,
+                         datetime.date.today() + loans.LOAN_PERIOD)
+
+        with self.assertRaises(loans.LoanConflict) as raised:
+            loans.checkout(self.copy.pk, self.bob)
+        self.assertEqual((raised.exception.status, raised.exception.borrower_id), ('o', self.alice.pk))
+        with self.assertRaises(loans.LoanConflict):
+            loans.return_copy(self.copy.pk, borrower=self.bob)
+
+        loans.return_copy(self.copy.pk, borrower=self.alice)
+        self.assertCopy('a', None)
+        with self.assertRaises(loans.LoanConflict):
+            loans.return_copy(self.copy.pk)
+
+    def test_reserve(self):
+        loans.reserve(self.copy.pk, self.alice)
+        self.assertCopy('r', self.alice)
+        with self.assertRaises(loans.LoanConflict):
+            loans.reserve(self.copy.pk, self.bob)
+        with self.assertRaises(loans.LoanConflict):
+            loans.checkout(self.copy.pk, self.bob)
+        loans.checkout(self.copy.pk, self.alice)
+        self.assertCopy('o', self.alice)
+
+    def test_renew(self):
+        renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        with self.assertRaises(loans.LoanConflict):
+            loans.renew(self.copy.pk, renewal_date)
+        loans.checkout(self.copy.pk, self.alice)
+        loans.renew(self.copy.pk, renewal_date, borrower=self.alice)
+        self.assertEqual(BookInstance.objects.get(pk=self.copy.pk).due_back, renewal_date)
+        with self.assertRaises(BookInstance.DoesNotExist):
+            loans.renew(uuid.uuid4(), renewal_date)
+
+    def test_checkout_book(self):
+        second = BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        taken = {loans.checkout_book(self.book, self.alice), loans.checkout_book(self.book, self.bob)}
+        self.assertEqual(taken, {self.copy.pk, second.pk})
+        with self.assertRaises(BookInstance.DoesNotExist):
+            loans.checkout_book(self.book, self.alice)
+
+    def test_renew_view_reports_conflict(self):
+        librarian = User.objects.create(username='librarian')
+        librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        self.client.force_login(librarian)
+        loans.checkout(self.copy.pk, self.alice)
+        url = reverse('renew-book-librarian', args=[self.copy.pk])
+        renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        shown = self.client.get(url).context['form'].initial
+        self.assertEqual(shown['borrower'], self.alice.pk)
+
+        # The copy is returned and lent to someone else between showing the form and posting it.
+        loans.return_copy(self.copy.pk)
+        loans.checkout(self.copy.pk, self.bob, due_back=shown['due_back'])
+        data = {'renewal_date': renewal_date, 'borrower': shown['borrower'], 'due_back': shown['due_back']}
+        response = self.client.post(url, data)
+        self.assertContains(response, 'is on loan')
+        self.assertNotEqual(BookInstance.objects.get(pk=self.copy.pk).due_back, renewal_date)
+
+        # Nor is a loan renewed whose due date has changed since.
+        loans.renew(self.copy.pk, shown['due_back'] + datetime.timedelta(days=1))
+        data['borrower'] = self.bob.pk
+        self.assertContains(self.client.post(url, data), 'is on loan')
+
+        data['due_back'] = shown['due_back'] + datetime.timedelta(days=1)
+        response = self.client.post(url, data)
+        self.assertRedirects(response, reverse('all-borrowed'))
+        self.assertEqual(BookInstance.objects.get(pk=self.copy.pk).due_back, renewal_date)
+
+
+class ConcurrentCheckoutTests(SimpleTestCase):
+    """Threads racing to check out the same copies each get a different copy or a conflict, never a lost update.
+
+    The race needs a database whose connections wait for each other's locks, which the in-memory
+    SQLite test database is not, so it runs in its own process with the benchmark_checkouts
+    command, on a fresh on-disk test database, and the tests check what it reports.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, directory)
+        output = os.path.join(directory, 'race.json')
+        subprocess.run([sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'benchmark_checkouts',
+                        '--threads=8', '--copies=5', '--rounds=10', f'--output={output}'],
+                       check=True, capture_output=True)
+        with open(output) as results:
+            cls.results = json.load(results)
+
+    def test_same_copy(self):
+        race = self.results['same_copy']
+        self.assertEqual(race['errors'], [])
+        self.assertEqual(len(race['winners']), 1)
+        self.assertEqual(race['borrower'], race['winners'][0])
+
+    def test_any_copy(self):
+        race = self.results['any_copy']
+        self.assertEqual(race['errors'], [])
+        # Each copy lent exactly once, and the counters agree with the copies.
+        self.assertEqual(len(race['taken']), 5)
+        self.assertEqual(len(set(race['taken'])), 5)
+        self.assertEqual(race['on_loan'], 5)
+        self.assertEqual(race['counters'], [5, 0, 5])
+        self.assertEqual(race['stats_drift'], {})
+
+    def test_repeated_checkouts(self):
+        race = self.results['throughput']
+        self.assertEqual(race['errors'], [])
+        self.assertEqual(race['loan_events'], 8 * 10)
+
+
+class AsyncViewTests(TestCase):
+    """The async read views render the same pages as the sync ones."""
+
+    def setUp(self):
+        self.author = Author.objects.create(first_name='Frank', last_name='Herbert')
+        self.book = Book.objects.create(title='Dune', author=self.author, summary='Spice.', isbn='9780441013593')
+        for n in range(11):
+            Book.objects.create(title=f'Sequel {n:02}', author=self.author, summary='More.', isbn=f'{n:013d}')
+        self.librarian = User.objects.create(username='librarian')
+        self.librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        BookInstance.objects.create(book=self.book, imprint='Ace', status='o', borrower=self.librarian,
+                                    due_back=datetime.date.today() - datetime.timedelta(days=2))
+        BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        cache.clear()
+        patcher = mock.patch.object(visits, 'buffer', visits.VisitBuffer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def main_content(self, response):
+        self.assertEqual(response.status_code, 200)
+        content = re.sub(r'name="csrfmiddlewaretoken" value="\w+"', '', response.content.decode())
+        return content[content.index('<h1>'):content.index('</body>')].replace('/catalog/async', '/catalog')
+
+    async def test_pages_match_sync_views(self):
+        await sync_to_async(self.client.force_login)(self.librarian)
+        self.async_client.cookies.update(self.client.cookies)
+        for name, args, query in (('books', [], {}), ('books', [], {'page': 2}), ('books', [], {'available': 1}),
+                                  ('books', [], {'cursor': ''}), ('book-detail', [self.book.pk], {}),
+                                  ('authors', [], {}), ('authors', [], {'cursor': ''}),
+                                  ('author-detail', [self.author.pk], {}), ('my-borrowed', [], {}),
+                                  ('all-borrowed', [], {}), ('all-borrowed', [], {'overdue': 1}),
+                                  ('all-borrowed', [], {'cursor': ''})):
+            with self.subTest(name=name, query=query):
+                expected = await sync_to_async(self.client.get)(reverse(name, args=args), query)
+                # Rendered by the async view itself, not served from the fragment the sync view cached.
+                await cache.aclear()
+                response = await self.async_client.get(reverse(f'async-{name}', args=args), query)
+                self.assertEqual(self.main_content(response), self.main_content(expected))
+
+    async def test_cursor_pages(self):
+        response = await self.async_client.get(reverse('async-books'), {'cursor': ''})
+        next_query = response.context['page_obj'].next_query
+        self.assertIn('cursor=', next_query)
+        response = await self.async_client.get(reverse('async-books') + next_query)
+        self.assertEqual([book.title for book in response.context['page_obj']], ['Sequel 09', 'Sequel 10'])
+        response = await self.async_client.get(reverse('async-books'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_shares_fragments_and_etags_with_sync_views(self):
+        url, async_url = self.book.get_absolute_url(), reverse('async-book-detail', args=[self.book.pk])
+        response = await self.async_client.get(async_url)
+        etag = response['ETag']
+        self.assertEqual((await self.async_client.get(async_url, headers={'If-None-Match': etag})).status_code, 304)
+        with mock.patch.object(caching, 'render_to_string') as render_fragment:
+            expected = await sync_to_async(self.client.get)(url)
+            self.assertEqual((await sync_to_async(self.client.get)(url, HTTP_IF_NONE_MATCH=etag)).status_code, 304)
+        render_fragment.assert_not_called()
+        self.assertEqual(expected['ETag'], etag)
+        self.assertEqual(self.main_content(response), self.main_content(expected))
+
+    async def test_index(self):
+        response = await self.async_client.get(reverse('async-index'))
+        self.assertEqual(response.context['num_books'], 12)
+        self.assertEqual(response.context['num_instances_available'], 1)
+        self.assertEqual(response.context['num_visits'], 0)
+        self.async_client.cookies.update(response.cookies)
+        response = await self.async_client.get(reverse('async-index'))
+        self.assertEqual(response.context['num_visits'], 1)
+
+    async def test_access(self):
+        response = await self.async_client.get(reverse('async-all-borrowed'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.LOGIN_URL, response['Location'])
+        reader = await User.objects.acreate(username='reader')
+        await sync_to_async(self.client.force_login)(reader)
+        self.async_client.cookies.update(self.client.cookies)
+        self.assertEqual((await self.async_client.get(reverse('async-all-borrowed'))).status_code, 403)
+        self.assertEqual((await self.async_client.get(reverse('async-my-borrowed'))).status_code, 200)
+        self.assertEqual((await self.async_client.get(reverse('async-book-detail', args=[999]))).status_code, 404)
+        self.assertEqual((await self.async_client.get(reverse('async-books'), {'page': 9})).status_code, 404)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['catalog.backends.CachedPermissionBackend'])
+class CachedPermissionBackendTests(TestCase):
+    """Resolved permission sets are reused across requests until the user, a group or a permission changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.permission = Permission.objects.get(codename='can_mark_returned')
+        self.librarians = Group.objects.create(name='Librarians')
+        self.user = User.objects.create(username='librarian')
+        self.user.groups.add(self.librarians)
+        self.client.force_login(self.user)
+
+    def change(self, func, *args):
+        with self.captureOnCommitCallbacks(execute=True):
+            func(*args)
+
+    def has_perm(self):
+        return User.objects.get(pk=self.user.pk).has_perm('catalog.can_mark_returned')
+
+    def test_warm_check_runs_no_queries(self):
+        self.change(self.librarians.permissions.add, self.permission)
+        self.assertTrue(self.has_perm())
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('catalog.can_mark_returned'))
+            self.assertTrue(user.has_module_perms('catalog'))
+
+    def test_warm_page_skips_permission_tables(self):
+        self.change(self.user.user_permissions.add, self.permission)
+        url = reverse('all-borrowed')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([query for query in queries if 'auth_permission' in query['sql']])
+
+    def test_invalidation(self):
+        self.assertFalse(self.has_perm())
+        self.change(self.librarians.permissions.add, self.permission)
+        self.assertTrue(self.has_perm())
+        self.change(self.user.groups.remove, self.librarians)
+        self.assertFalse(self.has_perm())
+        self.change(self.librarians.user_set.add, self.user)
+        self.assertTrue(self.has_perm())
+        self.change(self.librarians.permissions.clear)
+        self.assertFalse(self.has_perm())
+
+        self.change(self.user.user_permissions.add, self.permission)
+        self.assertTrue(self.has_perm())
+        self.change(self.permission.user_set.clear)
+        self.assertFalse(self.has_perm())
+
+        self.user.is_superuser = True
+        self.change(self.user.save)
+        self.assertTrue(self.has_perm())
+        self.user.is_active = False
+        self.change(self.user.save)
+        self.assertFalse(self.has_perm())
+
+
+class BookBrowseTests(TestCase):
+    """The faceted browse page counts every option in a fixed number of queries and caches the counts."""
+
+    def setUp(self):
+        cache.clear()
+        self.english, self.french = Language.objects.create(name='English'), Language.objects.create(name='French')
+        self.fantasy, self.poetry = Genre.objects.create(name='Fantasy'), Genre.objects.create(name='Poetry')
+        self.le_guin = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+        self.hugo = Author.objects.create(first_name='Victor', last_name='Hugo')
+        self.books = []
+        for n, (author, language, genres) in enumerate([
+            (self.le_guin, self.english, [self.fantasy]),
+            (self.le_guin, self.english, [self.fantasy, self.poetry]),
+            (self.hugo, self.french, [self.poetry]),
+            (self.hugo, self.french, []),
+        ]):
+            book = Book.objects.create(title=f'Book {n}', summary='.', isbn=f'97800000000{n:02}', author=author,
+                                       language=language)
+            book.genre.set(genres)
+            self.books.append(book)
+        BookInstance.objects.create(book=self.books[0], imprint='Ace', status='a')
+
+    def counts(self, **query):
+        response = self.client.get(reverse('book-browse'), query)
+        self.assertEqual(response.status_code, 200)
+        return response.context['total'], {name: {option['name']: option['count'] for option in options}
+                                           for name, options in response.context['facets']}
+
+    def test_counts(self):
+        self.assertEqual(self.counts(), (4, {
+            'genre': {'Fantasy': 2, 'Poetry': 2},
+            'language': {'English': 2, 'French': 2},
+            'author': {'Le Guin, Ursula': 2, 'Hugo, Victor': 2},
+        }))
+        # Options of the chosen facet are counted without it, the other facets with it.
+        total, counts = self.counts(genre=[self.fantasy.pk, self.poetry.pk])
+        self.assertEqual(total, 3)
+        self.assertEqual(counts['genre'], {'Fantasy': 2, 'Poetry': 2})
+        self.assertEqual(counts['language'], {'English': 2, 'French': 1})
+        total, counts = self.counts(genre=self.poetry.pk, language=self.french.pk)
+        self.assertEqual(total, 1)
+        self.assertEqual(counts['genre'], {'Poetry': 1})
+        self.assertEqual(counts['language'], {'English': 1, 'French': 1})
+        self.assertEqual(self.counts(available=1)[0], 1)
+
+    def test_page_lists_matching_books(self):
+        response = self.client.get(reverse('book-browse'), {'author': self.hugo.pk, 'page': 1})
+        self.assertEqual([book.title for book in response.context['book_list']], ['Book 2', 'Book 3'])
+        hugo = [option for name, options in response.context['facets'] if name == 'author'
+                for option in options if option['id'] == self.hugo.pk][0]
+        self.assertTrue(hugo['selected'])
+        self.assertEqual(hugo['query'], '?')
+
+    def test_fixed_number_of_queries(self):
+        for n in range(10):
+            Genre.objects.create(name=f'Genre {n}')
+            Language.objects.create(name=f'Language {n}')
+        # The total and the three facets, plus the page of books.
+        with self.assertNumQueries(5):
+            self.client.get(reverse('book-browse'), {'genre': self.fantasy.pk})
+        with self.assertNumQueries(1):
+            self.client.get(reverse('book-browse'), {'genre': self.fantasy.pk})
+        # Larger filter sets are not cached.
+        query = {'genre': [self.fantasy.pk, self.poetry.pk], 'language': self.english.pk}
+        self.client.get(reverse('book-browse'), query)
+        with self.assertNumQueries(5):
+            self.client.get(reverse('book-browse'), query)
+
+    def test_invalidation(self):
+        self.counts()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books[3].genre.add(self.fantasy)
+        self.assertEqual(self.counts()[1]['genre'], {'Fantasy': 3, 'Poetry': 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.create(title='Book 4', summary='.', isbn='9780000000004', author=self.hugo)
+        self.assertEqual(self.counts()[1]['author'], {'Le Guin, Ursula': 2, 'Hugo, Victor': 3})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.poetry.name = 'Verse'
+            self.poetry.save()
+        self.assertEqual(self.counts()[1]['genre'], {'Fantasy': 3, 'Verse': 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            BookInstance.objects.create(book=self.books[2], imprint='Ace', status='a')
+        self.assertEqual(self.counts(available=1)[0], 2)
+
+    def test_loans_only_invalidate_available_counts(self):
+        copy = BookInstance.objects.get(book=self.books[0])
+        unfiltered = facets.facets_key(facets.parse_filters(RequestFactory().get('/').GET),
+                                       caching.get_versions(*facets.VERSION_NAMES))
+        self.assertEqual(self.counts(available=1)[0], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            loans.checkout(copy.pk, User.objects.create_user('reader'))
+        self.assertEqual(facets.facets_key(facets.parse_filters(RequestFactory().get('/').GET),
+                                           caching.get_versions(*facets.VERSION_NAMES)), unfiltered)
+        self.assertEqual(self.counts(available=1)[0], 0)
+
+    def test_parse_filters_ignores_bad_values(self):
+        query = RequestFactory().get('/', {'genre': ['2', 'x', '1'], 'author': ''}).GET
+        self.assertEqual(facets.parse_filters(query),
+                         {'genre': [1, 2], 'language': [], 'author': [], 'available': False})
+
+
+@override_settings(CATALOG_READ_DATABASE='replica')
+class ReadReplicaRouterTests(SimpleTestCase):
+    """Reads of GET requests go to the replica until the request writes; everything else goes to the primary."""
+
+    def setUp(self):
+        self.router = database.ReadReplicaRouter()
+
+    def test_outside_requests(self):
+        self.assertEqual(self.router.db_for_read(Book), 'default')
+        self.assertEqual(self.router.db_for_write(Book), 'default')
+
+    def test_request_scope(self):
+        with database.request_scope(use_replica=True):
+            self.assertEqual(self.router.db_for_read(Book), 'replica')
+            self.assertEqual(self.router.db_for_read(User), 'default')
+            self.assertEqual(self.router.db_for_read(Permission), 'default')
+            self.router.db_for_write(Book)
+            self.assertEqual(self.router.db_for_read(Book), 'default')
+        with database.request_scope(use_replica=False):
+            self.assertEqual(self.router.db_for_read(Book), 'default')
+        with override_settings(CATALOG_READ_DATABASE=None), database.request_scope(use_replica=True):
+            self.assertEqual(self.router.db_for_read(Book), 'default')
+
+    def test_atomic_block_reads_primary(self):
+        with mock.patch.object(connection, 'in_atomic_block', True), database.request_scope(use_replica=True):
+            self.assertEqual(self.router.db_for_read(Book), 'default')
+
+    def test_primary_reads(self):
+        with database.request_scope(use_replica=True):
+            with database.primary_reads():
+                self.assertEqual(self.router.db_for_read(Book), 'default')
+            self.assertEqual(self.router.db_for_read(Book), 'replica')
+        with database.primary_reads():
+            self.assertEqual(self.router.db_for_read(Book), 'default')
+
+    def test_shared_caches_are_filled_from_primary(self):
+        reads = []
+
+        def read(result=None):
+            def record(*args, **kwargs):
+                reads.append(self.router.db_for_read(Book))
+                return result
+            return record
+
+        class FragmentView(caching.CachedFragmentMixin, generic.TemplateView):
+            template_name = fragment_template_name = 'unused.html'
+
+            def get_context_data(self, **kwargs):
+                return read({})()
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        cache.clear()
+        with database.request_scope(use_replica=True), \
+                mock.patch.object(caching, 'render_to_string', return_value=''), \
+                mock.patch.object(stats.LibraryStats.objects, 'filter',
+                                  read(mock.Mock(**{'values.return_value.first.return_value': {}}))), \
+                mock.patch.object(facets, 'count_facets', read({})):
+            FragmentView.as_view()(request)
+            stats.get_stats()
+            facets.get_facets({'genre': [], 'language': [], 'author': [], 'available': False})
+            reads.append(self.router.db_for_read(Book))
+        # Only the read made outside the cache fills goes to the replica.
+        self.assertEqual(reads, ['default', 'default', 'default', 'replica'])
+
+    def test_replica_is_not_migrated(self):
+        self.assertIs(self.router.allow_migrate('replica', 'catalog'), False)
+        self.assertIsNone(self.router.allow_migrate('default', 'catalog'))
+
+    def test_middleware_sticks_to_primary_after_write(self):
+        reads = []
+
+        def view(request):
+            if request.method == 'POST':
+                self.router.db_for_write(Book)
+            reads.append(self.router.db_for_read(Book))
+            return HttpResponse()
+
+        middleware = ReplicaRoutingMiddleware(view)
+        factory = RequestFactory()
+        response = middleware(factory.get('/'))
+        self.assertNotIn('catalog_primary', response.cookies)
+        response = middleware(factory.post('/'))
+        self.assertEqual(response.cookies['catalog_primary']['max-age'], 5)
+        request = factory.get('/')
+        request.COOKIES['catalog_primary'] = '1'
+        middleware(request)
+        self.assertEqual(reads, ['replica', 'default', 'default'])
+
+    @override_settings(DATABASE_ROUTERS=['catalog.database.ReadReplicaRouter'])
+    def test_streamed_export_reads_replica(self):
+        reads = []
+
+        def iterator(queryset, chunk_size=None):
+            # Like QuerySet.iterator(), the database is only chosen when the rows are read.
+            reads.append(queryset.db)
+            yield from ()
+
+        middleware = ReplicaRoutingMiddleware(lambda request: api.resource_export(request, 'books'))
+        with mock.patch.object(QuerySet, 'iterator', autospec=True, side_effect=iterator):
+            response = middleware(RequestFactory().get('/'))
+            # The body is only read once the middleware has returned.
+            b''.join(response.streaming_content)
+        self.assertEqual(reads, ['replica'])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite connection settings')
+class SQLiteTuningTests(TestCase):
+
+    def test_pragmas_on_new_connections(self):
+        with tempfile.TemporaryDirectory() as directory:
+            primary = connections['default']
+            wrapper = type(primary)({**primary.settings_dict, 'NAME': os.path.join(directory, 'tuned.db')},
+                                    alias='tuned')
+            try:
+                wrapper.ensure_connection()
+                pragmas = [wrapper.connection.execute(f'PRAGMA {name}').fetchone()[0]
+                           for name in ('journal_mode', 'synchronous', 'mmap_size')]
+            finally:
+                wrapper.close()
+        # synchronous=NORMAL is reported as 1.
+        self.assertEqual(pragmas, ['wal', 1, 256 * 1024 * 1024])
+
+
+class CirculationTests(TestCase):
+    """Every status change is logged as a LoanEvent, and rollup() adds new events to the daily rollups once."""
+
+    def setUp(self):
+        self.english = Language.objects.create(name='English')
+        self.fantasy, self.poetry = Genre.objects.create(name='Fantasy'), Genre.objects.create(name='Poetry')
+        self.book = Book.objects.create(title='Earthsea', summary='.', isbn='9780000000001', language=self.english)
+        self.book.genre.set([self.fantasy, self.poetry])
+        self.reader = User.objects.create(username='reader')
+        self.copy = BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+
+    def events(self):
+        return list(LoanEvent.objects.values_list('kind', 'old_status', 'new_status', 'borrower_id'))
+
+    def test_saves_are_logged(self):
+        copy = BookInstance.objects.get(pk=self.copy.pk)
+        copy.status, copy.borrower, copy.due_back = 'o', self.reader, datetime.date.today()
+        copy.save()
+        copy.due_back += datetime.timedelta(days=7)
+        copy.save()
+        copy.imprint = 'Gollancz'
+        copy.save()
+        copy.status, copy.borrower, copy.due_back = 'a', None, None
+        copy.save()
+        BookInstance.objects.create(book=self.book, imprint='Ace', status='r', borrower=self.reader)
+        self.assertEqual(self.events(), [
+            ('loan', 'a', 'o', self.reader.pk),
+            ('renew', 'o', 'o', self.reader.pk),
+            ('return', 'o', 'a', self.reader.pk),
+            ('reserve', '', 'r', self.reader.pk),
+        ])
+
+    def test_bulk_created_loans_are_not_counted(self):
+        LibraryGenerator(books=5, users=2, seed=0).run()
+        self.assertTrue(LoanEvent.objects.filter(new_status='o').exists())
+        self.assertFalse(LoanEvent.objects.exclude(kind=LoanEvent.STATUS).exists())
+        circulation.rollup()
+        self.assertFalse(BookCirculation.objects.filter(loans__gt=0).exists())
+
+    def test_copy_saved_on_loan_is_a_loan(self):
+        BookInstance.objects.create(book=self.book, imprint='Ace', status='o', borrower=self.reader,
+                                    due_back=datetime.date.today())
+        self.assertEqual(self.events(), [('loan', '', 'o', self.reader.pk)])
+        circulation.rollup()
+        self.assertEqual(BookCirculation.objects.get(book=self.book).loans, 1)
+
+    def test_loan_services_are_logged(self):
+        loans.checkout(self.copy.pk, self.reader)
+        loans.renew(self.copy.pk, datetime.date.today() + datetime.timedelta(weeks=4))
+        loans.renew_loans([self.copy.pk], datetime.date.today() + datetime.timedelta(weeks=5))
+        loans.return_loans([self.copy.pk])
+        loans.reserve(self.copy.pk, self.reader)
+        with self.assertRaises(loans.LoanConflict):
+            loans.return_copy(self.copy.pk)
+        self.assertEqual(self.events(), [
+            ('loan', 'a', 'o', self.reader.pk),
+            ('renew', 'o', 'o', self.reader.pk),
+            ('renew', 'o', 'o', self.reader.pk),
+            ('return', 'o', 'a', self.reader.pk),
+            ('reserve', 'a', 'r', self.reader.pk),
+        ])
+
+    def test_return_keeps_borrower(self):
+        loans.checkout(self.copy.pk, self.reader)
+        loans.return_copy(self.copy.pk)
+        self.assertEqual(self.events()[-1], ('return', 'o', 'a', self.reader.pk))
+        self.assertIsNone(BookInstance.objects.get(pk=self.copy.pk).borrower)
+
+    def test_overdue_logged_once_per_day(self):
+        loans.checkout(self.copy.pk, self.reader, due_back=datetime.date(2024, 1, 1))
+        loans.sweep_overdue(datetime.date(2024, 1, 5))
+        loans.sweep_overdue(datetime.date(2024, 1, 5))
+        loans.sweep_overdue(datetime.date(2024, 1, 6))
+        overdue = LoanEvent.objects.filter(kind=LoanEvent.OVERDUE)
+        self.assertEqual(sorted(overdue.values_list('day', flat=True)),
+                         [datetime.date(2024, 1, 5), datetime.date(2024, 1, 6)])
+
+    def test_overdue_logged_only_for_new_notices(self):
+        other = BookInstance.objects.create(book=self.book, imprint='Ace', status='a')
+        loans.checkout(self.copy.pk, self.reader, due_back=datetime.date(2024, 1, 1))
+        loans.checkout(other.pk, self.reader, due_back=datetime.date(2024, 1, 1))
+        # Another sweep has already found one of the loans overdue today.
+        OverdueNotice.objects.create(swept_on=datetime.date(2024, 1, 5), book_instance=self.copy,
+                                     borrower=self.reader, due_back=datetime.date(2024, 1, 1), days_overdue=4)
+        self.assertEqual(loans.sweep_overdue(datetime.date(2024, 1, 5)), 2)
+        overdue = LoanEvent.objects.filter(kind=LoanEvent.OVERDUE)
+        self.assertEqual(list(overdue.values_list('book_instance_id', flat=True)), [other.pk])
+
+    def test_events_are_append_only(self):
+        loans.checkout(self.copy.pk, self.reader)
+        event = LoanEvent.objects.get()
+        with self.assertRaises(ValueError):
+            event.save()
+        with self.assertRaises(ValueError):
+            event.delete()
+
+    def test_rollup_is_incremental(self):
+        today = datetime.date.today()
+        loans.checkout(self.copy.pk, self.reader)
+        loans.return_copy(self.copy.pk)
+        loans.checkout(self.copy.pk, self.reader, due_back=today - datetime.timedelta(days=1))
+        loans.sweep_overdue(today)
+        self.assertEqual(circulation.rollup(batch_size=2), 4)
+        self.assertEqual(circulation.rollup(), 0)
+
+        loans.return_copy(self.copy.pk)
+        # The watermark, the events, the books' languages and genres, then a read and a write per rollup table.
+        with self.assertNumQueries(13):
+            self.assertEqual(circulation.rollup(), 1)
+        out = StringIO()
+        call_command('rollup_circulation', stdout=out)
+        self.assertIn('Rolled up 0 loan events', out.getvalue())
+
+        expected = {'total_loans': 2, 'total_returns': 2, 'total_overdues': 1}
+        for by, name in (('book', 'Earthsea'), ('genre', 'Fantasy'), ('genre', 'Poetry'), ('language', 'English')):
+            rows = [row for row in circulation.report(by, today, today) if row['name'] == name]
+            self.assertEqual([{key: row[key] for key in expected} for row in rows], [expected])
+
+    def test_report_page(self):
+        loans.checkout(self.copy.pk, self.reader)
+        circulation.rollup()
+        librarian = User.objects.create(username='librarian')
+        librarian.user_permissions.add(Permission.objects.get(codename='can_mark_returned'))
+        self.client.force_login(self.reader)
+        self.assertEqual(self.client.get(reverse('circulation-report')).status_code, 403)
+        self.client.force_login(librarian)
+        response = self.client.get(reverse('circulation-report'), {'by': 'language', 'days': 'x'})
+        self.assertEqual(response.context['days'], 30)
+        self.assertEqual([(row['name'], row['total_loans']) for row in response.context['rows']], [('English', 1)])
@@ -1,9 +1,11 @@
 from django.urls import path, re_path
-from catalog import views
+from catalog import api, async_views, views
 
 urlpatterns = [
     path('', views.index, name='index'),
     path('books/', views.BookListView.as_view(), name='books'),
+    path('search/', views.book_search, name='book-search'),
+    path('browse/', views.BookBrowseView.as_view(), name='book-browse'),
     # Challenge 1:
     # Consider how you might encode a URL to list all books released in a particular year, month, day,
     # and the RE that could be used to match it.
@@ -25,6 +27,8 @@ urlpatterns += [
     # the function named renew_book_librarian() in views.py, and send the BookInstance id as the parameter named pk.
     # The pattern only matches if pk is a correctly formatted uuid.
     path('book/<uuid:pk>/renew/', views.renew_book_librarian, name='renew-book-librarian'),
+    path('borrowed/update/', views.bulk_update_loans, name='bulk-update-loans'),
+    path('circulation/', views.circulation_report, name='circulation-report'),
 
     path('author/create/', views.AuthorCreate.as_view(), name='author-create'),
     path('author/<int:pk>/update/', views.AuthorUpdate.as_view(), name='author-update'),
@@ -33,4 +37,22 @@ urlpatterns += [
     path('book/create/', views.BookCreate.as_view(), name='book-create'),
     path('book/<int:pk>/update/', views.BookUpdate.as_view(), name='book-update'),
     path('book/<int:pk>/delete/', views.BookDelete.as_view(), name='book-delete'),
-]
\ No newline at end of file
+]
+
+#   JSON API
+urlpatterns += [
+    path('api/availability/', api.availability, name='api-availability'),
+    path('api/<slug:resource>/', api.resource_list, name='api-list'),
+    path('api/<slug:resource>/export/', api.resource_export, name='api-export'),
+]
+
+#   Async versions of the read views (for ASGI deployments)
+urlpatterns += [
+    path('async/', async_views.index, name='async-index'),
+    path('async/books/', async_views.book_list, name='async-books'),
+    path('async/book/<int:pk>', async_views.book_detail, name='async-book-detail'),
+    path('async/authors/', async_views.author_list, name='async-authors'),
+    path('async/author/<int:pk>', async_views.author_detail, name='async-author-detail'),
+    path('async/mybooks/', async_views.loaned_books_by_user, name='async-my-borrowed'),
+    path('async/borrowed/', async_views.all_loaned_books, name='async-all-borrowed'),
+]
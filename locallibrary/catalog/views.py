@@ -2,9 +2,18 @@
 #   1. We must use pk as the name for our captured primary key value, as this is the parameter name
 #       expected by the view classes.
 
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render
-
-from catalog.models import Book, Author, BookInstance, Genre
+from django.db.models import Count, Prefetch
+
+from catalog.models import Book, Author, BookInstance
+from catalog import facets, search, stats, visits
+from catalog import caching
+from catalog.caching import CachedFragmentMixin
+from catalog.database import primary_reads
+from catalog.pagination import CursorPaginationMixin
+from django.core.paginator import Paginator
 from django.views import generic
 
 #   Tutorial 8 imports
@@ -17,7 +26,8 @@ from django.contrib.auth.decorators import login_required, permission_required
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponseRedirect
 from django.urls import reverse
-from catalog.forms import RenewBookForm
+from catalog.forms import BulkLoanForm, RenewBookLibrarianForm
+from catalog import circulation, loans
 
 #   ModelForms
 from django.forms import ModelForm
@@ -34,35 +44,38 @@ from catalog.models import Author
 def index(request):
     """View function for home page of site."""
 
-    # Generate counts of some of the main objects
-    num_books = Book.objects.all().count()
-    num_instances = BookInstance.objects.all().count()
-    num_genres = Genre.objects.count()
+    # Counts of the main objects (num_books, num_instances, num_instances_available, num_authors, num_genres)
+    # come from the maintained stats row rather than a COUNT(*) over each table.
+    context = dict(stats.get_stats())
+
+    # Visits are counted per visitor cookie and written in batches (see catalog.visits),
+    # rather than saving the session on every visit to the home page.
+    context['num_visits'] = visits.count_visit(request)
 
-    # Available books (status = 'a')
-    num_instances_available = BookInstance.objects.filter(status__exact='a').count()
+    # Render the HTML template index.html with the data in the context variable
+    response = render(request, 'index.html', context=context)
+    return visits.set_visitor_cookie(request, response)
 
-    num_authors = Author.objects.count() # The 'all()' is implied by default.
 
-    num_visits = request.session.get('num_visits', 0)
-    request.session['num_visits'] = num_visits + 1
+def book_search(request):
+    """View function for ranked full-text search over book titles, summaries, authors and genres."""
+    query = request.GET.get('q', '').strip()
+    page_obj = None
+    if query:
+        paginator = Paginator(search.search(query), 10)
+        page_obj = paginator.get_page(request.GET.get('page'))
 
     context = {
-        'num_books': num_books,
-        'num_instances': num_instances,
-        'num_instances_available': num_instances_available,
-        'num_authors': num_authors,
-        'num_genres': num_genres,
-        'num_visits': num_visits,
+        'query': query,
+        'page_obj': page_obj,
+        'book_list': page_obj.object_list if page_obj else [],
     }
-
-    # Render the HTML template index.html with the data in the context variable
-    return render(request, 'index.html', context=context)
+    return render(request, 'catalog/book_search.html', context=context)
 
 
 # ListView is a class-based generic list view that inherits from an existing view which follows Django best-practice.
 #   Making it more robust, less code, less repetition and less maintenance than standard views.
-class BookListView(generic.ListView):
+class BookListView(CachedFragmentMixin, CursorPaginationMixin, generic.ListView):
     """This generic view queryies the db to get all records for the specified model (Book) then it renders a template."""
     # Template location: /locallibrary/catalog/templates/catalog/book_list.html
     # Within the template you can access the list of books with the template variable named "object_list" OR "book_list"
@@ -70,6 +83,44 @@ class BookListView(generic.ListView):
 
     model = Book
     paginate_by = 10
+    # The template shows each book's author, so fetch it in the same query.
+    queryset = Book.objects.select_related('author')
+    # Unique sort key for cursor pagination (?cursor=), also used to order page-number pagination.
+    cursor_ordering = ('title', 'id')
+    # The rendered list is cached until a book or author changes (see catalog.caching).
+    template_name = 'catalog/book_list.html'
+    fragment_template_name = 'catalog/book_list_fragment.html'
+
+    def get_version_names(self):
+        names = ['catalog', 'books']
+        if self.request.GET.get('available'):
+            # Which books have a copy on the shelf changes with every loan.
+            names.append('availability')
+        return names
+
+    def get_fragment_key(self, versions):
+        # Each book shows its copy counts, so the page also depends on the versions of the books it lists:
+        # a loan only invalidates the pages showing that book, not the whole list.
+        book_versions = caching.get_versions(*[f'book:{pk}' for pk in self.get_page_book_ids(versions)])
+        return super().get_fragment_key({**versions, **book_versions})
+
+    def get_page_book_ids(self, versions):
+        """The ids of the books on the requested page, cached under the list's versions."""
+        key = caching.fragment_key('BookListView:books', self.kwargs, self.request.GET, versions)
+        book_ids = cache.get(key)
+        if book_ids is None:
+            with primary_reads():
+                queryset = self.get_queryset().select_related(None).only(*self.cursor_ordering)
+                book_ids = [book.pk for book in self.paginate_queryset(queryset, self.paginate_by)[2]]
+            cache.set(key, book_ids, getattr(settings, 'CATALOG_FRAGMENT_TIMEOUT', 3600))
+        return book_ids
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # ?available=1 lists only books with a copy on the shelf, using the maintained counter.
+        if self.request.GET.get('available'):
+            queryset = queryset.filter(copies_available__gt=0)
+        return queryset
 
     # context_object_name = 'book_list' # custom name for the list as a template variable.
         # context passed by default as "object_list" or "book_list".
@@ -89,23 +140,95 @@ class BookListView(generic.ListView):
     # template_name = 'books/my_arbitray_template_name_list.html' # Specify your own template name/location.
 
 
+class BookBrowseView(CursorPaginationMixin, generic.ListView):
+    """Books filtered by genre, language and author, with the number of books next to each option."""
+    model = Book
+    paginate_by = 10
+    queryset = Book.objects.select_related('author')
+    cursor_ordering = ('title', 'id')
+    template_name = 'catalog/book_browse.html'
+
+    def get(self, request, *args, **kwargs):
+        # The facet counts are cached for common filter sets (see catalog.facets).
+        self.filters = facets.parse_filters(request.GET)
+        self.facets = facets.get_facets(self.filters)
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return facets.filter_books(self.filters).select_related('author').order_by(*self.cursor_ordering)
+
+    def get_paginator(self, *args, **kwargs):
+        # The facets already counted the matching books.
+        paginator = super().get_paginator(*args, **kwargs)
+        paginator.count = self.facets['total']
+        return paginator
+
+    def toggle_query(self, name, value):
+        """Query string that adds or removes one option, back on the first page."""
+        query = self.request.GET.copy()
+        for param in (self.page_kwarg, self.cursor_kwarg):
+            query.pop(param, None)
+        values = query.getlist(name)
+        if str(value) in values:
+            values.remove(str(value))
+        else:
+            values.append(str(value))
+        query.setlist(name, values)
+        return f'?{query.urlencode()}'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['total'] = self.facets['total']
+        context['facets'] = [
+            (name, [{**option, 'selected': option['id'] in self.filters[name],
+                     'query': self.toggle_query(name, option['id'])} for option in self.facets[name]])
+            for name in facets.FACET_NAMES
+        ]
+        context['available'] = self.filters['available']
+        context['available_query'] = self.toggle_query('available', 1)
+        return context
+
+
 # def book_detail_view(request, primary_key):   *CLASS-BASED ALTERNATIVE FOR THE DETAIL VIEW*
 #     book = get_object_or_404(Book, pk=primary_key)
 #     return render(request, 'catalog/book_detail.html', context={'book': book})
 
 
-class BookDetailView(generic.DetailView):
+class BookDetailView(CachedFragmentMixin, generic.DetailView):
     model = Book
+    # Fetch the author and language with the book, and the genres and copies in one query each.
+    queryset = Book.objects.select_related('author', 'language').prefetch_related('genre', 'bookinstance_set')
+    template_name = 'catalog/book_detail.html'
+    fragment_template_name = 'catalog/book_detail_fragment.html'
 
+    def get_version_names(self):
+        return ['catalog', 'taxonomy', f'book:{self.kwargs["pk"]}']
 
-class AuthorListView(generic.ListView):
+
+class AuthorListView(CachedFragmentMixin, CursorPaginationMixin, generic.ListView):
     """This generic view queryies the db to get all records for Author then it renders a template."""
     model = Author
     paginate_by = 10
+    cursor_ordering = ('last_name', 'first_name', 'id')
+    cursor_show_count = True
+    template_name = 'catalog/author_list.html'
+    fragment_template_name = 'catalog/author_list_fragment.html'
+
+    def get_version_names(self):
+        return ['catalog', 'authors']
 
 
-class AuthorDetailView(generic.DetailView):
+class AuthorDetailView(CachedFragmentMixin, generic.DetailView):
     model = Author
+    # Fetch the author's books in one query, each annotated with its number of copies (book.num_copies).
+    queryset = Author.objects.prefetch_related(
+        Prefetch('book_set', queryset=Book.objects.annotate(num_copies=Count('bookinstance')).order_by('title'))
+    )
+    template_name = 'catalog/author_detail.html'
+    fragment_template_name = 'catalog/author_detail_fragment.html'
+
+    def get_version_names(self):
+        return ['catalog', f'author:{self.kwargs["pk"]}']
 
     # num_instances = BookInstance.objects.filter(__str__=author).count()
     #
@@ -115,28 +238,36 @@ class AuthorDetailView(generic.DetailView):
     #     return context
 
 
-class LoanedBooksByUserListView(LoginRequiredMixin,generic.ListView):
+class LoanedBooksByUserListView(LoginRequiredMixin, CursorPaginationMixin, generic.ListView):
     """Generic class-based view listing books on loan to current user."""
     model = BookInstance
     template_name ='catalog/bookinstance_list_borrowed_user.html'
     paginate_by = 10
+    cursor_ordering = ('due_back', 'id')
 
     def get_queryset(self):
         # 'o' is stored code for 'on loan'. Ordered by the due_back date so that the oldest items are displayed first.
-        return BookInstance.objects.filter(borrower=self.request.user).filter(status__exact='o').order_by('due_back')
+        return (BookInstance.objects.filter(borrower=self.request.user).filter(status__exact='o')
+                .with_overdue().select_related('book').order_by(*self.cursor_ordering))
 
 
-class AllLoanedBooksListView(LoginRequiredMixin, PermissionRequiredMixin, generic.ListView):
+class AllLoanedBooksListView(LoginRequiredMixin, PermissionRequiredMixin, CursorPaginationMixin, generic.ListView):
     """Generic class-based view listing all books on loan."""
     model = BookInstance
     template_name ='catalog/bookinstance_list_borrowed_users.html'
     paginate_by = 10
+    cursor_ordering = ('due_back', 'id')
+    cursor_show_count = True
 
     permission_required = 'catalog.can_mark_returned'
 
     def get_queryset(self):
         # 'o' is stored code for 'on loan'. Ordered by the due_back date so that the oldest items are displayed first.
-        return BookInstance.objects.filter(status__exact='o').order_by('due_back')
+        queryset = BookInstance.objects.filter(status__exact='o')
+        # ?overdue=1 lists only the loans past their due date.
+        if self.request.GET.get('overdue'):
+            queryset = queryset.overdue()
+        return queryset.with_overdue().select_related('book', 'borrower').order_by(*self.cursor_ordering)
 
 
 #   FUNCTIONAL FORM VIEW 1:
@@ -150,21 +281,28 @@ def renew_book_librarian(request, pk):
     if request.method == 'POST':
 
         # Create a form instance and populate it with data from the request (binding):
-        form = RenewBookForm(request.POST)
+        form = RenewBookLibrarianForm(request.POST)
 
         # Check if the form is valid:
         if form.is_valid():
-            # process the data in form.cleaned_data as required (here we just write it to the model due_back field)
-            book_instance.due_back = form.cleaned_data['renewal_date']
-            book_instance.save()
-
-            # redirect to a new URL:
-            return HttpResponseRedirect(reverse('all-borrowed') )
+            # process the data in form.cleaned_data as required (here we just write it to the model due_back field).
+            # The UPDATE only applies if the copy is still the loan shown on the form (same borrower and due date),
+            # so a renewal cannot overwrite a return, or renew another loan of the copy, made in the meantime.
+            try:
+                loans.renew(book_instance.pk, form.cleaned_data['renewal_date'],
+                            borrower=form.cleaned_data['borrower'], due_back=form.cleaned_data['due_back'])
+            except loans.LoanConflict as e:
+                form.add_error(None, str(e))
+            else:
+                # redirect to a new URL:
+                return HttpResponseRedirect(reverse('all-borrowed') )
 
     # If this is a GET (or any other method) create the default form.
     else:
         proposed_renewal_date = datetime.date.today() + datetime.timedelta(weeks=3)
-        form = RenewBookForm(initial={'renewal_date': proposed_renewal_date})
+        form = RenewBookLibrarianForm(initial={'renewal_date': proposed_renewal_date,
+                                               'borrower': book_instance.borrower_id,
+                                               'due_back': book_instance.due_back})
 
     context = {
         'form': form,
@@ -173,6 +311,55 @@ def renew_book_librarian(request, pk):
 
     return render(request, 'catalog/book_renew_librarian.html', context)
 
+
+@login_required
+@permission_required('catalog.can_mark_returned', raise_exception=True)
+def bulk_update_loans(request):
+    """View function for renewing or returning many BookInstances at once (posted from the all-borrowed list)."""
+    if request.method != 'POST':
+        return HttpResponseRedirect(reverse('all-borrowed'))
+
+    form = BulkLoanForm(request.POST)
+    results = None
+    if form.is_valid():
+        ids = form.cleaned_data['book_instances']
+        if form.cleaned_data['action'] == BulkLoanForm.RENEW:
+            results = loans.renew_loans(ids, form.cleaned_data['renewal_date'])
+        else:
+            results = loans.return_loans(ids)
+
+    context = {
+        'form': form,
+        'results': sorted(results.items(), key=lambda item: item[1]) if results else None,
+    }
+    return render(request, 'catalog/bulk_loan_results.html', context, status=200 if form.is_valid() else 400)
+
+
+@login_required
+@permission_required('catalog.can_mark_returned', raise_exception=True)
+def circulation_report(request):
+    """View function for loans, returns and overdues per genre, language or book over the last days."""
+    by = request.GET.get('by')
+    if by not in circulation.ROLLUPS:
+        by = 'genre'
+    try:
+        days = min(max(int(request.GET.get('days', 30)), 1), 366)
+    except ValueError:
+        days = 30
+    # The daily rollups are maintained by the rollup_circulation command, so no loan history is scanned here.
+    until = datetime.date.today()
+    since = until - datetime.timedelta(days=days - 1)
+    context = {
+        'by': by,
+        'dimensions': list(circulation.ROLLUPS),
+        'days': days,
+        'since': since,
+        'until': until,
+        'rows': circulation.report(by, since, until),
+    }
+    return render(request, 'catalog/circulation_report.html', context)
+
+
 class AuthorCreate(PermissionRequiredMixin, CreateView):
     model = Author
     fields = ['first_name', 'last_name', 'date_of_birth', 'date_of_death']
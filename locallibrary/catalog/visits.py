@@ -0,0 +1,199 @@
+"""Home page visit counting without a session write on every request.
+
+Each visitor is identified by a signed cookie holding a random id, set on their first visit.
+Visits are added to a buffer in the process's memory and written to the VisitCount table in
+one batch when CATALOG_VISIT_FLUSH_INTERVAL seconds have passed since the last write, or when
+CATALOG_VISIT_MAX_PENDING visits are waiting, whichever comes first. The count shown to a
+visitor is the stored count plus the visits still waiting in this process.
+
+If the process dies, the visits waiting in its buffer are lost, so at most
+CATALOG_VISIT_MAX_PENDING visits per process can be lost. A failed write (e.g. "database is
+locked") is logged rather than failing the page. The buffer keeps at most
+CATALOG_VISIT_MAX_PENDING of the visits and retries after CATALOG_VISIT_FLUSH_INTERVAL; while
+the database refuses writes, visits beyond that are dropped rather than held. Each process has
+its own buffer; writes add to the stored counts, so several processes can flush to the same rows.
+
+    CATALOG_VISIT_FLUSH_INTERVAL  -- seconds between writes (default 10, 0 to write on every visit)
+    CATALOG_VISIT_MAX_PENDING     -- write once this many visits are waiting (default 100)
+"""
+
+import atexit
+import logging
+import threading
+import uuid
+from collections import Counter, defaultdict
+from time import monotonic
+
+from django.conf import settings
+from django.core import signing
+from django.db import DatabaseError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from catalog.models import VisitCount
+
+COOKIE_NAME = 'catalog_visitor'
+COOKIE_SALT = 'catalog.visits'
+COOKIE_MAX_AGE = 365 * 24 * 60 * 60
+
+logger = logging.getLogger('catalog.visits')
+
+
+class VisitBuffer:
+    """Visits waiting to be written, as a Counter of visitor id -> visits. Safe to share between threads."""
+
+    def __init__(self, flush_interval=None, max_pending=None):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = Counter()
+        self.num_pending = 0
+        self.last_flush = monotonic()
+        # After a failed write, no flush is tried before this time.
+        self.retry_after = 0.0
+        # Visits taken out of the buffer by a flush that has not committed yet; still counted as waiting.
+        self.writing = Counter()
+        # Incremented whenever a flush has committed, so the visits it wrote are now stored.
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get_flush_interval(self):
+        if self.flush_interval is not None:
+            return self.flush_interval
+        return getattr(settings, 'CATALOG_VISIT_FLUSH_INTERVAL', 10)
+
+    def get_max_pending(self):
+        if self.max_pending is not None:
+            return self.max_pending
+        return getattr(settings, 'CATALOG_VISIT_MAX_PENDING', 100)
+
+    def add(self, visitor):
+        """Count a visit, flushing the buffer if it is due. Returns the visitor's visits still waiting.
+
+        A failed flush is logged, never raised, so counting a visit cannot fail the page.
+        """
+        with self.lock:
+            now = monotonic()
+            if self.num_pending >= self.get_max_pending() and now < self.retry_after:
+                # The last write failed and the buffer is full: drop the visit rather than grow it.
+                return self.pending[visitor] + 1
+            self.pending[visitor] += 1
+            self.num_pending += 1
+            due = now >= self.retry_after and (self.num_pending >= self.get_max_pending()
+                                               or now - self.last_flush >= self.get_flush_interval())
+        if due:
+            try:
+                self.flush()
+            except DatabaseError:
+                logger.warning('Could not write pending visits, will retry', exc_info=True)
+        with self.lock:
+            return self.pending[visitor]
+
+    def waiting(self, visitor):
+        return self.snapshot(visitor)[1]
+
+    def snapshot(self, visitor):
+        """Return (generation, the visitor's visits waiting), read together."""
+        with self.lock:
+            return self.generation, self.pending[visitor] + self.writing[visitor]
+
+    def flush(self):
+        """Write the waiting visits to VisitCount. Returns the number of visits written."""
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+            self.num_pending = 0
+            self.last_flush = monotonic()
+            self.writing.update(pending)
+        if not pending:
+            return 0
+        try:
+            write_visits(pending)
+        except Exception:
+            # Keep up to max_pending visits for the next try, one flush interval from now.
+            with self.lock:
+                self.writing -= pending
+                room = self.get_max_pending() - self.num_pending
+                kept = Counter()
+                for visitor, visits in pending.items():
+                    if room <= 0:
+                        break
+                    kept[visitor] = min(visits, room)
+                    room -= kept[visitor]
+                self.pending.update(kept)
+                self.num_pending += sum(kept.values())
+                self.retry_after = monotonic() + self.get_flush_interval()
+            dropped = sum(pending.values()) - sum(kept.values())
+            if dropped:
+                logger.warning('Dropped %d visits that could not be written', dropped)
+            raise
+        # Only now that the visits are stored: a reader must not miss them in both places.
+        with self.lock:
+            self.writing -= pending
+            self.generation += 1
+        return sum(pending.values())
+
+
+def write_visits(pending):
+    """Add the visits in pending (visitor id -> visits) to the stored counts.
+
+    Missing rows are created first (ignoring rows another process has just created), then
+    the counts are increased with one UPDATE per distinct number of visits, which is usually
+    only a handful of statements however many visitors are in the batch.
+    """
+    by_increment = defaultdict(list)
+    for visitor, visits in pending.items():
+        by_increment[visits].append(visitor)
+    now = timezone.now()
+    with transaction.atomic():
+        VisitCount.objects.bulk_create(
+            [VisitCount(visitor=visitor, last_flushed=now) for visitor in pending], ignore_conflicts=True)
+        for visits, visitors in by_increment.items():
+            VisitCount.objects.filter(visitor__in=visitors).update(count=F('count') + visits, last_flushed=now)
+
+
+buffer = VisitBuffer()
+
+
+@atexit.register
+def flush_at_exit():
+    try:
+        buffer.flush()
+    except DatabaseError:
+        logger.exception('Could not write %d pending visits at exit', buffer.num_pending)
+
+
+def get_visitor(request):
+    """Return the visitor id from the request's cookie, or None for a new (or tampered) cookie."""
+    try:
+        value = request.get_signed_cookie(COOKIE_NAME, salt=COOKIE_SALT)
+        return str(uuid.UUID(value))
+    except (KeyError, signing.BadSignature, ValueError):
+        return None
+
+
+def count_visit(request):
+    """Count a visit to the home page and return the visitor's number of earlier visits.
+
+    A visitor without a cookie is given a new id; the caller then sets the cookie with
+    set_visitor_cookie() on the response. Only the stored count is read from the database.
+    """
+    visitor = get_visitor(request)
+    new = visitor is None
+    if new:
+        visitor = str(uuid.uuid4())
+        request.catalog_visitor = visitor
+    buffer.add(visitor)
+    while True:
+        generation, waiting = buffer.snapshot(visitor)
+        stored = 0 if new else VisitCount.objects.filter(pk=visitor).values_list('count', flat=True).first() or 0
+        # If a flush committed meanwhile, the count may or may not include its visits: read again.
+        if buffer.snapshot(visitor)[0] == generation:
+            return stored + waiting - 1
+
+
+def set_visitor_cookie(request, response):
+    """Set the cookie for a visitor seen for the first time by count_visit()."""
+    visitor = getattr(request, 'catalog_visitor', None)
+    if visitor:
+        response.set_signed_cookie(COOKIE_NAME, visitor, salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE,
+                                   httponly=True, samesite='Lax')
+    return response